@@ -7,4 +7,5 @@ class KpiAnalyzerConfig(AppConfig):
     verbose_name = 'KPI Анализатор'
 
     def ready(self):
-        import kpi_analyzer.signals
\ No newline at end of file
+        import kpi_analyzer.signals
+        import kpi_analyzer.checks
\ No newline at end of file
@@ -0,0 +1,18 @@
+from django.core import checks
+
+from .services.db_service import DBService
+from .services.itrade_pool import ItradeConnectionPool
+
+
+@checks.register()
+def check_itrade_concurrency(app_configs, **kwargs):
+    """Загрузка данных анализа не должна занимать больше соединений, чем есть в пуле itrade"""
+    workers = DBService.FETCH_WORKERS + DBService.PARTITION_WORKERS
+    if workers > ItradeConnectionPool.SIZE:
+        return [checks.Warning(
+            f"KPI_FETCH_WORKERS + KPI_PARTITION_WORKERS ({workers}) больше ITRADE_POOL_SIZE "
+            f"({ItradeConnectionPool.SIZE}): запросы анализа будут ждать соединение и могут завершаться PoolTimeout",
+            hint="Уменьшите число потоков загрузки или увеличьте ITRADE_POOL_SIZE",
+            id='kpi_analyzer.W001',
+        )]
+    return []
@@ -1,7 +1,11 @@
 import json
+from asgiref.sync import sync_to_async
+from celery.result import AsyncResult
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
 from .models import Cell
+from .services.analysis_jobs import AnalysisJobProgress
 
 class SpreadsheetConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -102,4 +106,73 @@ class SpreadsheetConsumer(AsyncWebsocketConsumer):
             cell.save()
         except Cell.DoesNotExist:
             # Создание новой ячейки
-            Cell.objects.create(**cell_data)
\ No newline at end of file
+            Cell.objects.create(**cell_data)
+
+
+class KpiAnalysisJobConsumer(AsyncWebsocketConsumer):
+    """Прогресс фонового KPI анализа: этапы fetch/ingest/finalize/format/done (или failed).
+
+    Сразу после подключения отправляет текущее состояние задачи - прогресс,
+    опубликованный до подключения клиента, не теряется. Подключиться может только сессия,
+    поставившая задачу (см. AnalysisJobProgress.owns).
+    """
+
+    async def connect(self):
+        self.job_id = self.scope['url_route']['kwargs']['job_id']
+        self.group_name = AnalysisJobProgress.group_name(self.job_id)
+
+        if not await self.owns_job():
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+
+        await self.accept()
+        await self.send_job_state()
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(
+            self.group_name,
+            self.channel_name
+        )
+
+    async def receive(self, text_data):
+        """Любое сообщение клиента - запрос текущего состояния задачи"""
+        await self.send_job_state()
+
+    async def job_progress(self, event):
+        """Отправка этапа анализа клиенту"""
+        await self.send(text_data=json.dumps({
+            'type': 'job_progress',
+            'progress': event['progress']
+        }, cls=DjangoJSONEncoder))
+
+    async def send_job_state(self):
+        state, info = await self.get_job_state()
+        await self.send(text_data=json.dumps({
+            'type': 'job_state',
+            'job_id': self.job_id,
+            'status': state.lower(),
+            'progress': info,
+        }, cls=DjangoJSONEncoder))
+
+    @database_sync_to_async
+    def owns_job(self):
+        return AnalysisJobProgress.owns(self.scope.get('session'), self.job_id)
+
+    @sync_to_async
+    def get_job_state(self):
+        """Состояние задачи из result backend; сам результат забирается через REST (jobs/<job_id>/)"""
+        result = AsyncResult(self.job_id)
+        try:
+            state = result.state
+        except Exception as e:
+            return 'UNKNOWN', {'error': str(e)}
+        if state == 'PROGRESS':
+            return state, result.info
+        if state == 'FAILURE':
+            return state, {'error': str(result.result)}
+        return state, None
@@ -0,0 +1,150 @@
+import gc
+import logging
+import random
+import tracemalloc
+from datetime import date, timedelta
+from typing import Callable, Dict, List, Any, Tuple
+
+from django.core.management.base import BaseCommand
+
+from kpi_analyzer.services.db_service import DBService
+from kpi_analyzer.services.engine_call_efficiency2 import Call, Lead, CallGroup, Kpi
+from kpi_analyzer.services.kpi_analyzer import Stat, KpiStat, LeadContainer, CommonItem, OfferItem
+
+
+class Command(BaseCommand):
+    help = ("Бенчмарк памяти движка анализа: байт на звонок при приеме синтетического месяца данных "
+            "и байт на объект для классов со __slots__ и тех же атрибутов в __dict__ (как до __slots__)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200000, help='Число звонков (по умолчанию 200000)')
+        parser.add_argument('--leads', type=int, default=None, help='Число лидов (по умолчанию calls / 5)')
+        parser.add_argument('--days', type=int, default=30, help='Число дней периода (по умолчанию 30)')
+        parser.add_argument('--seed', type=int, default=7)
+
+    @staticmethod
+    def _make_rows(calls_count: int, leads_count: int, days: int, seed: int) -> Tuple[List, List, List[Dict], List[Dict]]:
+        """Компактные строки звонков и лидов (как при потоковом чтении get_calls / get_leads), офферы и планы"""
+        r = random.Random(seed)
+        base = date(2025, 9, 1)
+        categories = ('Cat A', 'Cat B', 'Cat C')
+        offers = [{'id': i, 'name': f'Offer {i}', 'category_name': categories[i % 3]} for i in range(1, 41)]
+        operators = [f'op{i}' for i in range(40)]
+        affiliates = [100 + i for i in range(20)] + [None]
+
+        calls = []
+        for i in range(calls_count):
+            offer = r.choice(offers)
+            calls.append({'call_eff_id': i + 1, 'call_eff_crm_id': i, 'call_eff_offer_id': offer['id'],
+                          'offer_name': offer['name'], 'call_eff_uniqueid': f'u{r.randrange(calls_count // 2 or 1)}',
+                          'call_eff_calldate': (base + timedelta(days=r.randrange(days))).isoformat(),
+                          'call_eff_crm_lead_id': r.randrange(calls_count // 4 or 1),
+                          'call_eff_operator_id': r.randrange(40), 'call_eff_billsec': r.randrange(0, 300),
+                          'call_eff_billsec_exact': None, 'call_eff_robo_detected': 0,
+                          'lv_username': r.choice(operators), 'category_name': offer['category_name'],
+                          'call_eff_affiliate_id': r.choice(affiliates)})
+        calls.sort(key=lambda c: c['call_eff_calldate'])
+
+        leads = []
+        for i in range(leads_count):
+            offer = r.choice(offers)
+            day = (base + timedelta(days=r.randrange(days))).isoformat()
+            leads.append({'call_eff_crm_lead_id': i, 'call_eff_approved_at': f'{day} 12:00:00',
+                          'call_eff_canceled_at': None, 'lv_username': r.choice(operators),
+                          'call_eff_operator_id': r.randrange(40), 'call_eff_status_verbose': 'Подтвержден',
+                          'call_eff_status_group': 'accepted', 'offer_id': offer['id'], 'offer_name': offer['name'],
+                          'category_name': offer['category_name'], 'aff_id': r.choice(affiliates)})
+
+        plans = [{'call_eff_kpi_id': i + 1, 'call_eff_period_date': base.isoformat(), 'call_eff_offer_id': offer['id'],
+                  'call_eff_affiliate_id': None, 'call_eff_plan_update_date': base.isoformat(),
+                  'call_eff_operator_efficiency': 2.0, 'call_eff_planned_approve': 0.4,
+                  'call_eff_planned_buyout': 0.6, 'call_eff_confirmation_price': 10, 'call_eff_buyout_price': 5}
+                 for i, offer in enumerate(offers)]
+        return Command._compact(calls), Command._compact(leads), offers, plans
+
+    @staticmethod
+    def _compact(rows: List[Dict]) -> List[Any]:
+        row_type = DBService._row_type(list(rows[0].keys())) if rows else None
+        return [row_type._make(row.values()) for row in rows]
+
+    @staticmethod
+    def _traced(build: Callable[[], Any]) -> Tuple[int, Any]:
+        """Прирост памяти (tracemalloc) за время build, результат build остается живым"""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = build()
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return size, result
+
+    @staticmethod
+    def _slots(cls: type) -> List[str]:
+        return [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ())]
+
+    @staticmethod
+    def _copy(objects: List[Any], cls: type, names: List[str]) -> List[Any]:
+        """Копии объектов класса cls с теми же значениями атрибутов (значения общие, копируется только объект)"""
+        copies = []
+        for obj in objects:
+            copy = cls.__new__(cls)
+            for name in names:
+                if hasattr(obj, name):
+                    setattr(copy, name, getattr(obj, name))
+            copies.append(copy)
+        return copies
+
+    def _per_object(self, objects: List[Any]) -> Tuple[float, float]:
+        """Байт на объект: класс со __slots__ и такой же класс с атрибутами в __dict__.
+
+        Сравнивается только сам объект: словари, которые CallGroup до __slots__ создавал заранее,
+        сюда не входят (их экономия видна в замере приема).
+        """
+        cls = type(objects[0])
+        names = self._slots(cls)
+        plain = type(f'{cls.__name__}Dict', (), {})
+        slotted, _ = self._traced(lambda: self._copy(objects, cls, names))
+        with_dict, _ = self._traced(lambda: self._copy(objects, plain, names))
+        return slotted / len(objects), with_dict / len(objects)
+
+    def handle(self, *args, **options):
+        # Логи движка (пропуски дублей и т.п.) искажают замер и засоряют вывод
+        logging.disable(logging.WARNING)
+        calls_count = options['calls']
+        leads_count = options['leads'] if options['leads'] is not None else calls_count // 5
+        calls, leads, offers, plans = self._make_rows(calls_count, leads_count, options['days'], options['seed'])
+
+        def ingest():
+            stat = Stat()
+            for offer in offers:
+                stat.push_offer(offer)
+            for lead in leads:
+                stat.push_lead(lead)
+            for call in calls:
+                stat.push_call(call)
+            return stat
+
+        size, stat = self._traced(ingest)
+        self.stdout.write(f"Прием: звонков {calls_count}, лидов {leads_count}, дней {options['days']}: "
+                          f"{size / 2 ** 20:.1f} МБ, {size / max(calls_count, 1):.0f} байт на звонок")
+
+        groups = [group for category in stat.category.values() for group in category.kpi_stat.stat.calls_group.values()]
+        samples = {
+            Call: [call for group in groups for call in group.calls.values()],
+            Lead: [lead for category in stat.category.values() for lead in category.kpi_stat.stat.leads.values()],
+            CallGroup: groups,
+            Kpi: [Kpi(plan) for plan in plans],
+            KpiStat: [KpiStat() for _ in range(1000)],
+            LeadContainer: [LeadContainer() for _ in range(1000)],
+            CommonItem: [CommonItem(str(i), '') for i in range(1000)],
+            OfferItem: [item for category in stat.category.values() for item in category.offer.values()],
+        }
+        self.stdout.write(f"{'Класс':<14}{'объектов':>10}{'__slots__':>12}{'__dict__':>12}{'экономия':>10}")
+        for cls, objects in samples.items():
+            if not objects:
+                continue
+            slotted, with_dict = self._per_object(objects)
+            self.stdout.write(f"{cls.__name__:<14}{len(objects):>10}{slotted:>12.0f}{with_dict:>12.0f}"
+                              f"{(1 - slotted / with_dict) * 100 if with_dict else 0:>9.0f}%")
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.7 on 2026-10-17 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi_analyzer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KpiFactDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('call_groups_count', models.IntegerField(default=0)),
+                ('lead_facts_count', models.IntegerField(default=0)),
+                ('container_facts_count', models.IntegerField(default=0)),
+                ('build_seconds', models.FloatField(default=0.0)),
+                ('built_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'kpi_fact_day',
+                'ordering': ['day'],
+            },
+        ),
+        migrations.CreateModel(
+            name='KpiCallGroupFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('seq', models.IntegerField()),
+                ('calldate', models.CharField(max_length=10)),
+                ('category_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('offer_id', models.IntegerField(blank=True, null=True)),
+                ('offer_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('affiliate_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('lv_username', models.CharField(blank=True, max_length=150, null=True)),
+                ('subsystem_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('operator_id', models.BigIntegerField(blank=True, null=True)),
+                ('crm_lead_id', models.BigIntegerField(blank=True, null=True)),
+                ('first_call_id', models.BigIntegerField(blank=True, null=True)),
+                ('billsec', models.IntegerField(default=0)),
+                ('calls_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'kpi_fact_call_group',
+                'indexes': [models.Index(fields=['day', 'seq'], name='kpi_fact_ca_day_557963_idx'), models.Index(fields=['day', 'category_name'], name='kpi_fact_ca_day_3f2b15_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='KpiLeadContainerFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('category_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('offer_id', models.IntegerField(blank=True, null=True)),
+                ('aff_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('lv_username', models.CharField(blank=True, max_length=150, null=True)),
+                ('subsystem_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('raw_count', models.IntegerField(default=0)),
+                ('non_trash_count', models.IntegerField(default=0)),
+                ('approved_count', models.IntegerField(default=0)),
+                ('buyout_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'kpi_fact_lead_container',
+                'indexes': [models.Index(fields=['day', 'category_name'], name='kpi_fact_le_day_eb938e_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='KpiLeadFact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('category_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('offer_id', models.IntegerField(blank=True, null=True)),
+                ('offer_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('aff_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('lv_username', models.CharField(blank=True, max_length=150, null=True)),
+                ('subsystem_name', models.CharField(blank=True, max_length=255, null=True)),
+                ('leads_count', models.IntegerField(default=0)),
+                ('salary_leads_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'kpi_fact_lead',
+                'indexes': [models.Index(fields=['day', 'category_name'], name='kpi_fact_le_day_541b6e_idx')],
+            },
+        ),
+    ]
@@ -161,3 +161,86 @@ class KpiData(models.Model):
 
     def __str__(self):
         return f"{self.category} - {self.offer_name} - {self.date_from}"
+
+
+# === ТАБЛИЦЫ ФАКТОВ KPI (дневные агрегаты из itrade, см. services/kpi_facts.py) ===
+class KpiFactDay(models.Model):
+    """День, материализованный в таблицы фактов. Закрытые дни анализ читает отсюда, а не из itrade"""
+    day = models.DateField(unique=True)
+    call_groups_count = models.IntegerField(default=0)
+    lead_facts_count = models.IntegerField(default=0)
+    container_facts_count = models.IntegerField(default=0)
+    build_seconds = models.FloatField(default=0.0)
+    built_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'kpi_fact_day'
+        ordering = ['day']
+
+    def __str__(self):
+        return f"{self.day} ({self.built_at})"
+
+
+class KpiCallGroupFact(models.Model):
+    """Звонки дня, сгруппированные по (дата звонка, оператор, CRM лид) внутри ячейки
+    (категория, оффер, вебмастер, оператор LV, рекламодатель). billsec - максимальный в группе"""
+    day = models.DateField()
+    seq = models.IntegerField()
+    calldate = models.CharField(max_length=10)
+    category_name = models.CharField(max_length=255, blank=True, null=True)
+    offer_id = models.IntegerField(blank=True, null=True)
+    offer_name = models.CharField(max_length=255, blank=True, null=True)
+    affiliate_id = models.CharField(max_length=64, blank=True, null=True)
+    lv_username = models.CharField(max_length=150, blank=True, null=True)
+    subsystem_name = models.CharField(max_length=255, blank=True, null=True)
+    operator_id = models.BigIntegerField(blank=True, null=True)
+    crm_lead_id = models.BigIntegerField(blank=True, null=True)
+    first_call_id = models.BigIntegerField(blank=True, null=True)
+    billsec = models.IntegerField(default=0)
+    calls_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'kpi_fact_call_group'
+        indexes = [
+            models.Index(fields=['day', 'seq']),
+            models.Index(fields=['day', 'category_name']),
+        ]
+
+
+class KpiLeadFact(models.Model):
+    """Лиды дня (по дате аппрува) по ячейкам: количество строк и оплачиваемых лидов"""
+    day = models.DateField()
+    category_name = models.CharField(max_length=255, blank=True, null=True)
+    offer_id = models.IntegerField(blank=True, null=True)
+    offer_name = models.CharField(max_length=255, blank=True, null=True)
+    aff_id = models.CharField(max_length=64, blank=True, null=True)
+    lv_username = models.CharField(max_length=150, blank=True, null=True)
+    subsystem_name = models.CharField(max_length=255, blank=True, null=True)
+    leads_count = models.IntegerField(default=0)
+    salary_leads_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'kpi_fact_lead'
+        indexes = [
+            models.Index(fields=['day', 'category_name']),
+        ]
+
+
+class KpiLeadContainerFact(models.Model):
+    """Контейнер лидов дня (по дате создания) по ячейкам: сырые, не треш, аппрув, выкуп"""
+    day = models.DateField()
+    category_name = models.CharField(max_length=255, blank=True, null=True)
+    offer_id = models.IntegerField(blank=True, null=True)
+    aff_id = models.CharField(max_length=64, blank=True, null=True)
+    lv_username = models.CharField(max_length=150, blank=True, null=True)
+    subsystem_name = models.CharField(max_length=255, blank=True, null=True)
+    raw_count = models.IntegerField(default=0)
+    non_trash_count = models.IntegerField(default=0)
+    approved_count = models.IntegerField(default=0)
+    buyout_count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'kpi_fact_lead_container'
+        indexes = [
+            models.Index(fields=['day', 'category_name']),
+        ]
@@ -1,9 +1,18 @@
+from django.conf import settings
+
+
 class ITradeRouter:
     """
     ВСЁ приложение kpi_analyzer — работает с default (kpi_db)
-    База itrade — ТОЛЬКО для ручного чтения через .using('itrade')
+    База itrade и ее реплики (ITRADE_REPLICAS, ITRADE_QUERY_REPLICAS) — ТОЛЬКО для чтения
+    через DBService (см. ItradeReplicaSet), миграции на них не применяются
     """
 
+    @staticmethod
+    def itrade_aliases():
+        return ({'itrade'} | set(getattr(settings, 'ITRADE_REPLICAS', []))
+                | set(getattr(settings, 'ITRADE_QUERY_REPLICAS', {}).values()))
+
     def db_for_read(self, model, **hints):
         if model._meta.app_label == 'kpi_analyzer':
             return 'default'
@@ -22,6 +31,9 @@ class ITradeRouter:
         """
 
         """
+        if db in self.itrade_aliases():
+            return False
+
         if app_label == 'kpi_analyzer':
             return db == 'default'
 
@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/spreadsheet/(?P<spreadsheet_id>\w+)/$', consumers.SpreadsheetConsumer.as_asgi()),
+    re_path(r'ws/kpi-jobs/(?P<job_id>[\w-]+)/$', consumers.KpiAnalysisJobConsumer.as_asgi()),
 ]
\ No newline at end of file
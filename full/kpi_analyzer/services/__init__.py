@@ -12,7 +12,18 @@ from .engine_call_efficiency2 import (
 )
 from .kpi_analyzer import CommonItem, CategoryItem, OfferItem, OpAnalyzeKPI, KpiStat, Stat, Recommendation, RecommendationEngine
 from .formula_engine import FormulaEngine
-from .db_service import DBService
+from .db_service import DBService, CompactRow
+from .analysis_cache import AnalysisCache
+from .partition_cache import PartitionCache
+from .itrade_pool import ItradeConnectionPool, PoolTimeout, itrade_pool
+from .itrade_replicas import ItradeReplicaSet, itrade_replicas
+from .query_stats import QueryStats, QueryCollector
+from .reference_data import ReferenceData
+from .kpi_facts import KpiFactService
+from .kpi_plan_cache import KpiPlanCache
+from .parallel_finalize import ParallelFinalize
+from .stat_partial import StatPartial
+from .incremental_analysis import IncrementalAnalysis
 from .output_formatter import KPIOutputFormatter
 from .compatibility import GoogleScriptCompatibility
 
@@ -37,6 +48,22 @@ __all__ = [
     'Stat',
     'FormulaEngine',
     'DBService',
+    'CompactRow',
+    'AnalysisCache',
+    'PartitionCache',
+    'ItradeConnectionPool',
+    'PoolTimeout',
+    'itrade_pool',
+    'ItradeReplicaSet',
+    'itrade_replicas',
+    'QueryStats',
+    'QueryCollector',
+    'ReferenceData',
+    'KpiFactService',
+    'KpiPlanCache',
+    'ParallelFinalize',
+    'StatPartial',
+    'IncrementalAnalysis',
     'KPIOutputFormatter',
     'GoogleScriptCompatibility',
 ]
\ No newline at end of file
@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import time
+import uuid
+import zlib
+from datetime import datetime
+from typing import Dict, Any, Optional, Callable, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisCache:
+    """Кэш результатов KPI анализа в django cache (redis).
+
+    Ключ - эндпоинт + хэш нормализованных фильтров, значение - ответ эндпоинта в сжатом JSON.
+    Ошибки кэша не прерывают анализ: при недоступном redis результат просто считается заново.
+    """
+    KEY_PREFIX = 'kpi_analysis'
+    # Увеличить при изменении формата ответа, чтобы не отдавать устаревшие записи
+    VERSION = 1
+
+    # Периоды целиком в прошлом почти не меняются, периоды с сегодняшним днем - постоянно
+    TTL_PAST = getattr(settings, 'ANALYSIS_CACHE_TTL_PAST', 6 * 60 * 60)
+    TTL_TODAY = getattr(settings, 'ANALYSIS_CACHE_TTL_TODAY', 2 * 60)
+
+    # Фильтры-списки: порядок и повторы значения не имеют
+    LIST_FILTERS = ('advertiser', 'offer_id', 'category', 'lv_op', 'aff_id')
+    # Фильтры, которые DBService сравнивает без учета регистра
+    LOWERCASE_FILTERS = ('advertiser', 'lv_op')
+    DATE_FILTERS = ('date_from', 'date_to')
+    # Управляющие флаги запроса, не влияющие на результат
+    NON_FILTER_KEYS = ('refresh', 'async')
+
+    # Single-flight: одновременные одинаковые запросы ждут результат первого, а не считают его заново.
+    # Блокировка переживает падение воркера не дольше LOCK_TTL
+    LOCK_TTL = getattr(settings, 'ANALYSIS_CACHE_LOCK_TTL', 10 * 60)
+    WAIT_TIMEOUT = getattr(settings, 'ANALYSIS_CACHE_WAIT_TIMEOUT', 5 * 60)
+    POLL_INTERVAL = 0.5
+    # Итог попытки вычисления для ожидающих запросов: маркер успеха или ответ с ошибкой.
+    # Ответ с ошибкой отдается только ожидавшим эту попытку и не кэшируется для новых
+    ATTEMPT_TTL = 30
+
+    # Снятие блокировки только ее владельцем: сравнение токена и удаление одной командой
+    RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+    HITS_KEY = f'{KEY_PREFIX}:stats:hits'
+    MISSES_KEY = f'{KEY_PREFIX}:stats:misses'
+
+    @staticmethod
+    def _normalize_date(value: Any) -> Any:
+        if not value:
+            return None
+        value = str(value).strip()
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+            try:
+                parsed = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            return parsed.strftime(fmt)
+        return value
+
+    @staticmethod
+    def normalize_filters(filters: Dict) -> Dict[str, Any]:
+        """Каноничный вид фильтров: одинаковые по смыслу запросы дают одинаковый словарь"""
+        normalized = {}
+        for key, value in (filters or {}).items():
+            if key in AnalysisCache.NON_FILTER_KEYS:
+                continue
+            if key in AnalysisCache.DATE_FILTERS:
+                value = AnalysisCache._normalize_date(value)
+            elif key in AnalysisCache.LIST_FILTERS and isinstance(value, (list, tuple)):
+                values = [str(v).strip() for v in value]
+                if key in AnalysisCache.LOWERCASE_FILTERS:
+                    values = [v.lower() for v in values]
+                value = sorted(set(values))
+            normalized[key] = value
+        return normalized
+
+    @staticmethod
+    def make_key(endpoint: str, filters: Dict) -> str:
+        payload = json.dumps(AnalysisCache.normalize_filters(filters), sort_keys=True, ensure_ascii=False,
+                             cls=DjangoJSONEncoder)
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        return f'{AnalysisCache.KEY_PREFIX}:v{AnalysisCache.VERSION}:{endpoint}:{digest}'
+
+    @staticmethod
+    def ttl_for(filters: Dict) -> int:
+        """Короткий TTL, если период включает сегодняшний день (или не ограничен сверху)"""
+        date_to = AnalysisCache._normalize_date((filters or {}).get('date_to'))
+        today = datetime.now().strftime('%Y-%m-%d')
+        if not date_to or str(date_to)[:10] >= today:
+            return AnalysisCache.TTL_TODAY
+        return AnalysisCache.TTL_PAST
+
+    @staticmethod
+    def _load(key: str) -> Optional[Dict[str, Any]]:
+        try:
+            packed = cache.get(key)
+        except Exception as e:
+            logger.warning(f"Кэш анализа недоступен: {e}")
+            return None
+        if packed is None:
+            return None
+        try:
+            return json.loads(zlib.decompress(packed).decode('utf-8'))
+        except Exception as e:
+            logger.warning(f"Поврежденная запись кэша анализа {key}: {e}")
+            return None
+
+    @staticmethod
+    def get(key: str) -> Optional[Dict[str, Any]]:
+        value = AnalysisCache._load(key)
+        AnalysisCache._count(AnalysisCache.HITS_KEY if value is not None else AnalysisCache.MISSES_KEY)
+        return value
+
+    @staticmethod
+    def set(key: str, value: Dict[str, Any], ttl: int):
+        try:
+            packed = zlib.compress(json.dumps(value, ensure_ascii=False, cls=DjangoJSONEncoder).encode('utf-8'))
+            cache.set(key, packed, ttl)
+            logger.info(f"Результат анализа сохранен в кэш: {key}, {len(packed)} байт, TTL {ttl}с")
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить результат анализа в кэш: {e}")
+
+    @staticmethod
+    def _redis():
+        """Клиент redis для блокировок, None - кэш не redis (locmem в разработке)"""
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            return None
+
+    @staticmethod
+    def _acquire_lock(lock_key: str) -> Optional[str]:
+        """Атомарный захват (SET NX) блокировки вычисления, возвращает токен владельца (он же id попытки)"""
+        token = uuid.uuid4().hex
+        try:
+            client = AnalysisCache._redis()
+            if client is None:
+                return token if cache.add(lock_key, token, AnalysisCache.LOCK_TTL) else None
+            # Токен пишется без сериализации django-redis, чтобы его можно было сравнить в RELEASE_SCRIPT
+            acquired = client.set(cache.make_key(lock_key), token, nx=True, ex=AnalysisCache.LOCK_TTL)
+            return token if acquired else None
+        except Exception as e:
+            # Без кэша координация невозможна - считаем сами
+            logger.warning(f"Не удалось захватить блокировку анализа {lock_key}: {e}")
+            return token
+
+    @staticmethod
+    def _release_lock(lock_key: str, token: str):
+        # Снимаем только свою блокировку: чужая могла появиться после истечения LOCK_TTL
+        try:
+            client = AnalysisCache._redis()
+            if client is None:
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+                return
+            client.eval(AnalysisCache.RELEASE_SCRIPT, 1, cache.make_key(lock_key), token)
+        except Exception as e:
+            logger.warning(f"Не удалось снять блокировку анализа {lock_key}: {e}")
+
+    @staticmethod
+    def _lock_owner(lock_key: str) -> Optional[str]:
+        """Токен текущего владельца блокировки, None - блокировки нет"""
+        try:
+            client = AnalysisCache._redis()
+            if client is None:
+                return cache.get(lock_key)
+            owner = client.get(cache.make_key(lock_key))
+            return owner.decode() if owner is not None else None
+        except Exception:
+            return None
+
+    @staticmethod
+    def _attempt_key(key: str, attempt: str) -> str:
+        return f'{key}:attempt:{attempt}'
+
+    @staticmethod
+    def _attempt_result(key: str, attempt: str) -> Optional[Dict[str, Any]]:
+        """Результат завершенной попытки attempt или None, если она еще не завершилась.
+
+        Успешный результат берется из основного ключа: попытка оставляет только маркер.
+        """
+        outcome = AnalysisCache._load(AnalysisCache._attempt_key(key, attempt))
+        if outcome is None or not outcome.get('success'):
+            return outcome
+        return AnalysisCache._load(key)
+
+    @staticmethod
+    def compute_once(key: str, compute: Callable[[], Any], ttl: int, refresh: bool = False) -> Tuple[Any, bool]:
+        """Вычисляет результат для ключа не более одного раза одновременно во всех воркерах.
+
+        Первый запрос захватывает блокировку, считает и кладет результат в кэш (только успешный ответ),
+        а итог попытки - маркер успеха или ответ с ошибкой - в короткоживущий ключ :attempt:<токен>.
+        Остальные ждут итога именно той попытки, которая держит блокировку, поэтому не получают ни
+        ошибку прошлой попытки, ни старое значение при refresh. Если владелец блокировки пропал,
+        не оставив итога (например, упал воркер), ожидающие повторяют попытку сами.
+        Возвращает (результат, получен_от_другого_запроса).
+        """
+        lock_key = f'{key}:lock'
+        deadline = time.time() + AnalysisCache.WAIT_TIMEOUT
+        while True:
+            token = AnalysisCache._acquire_lock(lock_key)
+            if token is not None:
+                try:
+                    # Результат мог появиться, пока захватывали блокировку
+                    value = None if refresh else AnalysisCache._load(key)
+                    if value is not None:
+                        return value, True
+                    value = compute()
+                    if isinstance(value, dict):
+                        if value.get('success'):
+                            AnalysisCache.set(key, value, ttl)
+                            outcome = {'success': True}
+                        else:
+                            outcome = value
+                        AnalysisCache.set(AnalysisCache._attempt_key(key, token), outcome, AnalysisCache.ATTEMPT_TTL)
+                    return value, False
+                finally:
+                    AnalysisCache._release_lock(lock_key, token)
+
+            logger.info(f"Анализ {key} уже выполняется, ожидание результата")
+            attempt = AnalysisCache._lock_owner(lock_key)
+            while time.time() < deadline:
+                time.sleep(AnalysisCache.POLL_INTERVAL)
+                # Владелец читается до итога: итог записывается до снятия блокировки
+                owner = AnalysisCache._lock_owner(lock_key)
+                value = AnalysisCache._attempt_result(key, attempt) if attempt else None
+                if value is not None:
+                    return value, True
+                if owner is None:
+                    break
+                # Блокировку взяла новая попытка (предыдущая истекла по LOCK_TTL) - ждем ее
+                attempt = owner
+            else:
+                logger.warning(f"Не дождались результата анализа {key} за {AnalysisCache.WAIT_TIMEOUT}с, "
+                               f"выполняем самостоятельно")
+                return compute(), False
+
+    @staticmethod
+    def _count(key: str):
+        try:
+            cache.add(key, 0, None)
+            cache.incr(key)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить счетчик кэша анализа: {e}")
+
+    @staticmethod
+    def stats() -> Dict[str, int]:
+        try:
+            counters = cache.get_many([AnalysisCache.HITS_KEY, AnalysisCache.MISSES_KEY])
+        except Exception:
+            counters = {}
+        return {
+            'hits': counters.get(AnalysisCache.HITS_KEY, 0),
+            'misses': counters.get(AnalysisCache.MISSES_KEY, 0),
+        }
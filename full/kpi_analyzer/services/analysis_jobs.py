@@ -0,0 +1,90 @@
+import logging
+import time
+from typing import Dict, Any, Optional
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisJobProgress:
+    """Отчет о ходе фонового KPI анализа (Celery задача).
+
+    Этап сохраняется в meta задачи (state=PROGRESS) и рассылается в группу Channels задачи,
+    на которую подписан KpiAnalysisJobConsumer. Ошибки рассылки не прерывают анализ.
+
+    Задачи принадлежат сессии, которая их поставила (remember): результат и прогресс отдаются
+    только ей (owns).
+    """
+    # Процент готовности по завершении этапа; fetch распределяется по числу запросов.
+    # failed сохраняет процент последнего пройденного этапа
+    STAGES = {
+        'queued': 0,
+        'fetch': 50,
+        'ingest': 70,
+        'finalize': 85,
+        'format': 95,
+        'done': 100,
+    }
+    SESSION_KEY = 'kpi_analysis_jobs'
+    # Сколько последних задач сессии доступны по job_id
+    SESSION_JOBS_LIMIT = 50
+
+    def __init__(self, task, job_id: str):
+        self.task = task
+        self.job_id = job_id
+        self.started_at = time.time()
+        self.channel_layer = get_channel_layer()
+        self.percent = 0
+
+    @staticmethod
+    def remember(session, job_id: str):
+        """Запоминает задачу в сессии, поставившей ее в очередь"""
+        jobs = list(session.get(AnalysisJobProgress.SESSION_KEY, []))
+        jobs.append(job_id)
+        session[AnalysisJobProgress.SESSION_KEY] = jobs[-AnalysisJobProgress.SESSION_JOBS_LIMIT:]
+
+    @staticmethod
+    def owns(session, job_id: str) -> bool:
+        return session is not None and job_id in session.get(AnalysisJobProgress.SESSION_KEY, [])
+
+    @staticmethod
+    def group_name(job_id: str) -> str:
+        return f'kpi_job_{job_id}'
+
+    def _percent(self, stage: str, details: Dict[str, Any]) -> int:
+        if stage == 'fetch' and details.get('total'):
+            return int(self.STAGES['fetch'] * details.get('done', 0) / details['total'])
+        return self.STAGES.get(stage, self.percent)
+
+    def __call__(self, stage: str, **details):
+        self.percent = self._percent(stage, details)
+        meta = {
+            'job_id': self.job_id,
+            'stage': stage,
+            'percent': self.percent,
+            'elapsed_seconds': round(time.time() - self.started_at, 2),
+            **details,
+        }
+        logger.info(f"KPI задача {self.job_id}: {stage} {details}")
+
+        if self.task is not None and stage != 'done':
+            try:
+                self.task.update_state(state='PROGRESS', meta=meta)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить прогресс задачи {self.job_id}: {e}")
+        self.send(self.job_id, meta, channel_layer=self.channel_layer)
+
+    @staticmethod
+    def send(job_id: str, meta: Dict[str, Any], channel_layer: Optional[Any] = None):
+        channel_layer = channel_layer or get_channel_layer()
+        if channel_layer is None:
+            return
+        try:
+            async_to_sync(channel_layer.group_send)(
+                AnalysisJobProgress.group_name(job_id),
+                {'type': 'job_progress', 'progress': meta}
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось отправить прогресс задачи {job_id}: {e}")
@@ -1,26 +1,83 @@
-from django.db import connections
+from django.conf import settings
+from django.utils import timezone
+from MySQLdb.cursors import SSCursor
 import logging
+import os
+import threading
 import time
-from typing import Dict, List, Optional, Any, Tuple
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any, Tuple, Iterator, Iterable, Union, Callable
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from functools import wraps
+from functools import wraps, lru_cache
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_EXCEPTION
 import math
 
+from .itrade_replicas import itrade_replicas
+from .partition_cache import PartitionCache
+from .query_stats import QueryStats
+from .reference_data import ReferenceData
+
 logger = logging.getLogger(__name__)
 
 
+class CompactRow:
+    """Примесь для компактных строк (namedtuple): dict-подобный доступ через get()"""
+    __slots__ = ()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+
 class DBService:
     EXCLUDED_CATEGORIES = ['Архив', 'Входящая линия']
     BAD_APPROVE_STATUS = ['отправить позже', 'отмен', 'предоплаты', '4+ дней', '4 день', '3 день', '2 день', '1 день',
                           'перезвон']
     GOOD_APPROVE_STATUS_GROUP = ['accepted', 'shipped', 'paid', 'return']
+    # Размер таблицы вердиктов по паре (status_group, status_verbose), см. _status_verdict
+    STATUS_VERDICT_CACHE_SIZE = 1024
 
     # Настройки retry
     MAX_RETRIES = 3
     RETRY_DELAY = 1
     BATCH_SIZE = 1000
 
+    # Параллельная загрузка данных анализа (общий для процесса пул потоков, см. _executor)
+    FETCH_WORKERS = getattr(settings, 'KPI_FETCH_WORKERS', 4)
+
+    # Потоковое чтение (серверный курсор)
+    STREAM_CHUNK_SIZE = 5000
+    STREAM_MIN_DAYS = 7
+
+    # Загрузка по дням: недостающие закрытые дни запрашиваются параллельно (см. PartitionCache).
+    # FETCH_WORKERS + PARTITION_WORKERS не должно превышать ITRADE_POOL_SIZE (см. kpi_analyzer.checks)
+    PARTITION_WORKERS = getattr(settings, 'KPI_PARTITION_WORKERS', 3)
+
+    _executors: Dict[str, ThreadPoolExecutor] = {}
+    _executors_pid: Optional[int] = None
+    _executors_lock = threading.Lock()
+
+    # Звонки для анализа группируются в MySQL (см. get_call_groups)
+    CALLS_PUSHDOWN = getattr(settings, 'KPI_CALLS_PUSHDOWN', True)
+    # Лиды и контейнеры лидов загружаются одним запросом (см. get_lead_sets); только без stream -
+    # при потоковом чтении лиды идут отдельным запросом, чтобы не держать их в памяти целиком
+    LEADS_MERGED = getattr(settings, 'KPI_LEADS_MERGED_QUERY', False)
+
+    # Колонки get_leads и get_leads_container в строках get_lead_sets
+    LEAD_SET_COLUMNS = {
+        'leads': ('call_eff_crm_lead_id', 'call_eff_approved_at', 'call_eff_canceled_at', 'lv_username',
+                  'call_eff_operator_id', 'call_eff_status_verbose', 'call_eff_status_group', 'offer_id',
+                  'offer_name', 'category_name', 'aff_id', 'subsystem_name'),
+        'leads_container': ('lead_container_crm_lead_id', 'call_eff_crm_lead_id', 'lead_container_created_at',
+                            'lead_container_approved_at', 'lead_container_canceled_at', 'lead_container_buyout_at',
+                            'lead_container_status_verbose', 'lead_container_status_group',
+                            'lead_container_is_trash', 'lead_container_lead_ttl_till', 'lead_container_now',
+                            'offer_id', 'offer_name', 'aff_id', 'lv_username', 'category_name', 'subsystem_name'),
+    }
+
+    # Кэш классов компактных строк по набору колонок
+    _row_types: Dict[Tuple[str, ...], type] = {}
+
     @staticmethod
     def retry_on_db_error(func):
         """Декоратор для повторных попыток при ошибках БД"""
@@ -51,6 +108,15 @@ class DBService:
         placeholders = ",".join(["%s"] * len(values))
         return f"({placeholders})", [str(v).strip().replace("'", "''") if isinstance(v, str) else v for v in values]
 
+    @staticmethod
+    def _reference_filter(column: str, table: str, names: List[str]) -> Tuple[str, List[Any]]:
+        """Фильтр по именам справочника (без учета регистра) через первичные ключи: column IN (id, ...)"""
+        ids = ReferenceData.resolve_ids(table, names)
+        if not ids:
+            return " AND 1=0", []
+        placeholders, id_params = DBService._prepare_in_values(ids)
+        return f" AND {column} IN {placeholders}", id_params
+
     @staticmethod
     def _to_utc(date_str: Optional[str], time_part: str = "00:00:00") -> Optional[str]:
         if not date_str:
@@ -64,22 +130,165 @@ class DBService:
             logger.error(f"Ошибка парсинга даты: {date_str} → {e}")
             return None
 
+    @staticmethod
+    def _executor(kind: str) -> ThreadPoolExecutor:
+        """Общий для процесса пул потоков загрузки: 'fetch' (FETCH_WORKERS) или 'partition' (PARTITION_WORKERS).
+
+        Запросы одновременных анализов ждут в общей очереди, а не в пуле соединений itrade (где ожидание
+        ограничено ITRADE_POOL_TIMEOUT), поэтому загрузка занимает не больше FETCH_WORKERS + PARTITION_WORKERS
+        соединений. Задачи 'fetch' ждут задачи 'partition', но не наоборот - пулы не блокируют друг друга.
+        """
+        with DBService._executors_lock:
+            if DBService._executors_pid != os.getpid():
+                # Потоки пулов родителя после fork не существуют
+                DBService._executors = {}
+                DBService._executors_pid = os.getpid()
+            executor = DBService._executors.get(kind)
+            if executor is None:
+                workers = DBService.FETCH_WORKERS if kind == 'fetch' else DBService.PARTITION_WORKERS
+                executor = DBService._executors[kind] = ThreadPoolExecutor(max_workers=workers,
+                                                                          thread_name_prefix=f'itrade-{kind}')
+            return executor
+
+    @staticmethod
+    def _to_utc_end(date_str: Optional[str]) -> Optional[str]:
+        """Исключающая верхняя граница периода в UTC: для даты без времени - начало следующего дня"""
+        if not date_str or " " in date_str:
+            return DBService._to_utc(date_str)
+        try:
+            next_day = datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=1)
+        except Exception as e:
+            logger.error(f"Ошибка парсинга даты: {date_str} → {e}")
+            return None
+        return DBService._to_utc(next_day.strftime("%Y-%m-%d"), "00:00:00")
+
+    @staticmethod
+    def _server_now() -> str:
+        """NOW() сервера itrade со сдвигом +3 часа, как колонка lead_container_now"""
+        return (timezone.now() + timedelta(hours=3)).strftime("%Y-%m-%d %H:%M:%S")
+
+    @staticmethod
+    def _row_type(columns: List[str]) -> type:
+        """Класс компактной строки (namedtuple + CompactRow) для набора колонок запроса"""
+        key = tuple(columns)
+        row_type = DBService._row_types.get(key)
+        if row_type is None:
+            # rename=True - повторяющиеся колонки (как в get_kpi_plans_data) получают позиционные имена
+            base = namedtuple('RowBase', key, rename=True)
+            row_type = type('Row', (CompactRow, base), {'__slots__': ()})
+            DBService._row_types[key] = row_type
+        return row_type
+
     @staticmethod
     @retry_on_db_error
-    def _execute_query(query: str, params: List[Any]) -> List[Dict]:
+    def _execute_query(query: str, params: List[Any], compact: bool = False, name: str = 'query') -> List[Any]:
+        """Выполняет запрос к itrade на соединении из пула реплики, выбранной для запроса name
+        (см. ItradeReplicaSet, ItradeConnectionPool).
+
+        compact=False - строки возвращаются словарями, compact=True - компактными
+        namedtuple-строками с общим на весь результат описанием колонок.
+
+        Результат читается небуферизованным курсором, чтобы раздельно замерить время сервера
+        (execute до первой строки), чтение строк и их построение (см. QueryStats, name - имя запроса).
+        """
         try:
             start = time.time()
-            with connections['itrade'].cursor() as cursor:
+            with itrade_replicas.connection(name) as (replica, connection):
+                bytes_before = QueryStats.bytes_sent(connection)
+                cursor = connection.cursor(SSCursor)
+                try:
+                    execute_start = time.time()
+                    cursor.execute(query, params)
+                    fetch_start = time.time()
+                    columns = [col[0] for col in cursor.description]
+                    rows = cursor.fetchall()
+                finally:
+                    cursor.close()
+                build_start = time.time()
+                if compact:
+                    results = list(map(DBService._row_type(columns)._make, rows))
+                else:
+                    results = [dict(zip(columns, row)) for row in rows]
+                end = time.time()
+
+                bytes_after = QueryStats.bytes_sent(connection)
+                bytes_count = bytes_after - bytes_before if None not in (bytes_before, bytes_after) else None
+                explain = QueryStats.explain(connection, query, params) if QueryStats.need_explain(end - start) else None
+
+            QueryStats.record(name, fetch_start - execute_start, build_start - fetch_start, end - build_start,
+                              len(results), bytes_count, explain, replica=replica)
+            return results
+        except Exception as e:
+            logger.error(f"Ошибка выполнения запроса '{name}': {e}")
+            raise
+
+    @staticmethod
+    def _stream_query(query: str, params: List[Any], chunk_size: Optional[int] = None,
+                      compact: bool = False, name: str = 'query') -> Iterator[Any]:
+        """Отдает строки запроса по мере чтения через серверный курсор (SSCursor).
+
+        Результат не буферизуется целиком ни на стороне драйвера, ни в Python - строки
+        читаются порциями по chunk_size. Соединение из пула занято на все время чтения;
+        если чтение не дошло до конца, соединение с незавершенным SSCursor закрывается, а не
+        возвращается в пул. Замеры (QueryStats) учитывают только чтение и построение строк,
+        без времени обработки строк потребителем.
+        """
+        chunk_size = chunk_size or DBService.STREAM_CHUNK_SIZE
+        start = time.time()
+        rows_count = 0
+        fetch_seconds = build_seconds = 0.0
+        replica, connection = itrade_replicas.acquire(name)
+        completed = False
+        error = None
+        try:
+            bytes_before = QueryStats.bytes_sent(connection)
+            cursor = connection.cursor(SSCursor)
+            try:
                 cursor.execute(query, params)
+                server_seconds = time.time() - start
                 columns = [col[0] for col in cursor.description]
-                results = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
+                make_row = DBService._row_type(columns)._make if compact else None
+                while True:
+                    fetch_start = time.time()
+                    rows = cursor.fetchmany(chunk_size)
+                    build_start = time.time()
+                    fetch_seconds += build_start - fetch_start
+                    if not rows:
+                        break
+                    rows_count += len(rows)
+                    if make_row is not None:
+                        chunk = list(map(make_row, rows))
+                    else:
+                        chunk = [dict(zip(columns, row)) for row in rows]
+                    build_seconds += time.time() - build_start
+                    yield from chunk
+                completed = True
+            finally:
+                if completed:
+                    cursor.close()
+            bytes_after = QueryStats.bytes_sent(connection)
+            bytes_count = bytes_after - bytes_before if None not in (bytes_before, bytes_after) else None
             duration = time.time() - start
-            logger.info(f">>> Запрос выполнен за {duration:.2f}с, строк: {len(results)}")
-            return results
+            explain = QueryStats.explain(connection, query, params) if QueryStats.need_explain(duration) else None
         except Exception as e:
-            logger.error(f"Ошибка выполнения запроса: {e}")
+            error = e
+            logger.error(f"Ошибка потокового чтения запроса '{name}': {e}")
             raise
+        finally:
+            itrade_replicas.release(replica, connection, discard=not completed, error=error)
+
+        logger.info(f">>> Потоковый запрос прочитан за {duration:.2f}с, строк: {rows_count}")
+        QueryStats.record(name, server_seconds, fetch_seconds, build_seconds, rows_count, bytes_count, explain,
+                          stream=True, replica=replica)
+
+    @staticmethod
+    def _date_range_days(filters: Dict) -> int:
+        try:
+            date_from = datetime.strptime(str(filters.get('date_from'))[:10], "%Y-%m-%d")
+            date_to = datetime.strptime(str(filters.get('date_to'))[:10], "%Y-%m-%d")
+        except (TypeError, ValueError):
+            return 0
+        return (date_to - date_from).days + 1
 
     @staticmethod
     def _process_in_batches(data: List[Dict], batch_size: int, process_func: callable) -> List[Dict]:
@@ -106,7 +315,213 @@ class DBService:
         return results
 
     @staticmethod
-    def get_kpi_plans_data(filters: Optional[Dict] = None) -> List[Dict]:
+    def _run_timed(func: callable, *args) -> Tuple[Any, float]:
+        """Выполняет запрос в рабочем потоке; соединение itrade каждый запрос берет из пула"""
+        start = time.time()
+        return func(*args), time.time() - start
+
+    @staticmethod
+    def _query_rows(name: str, filters: Dict, stream: bool = False, compact: bool = False) -> Union[List[Any], Iterator[Any]]:
+        if name == 'calls':
+            return DBService.get_calls(filters, stream=stream, compact=compact)
+        if name == 'call_groups':
+            return DBService.get_call_groups(filters, stream=stream, compact=compact)
+        if name == 'leads':
+            return DBService.get_leads(filters, stream=stream, compact=compact)
+        if name == 'leads_container':
+            return DBService.get_leads_container(filters, compact=compact)
+        if name == 'lead_sets':
+            return DBService.get_lead_sets(filters, compact=compact)
+        raise ValueError(f"Неизвестный запрос: {name}")
+
+    @staticmethod
+    def _partition_days(filters: Dict) -> List[date]:
+        """Дни периода фильтра; пусто, если период задан со временем или не задан"""
+        try:
+            date_from = datetime.strptime(str(filters.get('date_from')), "%Y-%m-%d").date()
+            date_to = datetime.strptime(str(filters.get('date_to')), "%Y-%m-%d").date()
+        except (TypeError, ValueError):
+            return []
+        return [date_from + timedelta(days=i) for i in range((date_to - date_from).days + 1)]
+
+    @staticmethod
+    def _day_rows(partition: Dict[str, Any], compact: bool) -> Iterator[Any]:
+        """Строки распакованной партиции из кэша"""
+        columns = partition['columns']
+        rows = partition['rows']
+        if 'lead_container_now' in columns:
+            # Текущее время сервера в закэшированных строках устарело - подставляем актуальное
+            index = columns.index('lead_container_now')
+            now = (DBService._server_now(),)
+            rows = (row[:index] + now + row[index + 1:] for row in rows)
+        if compact:
+            return map(DBService._row_type(columns)._make, rows)
+        return (dict(zip(columns, row)) for row in rows)
+
+    @staticmethod
+    def _closed_partitions(name: str, filters: Dict, days: List[date], compact: bool) -> Iterator[Any]:
+        """Строки закрытых дней по порядку: из кэша, недостающие дни - запросами по дню.
+
+        Партиции из кэша распаковываются по одной при чтении. Запросы недостающих дней выполняются
+        впереди чтения, но не больше PARTITION_WORKERS одновременно; строки дня отдаются, как только
+        готов его запрос, и после этого не хранятся. Поэтому в памяти не больше PARTITION_WORKERS + 1
+        дней (и сжатые записи кэша), какой бы широкий период ни запрашивался.
+        """
+        start = time.time()
+        cached = PartitionCache.get_many(name, days, filters)
+        missing = deque(day for day in days if day not in cached)
+        loaded_count = len(missing)
+        executor = DBService._executor('partition')
+        futures: Dict[date, Future] = {}
+
+        def query(day: date) -> Future:
+            return QueryStats.submit(executor, DBService._run_timed, DBService._query_rows, name,
+                                     dict(filters, date_from=day.isoformat(), date_to=day.isoformat()), False, True)
+
+        try:
+            for day in days:
+                while missing and len(futures) < DBService.PARTITION_WORKERS:
+                    next_day = missing.popleft()
+                    futures[next_day] = query(next_day)
+
+                packed = cached.pop(day, None)
+                partition = PartitionCache.load(name, day, packed) if packed is not None else None
+                if partition is not None:
+                    yield from DBService._day_rows(partition, compact)
+                    continue
+
+                # Поврежденная запись кэша загружается заново, как недостающий день
+                future = futures.pop(day, None)
+                if future is None:
+                    loaded_count += 1
+                    future = query(day)
+                rows, _ = future.result()
+                PartitionCache.set(name, day, filters, rows)
+                yield from rows if compact else (row._asdict() for row in rows)
+        finally:
+            for future in futures.values():
+                future.cancel()
+
+        logger.info(f">>> Партиции '{name}': {len(days)} дней, из кэша {len(days) - loaded_count}, "
+                    f"загружено {loaded_count} за {time.time() - start:.2f}с")
+
+    @staticmethod
+    def fetch_partitioned(name: str, filters: Dict, stream: bool = False,
+                          compact: bool = False) -> Union[List[Any], Iterator[Any]]:
+        """Строки запроса name ('calls', 'call_groups', 'leads', 'leads_container', 'lead_sets') с разбиением периода по дням.
+
+        Закрытые дни берутся из PartitionCache, недостающие загружаются параллельно по дню и кэшируются,
+        открытый хвост периода загружается одним запросом. Порядок строк - по дням, как в исходном запросе.
+        Без кэша или для периода со временем выполняется обычный запрос за весь период.
+        """
+        days = DBService._partition_days(filters)
+        closed = [day for day in days if PartitionCache.is_closed(day)]
+        if not PartitionCache.ENABLED or not closed:
+            return DBService._query_rows(name, filters, stream=stream, compact=compact)
+
+        open_days = days[len(closed):]
+
+        def iterate():
+            yield from DBService._closed_partitions(name, filters, closed, compact)
+            if open_days:
+                open_filters = dict(filters, date_from=open_days[0].isoformat())
+                yield from DBService._query_rows(name, open_filters, stream=stream, compact=compact)
+
+        return iterate() if stream else list(iterate())
+
+    @staticmethod
+    def fetch_analysis_data(filters: Dict, stream: Optional[bool] = None, compact: bool = True,
+                            progress: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+        """Параллельно загружает все данные для KPI анализа.
+
+        Каждый запрос выполняется в потоке общего пула загрузки (см. _executor) на своем соединении itrade.
+        При ошибке любого запроса остальные не дожидаются - исключение пробрасывается сразу.
+        Возвращает словарь с ключами kpi_plans, offers, leads, calls, leads_container и timings.
+
+        В режиме stream звонки и лиды не загружаются заранее, а возвращаются итераторами
+        поверх серверного курсора. По умолчанию режим включается для периодов
+        от STREAM_MIN_DAYS дней.
+
+        compact=True - звонки, лиды и контейнеры лидов возвращаются компактными строками
+        (см. CompactRow), которые движок анализа принимает наравне со словарями.
+
+        progress(stage, **details) вызывается по завершении каждого запроса (stage='fetch').
+
+        Звонки, лиды и контейнеры лидов загружаются по дням через fetch_partitioned: закрытые дни
+        периода берутся из кэша партиций, из itrade запрашиваются только недостающие.
+        При CALLS_PUSHDOWN звонки приходят уже сгруппированными (get_call_groups), при LEADS_MERGED
+        (и без stream) лиды и контейнеры лидов загружаются одним запросом (get_lead_sets) и затем разделяются.
+        kpi_plans - готовый общий KpiList (см. KpiPlanCache), а не строки таблицы планов.
+        """
+        from .kpi_plan_cache import KpiPlanCache
+
+        range_days = DBService._date_range_days(filters)
+        calls_query = 'call_groups' if DBService.CALLS_PUSHDOWN else 'calls'
+        if stream is None:
+            stream = range_days >= DBService.STREAM_MIN_DAYS
+
+        tasks = {
+            'kpi_plans': (KpiPlanCache.kpi_list, ()),
+            'offers': (DBService.get_offers, (filters,)),
+        }
+
+        start = time.time()
+        result = {}
+        if range_days <= 0:
+            # Пустой период (например, все дни взяты из таблиц фактов) - строки не запрашиваются
+            result.update({'leads': [], 'calls': [], 'leads_container': []})
+        elif stream:
+            # Объединенный запрос (LEADS_MERGED) пришлось бы читать целиком - лиды читаются потоково отдельно
+            result['calls'] = DBService.fetch_partitioned(calls_query, filters, stream=True, compact=compact)
+            tasks['leads_container'] = (DBService.fetch_partitioned, ('leads_container', filters, False, compact))
+            result['leads'] = DBService.fetch_partitioned('leads', filters, stream=True, compact=compact)
+        else:
+            tasks['calls'] = (DBService.fetch_partitioned, (calls_query, filters, False, compact))
+            if DBService.LEADS_MERGED:
+                tasks['lead_sets'] = (DBService.fetch_partitioned, ('lead_sets', filters, False, compact))
+            else:
+                tasks['leads_container'] = (DBService.fetch_partitioned, ('leads_container', filters, False, compact))
+                tasks['leads'] = (DBService.fetch_partitioned, ('leads', filters, False, compact))
+
+        timings = {}
+        executor = DBService._executor('fetch')
+        futures = {
+            QueryStats.submit(executor, DBService._run_timed, func, *args): name
+            for name, (func, args) in tasks.items()
+        }
+        try:
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    name = futures[future]
+                    try:
+                        data, duration = future.result()
+                    except Exception as e:
+                        logger.error(f"Запрос '{name}' завершился ошибкой, загрузка прервана: {e}")
+                        raise
+                    result[name] = data
+                    timings[name] = round(duration, 3)
+                    if progress:
+                        progress('fetch', query=name, seconds=timings[name], done=len(timings), total=len(tasks))
+        finally:
+            # Незапущенные запросы этого анализа снимаются с общей очереди
+            for future in futures:
+                future.cancel()
+
+        if 'lead_sets' in result:
+            result['leads'], result['leads_container'] = DBService.split_lead_sets(result.pop('lead_sets'), compact)
+
+        timings['total'] = round(time.time() - start, 3)
+        result['timings'] = timings
+        result['stream'] = stream
+        logger.info(f">>> Данные для анализа загружены параллельно за {timings['total']:.2f}с "
+                    f"(stream={stream}): {timings}")
+        return result
+
+    @staticmethod
+    def get_kpi_plans_data(filters: Optional[Dict] = None, updated_since: Optional[Any] = None) -> List[Dict]:
+        """Таблица планов; updated_since - только строки, измененные не раньше (см. KpiPlanCache)"""
         query = """
           SELECT
               offer_plan.id as call_eff_kpi_id,
@@ -134,49 +549,30 @@ class DBService:
               LEFT(DATE_ADD(offer_plan.buyout_price_updated_at, INTERVAL 3 HOUR), 10) as call_eff_buyout_price_update_date
           FROM partners_tlofferplanneddataperiod AS offer_plan
           LEFT JOIN partners_affiliate aff ON aff.id = offer_plan.affiliate_id
-          ORDER BY period_date ASC
           """
-        return DBService._execute_query(query, [])
+        params = []
+        if updated_since is not None:
+            query += " WHERE offer_plan.updated_at >= %s"
+            params.append(updated_since)
+        query += " ORDER BY period_date ASC"
+        return DBService._execute_query(query, params, name='kpi_plans_changed' if params else 'kpi_plans')
 
     @staticmethod
     def get_offers(filters: Dict) -> List[Dict]:
-        offer_ids = filters.get('offer_id', [])
-        categories = filters.get('category', [])
-
-        query = """
-        SELECT
-            partners_offer.id as id,
-            partners_offer.name as name,
-            group_offer.name as category_name
-        FROM partners_offer
-        LEFT JOIN partners_assignedoffer assigned_offer ON assigned_offer.offer_id = partners_offer.id 
-        LEFT JOIN partners_groupoffer group_offer ON assigned_offer.group_id = group_offer.id 
-        WHERE 1=1
-        AND group_offer.name NOT IN ({})
-        """.format(",".join(["%s"] * len(DBService.EXCLUDED_CATEGORIES)))
-
-        params = DBService.EXCLUDED_CATEGORIES.copy()
-
-        if categories:
-            placeholders, cat_params = DBService._prepare_in_values(categories)
-            query += f" AND group_offer.name IN {placeholders}"
-            params.extend(cat_params)
-
-        if offer_ids:
-            placeholders, offer_params = DBService._prepare_in_values(offer_ids)
-            query += f" AND partners_offer.id IN {placeholders}"
-            params.extend(offer_params)
-
-        return DBService._execute_query(query, params)
+        """Офферы с категориями из справочника (см. ReferenceData) - без запроса к itrade"""
+        return ReferenceData.offers(filters.get('category', []), filters.get('offer_id', []))
 
     @staticmethod
-    def get_calls(filters: Dict) -> List[Dict]:
+    def _calls_from_where(filters: Dict) -> Optional[Tuple[str, List[Any]]]:
+        """FROM, JOIN и WHERE запроса звонков с параметрами; None, если не задан период"""
         date_from = DBService._to_utc(filters.get('date_from'), "00:00:00")
-        date_to = DBService._to_utc(filters.get('date_to'), "23:59:59")
+        # Граница исключающая (calldate <), поэтому для даты без времени - начало следующего дня:
+        # последняя секунда дня не теряется, и партиции по дням совпадают с запросом за весь период
+        date_to = DBService._to_utc_end(filters.get('date_to'))
 
         if not date_from or not date_to:
             logger.error("Не указаны даты начала или окончания периода")
-            return []
+            return None
 
         advertiser = [a.lower() for a in filters.get('advertiser', [])]
         offer_ids = filters.get('offer_id', [])
@@ -185,22 +581,6 @@ class DBService:
         aff_ids = filters.get('aff_id', [])
 
         query = """
-            SELECT
-                pae.id AS call_eff_id,
-                ccd.id AS call_eff_crm_id,
-                po.id AS call_eff_offer_id,
-                po.name AS offer_name,
-                pae.uniqueid AS call_eff_uniqueid,
-                LEFT(DATE_ADD(pae.calldate, INTERVAL 3 HOUR), 10) AS call_eff_calldate,
-                ccd.crm_lead_id AS call_eff_crm_lead_id,
-                uu.id AS call_eff_operator_id,
-                pae.billsec AS call_eff_billsec,
-                ccd.oktell_duration AS call_eff_billsec_exact,
-                ccd.oktell_anti_robot AS call_eff_robo_detected,
-                lv_op.username AS lv_username,
-                group_offer.name AS category_name,
-                pt.webmaster_id AS call_eff_affiliate_id
-
             FROM partners_atscallevent pae
             LEFT JOIN crm_call_calldata ccd
                 ON ccd.id = pae.assigned_call_data_id
@@ -267,13 +647,13 @@ class DBService:
             params.extend(offer_params)
 
         if advertiser and advertiser != ['']:
-            placeholders, adv_params = DBService._prepare_in_values(advertiser)
-            query += f" AND LOWER(subsystem.name) IN {placeholders}"
+            id_filter, adv_params = DBService._reference_filter('pt.subsystem_id', 'subsystems', advertiser)
+            query += id_filter
             params.extend(adv_params)
 
         if lv_ops and lv_ops != ['']:
-            placeholders, lv_params = DBService._prepare_in_values(lv_ops)
-            query += f" AND LOWER(lv_op.username) IN {placeholders}"
+            id_filter, lv_params = DBService._reference_filter('pae.lvoperator_id', 'lv_operators', lv_ops)
+            query += id_filter
             params.extend(lv_params)
 
         if aff_ids and aff_ids != ['']:
@@ -281,12 +661,96 @@ class DBService:
             query += f" AND pt.webmaster_id IN {placeholders}"
             params.extend(aff_params)
 
+        # Дозагрузка (IncrementalAnalysis): только звонки новее отметки
+        if filters.get('after_call_id') is not None:
+            query += " AND pae.id > %s"
+            params.append(filters['after_call_id'])
+
+        return query, params
+
+    @staticmethod
+    def get_calls(filters: Dict, stream: bool = False, compact: bool = False) -> Union[List[Any], Iterator[Any]]:
+        from_where = DBService._calls_from_where(filters)
+        if from_where is None:
+            return []
+        from_where_query, params = from_where
+
+        query = """
+            SELECT
+                pae.id AS call_eff_id,
+                ccd.id AS call_eff_crm_id,
+                po.id AS call_eff_offer_id,
+                po.name AS offer_name,
+                pae.uniqueid AS call_eff_uniqueid,
+                LEFT(DATE_ADD(pae.calldate, INTERVAL 3 HOUR), 10) AS call_eff_calldate,
+                ccd.crm_lead_id AS call_eff_crm_lead_id,
+                uu.id AS call_eff_operator_id,
+                pae.billsec AS call_eff_billsec,
+                ccd.oktell_duration AS call_eff_billsec_exact,
+                ccd.oktell_anti_robot AS call_eff_robo_detected,
+                lv_op.username AS lv_username,
+                group_offer.name AS category_name,
+                pt.webmaster_id AS call_eff_affiliate_id,
+                subsystem.name AS subsystem_name
+        """ + from_where_query
+
         query += " ORDER BY pae.calldate ASC"
 
-        return DBService._execute_query(query, params)
+        if stream:
+            return DBService._stream_query(query, params, compact=compact, name='calls')
+        return DBService._execute_query(query, params, compact=compact, name='calls')
 
     @staticmethod
-    def get_leads(filters: Dict) -> List[Dict]:
+    def get_call_groups(filters: Dict, stream: bool = False,
+                        compact: bool = False) -> Union[List[Any], Iterator[Any]]:
+        """Звонки, сгруппированные в MySQL: одна строка на группу движка (дата, оператор, CRM лид)
+        внутри разреза анализа (категория, оффер, вебмастер, оператор LV).
+
+        billsec группы - максимум billsec с поправкой на oktell_duration (как в Call), поэтому группа
+        эффективна в движке тогда же, когда эффективен хотя бы один ее звонок. Строки упорядочены по
+        первому звонку группы - атрибуты группы в движке берутся из него, как и для отдельных звонков.
+        call_eff_calls_count - число исходных строк звонков в группе.
+        """
+        from_where = DBService._calls_from_where(filters)
+        if from_where is None:
+            return []
+        from_where_query, params = from_where
+
+        query = """
+            SELECT
+                MIN(pae.id) AS call_eff_id,
+                MIN(ccd.id) AS call_eff_crm_id,
+                po.id AS call_eff_offer_id,
+                MAX(po.name) AS offer_name,
+                CONCAT('group-', MIN(pae.id)) AS call_eff_uniqueid,
+                LEFT(DATE_ADD(pae.calldate, INTERVAL 3 HOUR), 10) AS call_eff_calldate,
+                ccd.crm_lead_id AS call_eff_crm_lead_id,
+                uu.id AS call_eff_operator_id,
+                MAX(CASE
+                    WHEN ccd.oktell_duration IS NULL OR ccd.oktell_duration < 0 THEN pae.billsec
+                    ELSE LEAST(pae.billsec, ccd.oktell_duration)
+                END) AS call_eff_billsec,
+                NULL AS call_eff_billsec_exact,
+                MAX(ccd.oktell_anti_robot) AS call_eff_robo_detected,
+                lv_op.username AS lv_username,
+                group_offer.name AS category_name,
+                pt.webmaster_id AS call_eff_affiliate_id,
+                MAX(subsystem.name) AS subsystem_name,
+                COUNT(*) AS call_eff_calls_count
+        """ + from_where_query
+
+        query += """
+            GROUP BY call_eff_calldate, uu.id, ccd.crm_lead_id,
+                     group_offer.name, po.id, pt.webmaster_id, lv_op.username
+            ORDER BY MIN(pae.calldate) ASC
+        """
+
+        if stream:
+            return DBService._stream_query(query, params, compact=compact, name='call_groups')
+        return DBService._execute_query(query, params, compact=compact, name='call_groups')
+
+    @staticmethod
+    def get_leads(filters: Dict, stream: bool = False, compact: bool = False) -> Union[List[Any], Iterator[Any]]:
         date_from = DBService._to_utc(filters.get('date_from'), "00:00:00")
         date_to = DBService._to_utc(filters.get('date_to'), "23:59:59")
 
@@ -312,7 +776,8 @@ class DBService:
             offer.id as offer_id,
             offer.name as offer_name,
             group_offer.name as category_name,
-            tl_lead.webmaster_id as aff_id
+            tl_lead.webmaster_id as aff_id,
+            subsystem.name as subsystem_name
         FROM partners_lvlead lv
         INNER JOIN partners_tllead tl_lead ON lv.tl_id = tl_lead.external_id
         INNER JOIN partners_offer offer ON tl_lead.offer_id = offer.id
@@ -343,13 +808,13 @@ class DBService:
             params.extend(offer_params)
 
         if advertiser:
-            placeholders, adv_params = DBService._prepare_in_values(advertiser)
-            query += f" AND LOWER(subsystem.name) IN {placeholders}"
+            id_filter, adv_params = DBService._reference_filter('tl_lead.subsystem_id', 'subsystems', advertiser)
+            query += id_filter
             params.extend(adv_params)
 
         if lv_ops:
-            placeholders, lv_params = DBService._prepare_in_values(lv_ops)
-            query += f" AND LOWER(lv_op.username) IN {placeholders}"
+            id_filter, lv_params = DBService._reference_filter('lv.operator_id', 'lv_operators', lv_ops)
+            query += id_filter
             params.extend(lv_params)
 
         if aff_ids:
@@ -357,12 +822,19 @@ class DBService:
             query += f" AND tl_lead.webmaster_id IN {placeholders}"
             params.extend(aff_params)
 
+        # Дозагрузка (IncrementalAnalysis): только лиды с аппрувом не раньше отметки (местное время)
+        if filters.get('approved_since'):
+            query += " AND lv.approved_at >= DATE_SUB(%s, INTERVAL 3 HOUR)"
+            params.append(filters['approved_since'])
+
         query += " ORDER BY lv.approved_at ASC"
 
-        return DBService._execute_query(query, params)
+        if stream:
+            return DBService._stream_query(query, params, compact=compact, name='leads')
+        return DBService._execute_query(query, params, compact=compact, name='leads')
 
     @staticmethod
-    def get_leads_container(filters: Dict) -> List[Dict]:
+    def get_leads_container(filters: Dict, compact: bool = False) -> List[Any]:
         date_from = DBService._to_utc(filters.get('date_from'), "00:00:00")
         date_to = DBService._to_utc(filters.get('date_to'), "23:59:59")
 
@@ -393,7 +865,8 @@ class DBService:
             offer.name as offer_name,
             pt.webmaster_id as aff_id,
             lv_op.username as lv_username,
-            group_offer.name as category_name
+            group_offer.name as category_name,
+            subsystem.name as subsystem_name
         FROM partners_lvlead lv
         INNER JOIN partners_tllead pt ON lv.tl_id = pt.external_id
         INNER JOIN partners_offer offer ON pt.offer_id = offer.id
@@ -421,8 +894,8 @@ class DBService:
             params.extend(offer_params)
 
         if advertiser:
-            placeholders, adv_params = DBService._prepare_in_values(advertiser)
-            query += f" AND LOWER(subsystem.name) IN {placeholders}"
+            id_filter, adv_params = DBService._reference_filter('pt.subsystem_id', 'subsystems', advertiser)
+            query += id_filter
             params.extend(adv_params)
 
         if aff_ids:
@@ -431,26 +904,247 @@ class DBService:
             params.extend(aff_params)
 
         if lv_ops:
-            placeholders, lv_params = DBService._prepare_in_values(lv_ops)
-            query += f" AND LOWER(lv_op.username) IN {placeholders}"
+            id_filter, lv_params = DBService._reference_filter('lv.operator_id', 'lv_operators', lv_ops)
+            query += id_filter
             params.extend(lv_params)
 
+        # Дозагрузка (IncrementalAnalysis): лиды, созданные или сменившие статус не раньше отметки
+        if filters.get('changed_since'):
+            changed_filter, changed_params = DBService._changed_since_filter(filters['changed_since'])
+            query += changed_filter
+            params.extend(changed_params)
+
         logger.info(f"Запрос контейнеров лидов за период: {date_from} - {date_to}")
-        return DBService._execute_query(query, params)
+        return DBService._execute_query(query, params, compact=compact, name='leads_container')
+
+    @staticmethod
+    def _changed_since_filter(changed_since: str) -> Tuple[str, List[Any]]:
+        """Условие на лиды, созданные или сменившие статус не раньше changed_since (время +3 часа)"""
+        return """
+            AND (lv.created_at >= DATE_SUB(%s, INTERVAL 3 HOUR)
+                 OR lv.approved_at >= DATE_SUB(%s, INTERVAL 3 HOUR)
+                 OR lv.canceled_at >= DATE_SUB(%s, INTERVAL 3 HOUR)
+                 OR lv.buyout_at >= DATE_SUB(%s, INTERVAL 3 HOUR))
+            """, [changed_since] * 4
+
+    @staticmethod
+    def get_changed_lead_days(changed_since: str) -> List[Dict[str, Any]]:
+        """Дни лидов, созданных или сменивших статус не раньше changed_since (для пересборки фактов KPI).
+
+        Строка - день создания (created_day, контейнер лидов), день подтверждения (approved_day, лиды)
+        и последнее изменение лидов этой пары дней (changed_at); дни и время со сдвигом +3 часа.
+        """
+        query = """
+        SELECT
+            DATE(DATE_ADD(lv.created_at, INTERVAL 3 HOUR)) as created_day,
+            DATE(DATE_ADD(lv.approved_at, INTERVAL 3 HOUR)) as approved_day,
+            LEFT(DATE_ADD(MAX(GREATEST(lv.created_at,
+                                       COALESCE(lv.approved_at, lv.created_at),
+                                       COALESCE(lv.canceled_at, lv.created_at),
+                                       COALESCE(lv.buyout_at, lv.created_at))), INTERVAL 3 HOUR), 19) as changed_at
+        FROM partners_lvlead lv
+        WHERE 1 = 1
+        """
+        changed_filter, params = DBService._changed_since_filter(changed_since)
+        query += changed_filter + " GROUP BY created_day, approved_day"
+
+        logger.info(f"Запрос дней измененных лидов с {changed_since}")
+        return DBService._execute_query(query, params, name='changed_lead_days')
+
+    @staticmethod
+    def get_lead_sets(filters: Dict, compact: bool = False) -> List[Any]:
+        """Лиды (по approved_at) и контейнеры лидов (по created_at) одним запросом к partners_lvlead.
+
+        Строка содержит колонки обоих запросов и признаки принадлежности lead_set_lead и
+        lead_set_container, вычисленные по тем же условиям, что в get_leads и get_leads_container.
+        Разделение на два набора - split_lead_sets.
+
+        Запрос - UNION ALL двух веток с одним диапазонным условием в каждой (approved_at, затем
+        created_at без уже выбранных по approved_at строк): условие OR по двум колонкам не дает
+        MySQL использовать индекс ни по одной из них.
+        """
+        date_from = DBService._to_utc(filters.get('date_from'), "00:00:00")
+        date_to = DBService._to_utc(filters.get('date_to'), "23:59:59")
+
+        if not date_from or not date_to:
+            logger.error("Не указаны даты начала или окончания периода")
+            return []
+
+        advertiser = [a.lower() for a in filters.get('advertiser', [])]
+        offer_ids = filters.get('offer_id', [])
+        categories = filters.get('category', [])
+        lv_ops = [op.lower() for op in filters.get('lv_op', [])]
+        aff_ids = filters.get('aff_id', [])
+
+        # get_leads_container не соединяется с partners_userbasedonlvoperator - контейнером считается
+        # только строка первой привязки оператора, чтобы несколько привязок не размножали контейнеры
+        select = """
+        SELECT
+            (lv.approved_at BETWEEN %s AND %s AND lv_op.username IS NOT NULL) as lead_set_lead,
+            (lv.created_at BETWEEN %s AND %s AND (pu.id IS NULL OR pu.id = pu_first.id)) as lead_set_container,
+            crm_leads_crmlead.id as call_eff_crm_lead_id,
+            LEFT(DATE_ADD(lv.approved_at, INTERVAL 3 HOUR), 19) AS call_eff_approved_at,
+            LEFT(DATE_ADD(lv.canceled_at, INTERVAL 3 HOUR), 19) AS call_eff_canceled_at,
+            uu.id as call_eff_operator_id,
+            lv_status.status_verbose as call_eff_status_verbose,
+            lv_status.status_group as call_eff_status_group,
+            crm_leads_crmlead.id as lead_container_crm_lead_id,
+            LEFT(DATE_ADD(lv.created_at, INTERVAL 3 HOUR), 19) as lead_container_created_at,
+            LEFT(DATE_ADD(lv.approved_at, INTERVAL 3 HOUR), 19) as lead_container_approved_at,
+            LEFT(DATE_ADD(lv.canceled_at, INTERVAL 3 HOUR), 19) as lead_container_canceled_at,
+            LEFT(DATE_ADD(lv.buyout_at, INTERVAL 3 HOUR), 19) as lead_container_buyout_at,
+            lv_status.status_verbose as lead_container_status_verbose,
+            lv_status.status_group as lead_container_status_group,
+            tl_lead.is_trash as lead_container_is_trash,
+            LEFT(DATE_ADD(lv.created_at, INTERVAL 27 HOUR), 19) as lead_container_lead_ttl_till,
+            LEFT(DATE_ADD(NOW(), INTERVAL 3 HOUR), 19) as lead_container_now,
+            lv_op.username as lv_username,
+            offer.id as offer_id,
+            offer.name as offer_name,
+            group_offer.name as category_name,
+            tl_lead.webmaster_id as aff_id,
+            subsystem.name as subsystem_name
+        FROM partners_lvlead lv
+        INNER JOIN partners_tllead tl_lead ON lv.tl_id = tl_lead.external_id
+        INNER JOIN partners_offer offer ON tl_lead.offer_id = offer.id
+        INNER JOIN partners_assignedoffer assigned_offer ON assigned_offer.offer_id = offer.id
+        INNER JOIN partners_groupoffer group_offer ON assigned_offer.group_id = group_offer.id
+        LEFT JOIN crm_leads_crmlead ON crm_leads_crmlead.lvlead_id = lv.id
+        LEFT JOIN partners_lvoperator lv_op ON lv_op.id = lv.operator_id
+        LEFT JOIN partners_userbasedonlvoperator pu ON pu.operator_id = lv.operator_id
+        LEFT JOIN (
+            SELECT operator_id, MIN(id) AS id FROM partners_userbasedonlvoperator GROUP BY operator_id
+        ) pu_first ON pu_first.operator_id = lv.operator_id
+        LEFT JOIN users_user uu ON uu.id = pu.user_id
+        LEFT JOIN partners_lvleadstatuses lv_status ON lv.leadvertex_status_id = lv_status.id
+        LEFT JOIN partners_subsystem subsystem ON tl_lead.subsystem_id = subsystem.id
+        """
+        select_params = [date_from, date_to] * 2
+
+        where = """
+        AND group_offer.name NOT IN ({})
+        AND offer.id IS NOT NULL
+        """.format(",".join(["%s"] * len(DBService.EXCLUDED_CATEGORIES)))
+        params = list(DBService.EXCLUDED_CATEGORIES)
+
+        if categories:
+            placeholders, cat_params = DBService._prepare_in_values(categories)
+            where += f" AND group_offer.name IN {placeholders}"
+            params.extend(cat_params)
+
+        if offer_ids:
+            placeholders, offer_params = DBService._prepare_in_values(offer_ids)
+            where += f" AND offer.id IN {placeholders}"
+            params.extend(offer_params)
+
+        if advertiser:
+            id_filter, adv_params = DBService._reference_filter('tl_lead.subsystem_id', 'subsystems', advertiser)
+            where += id_filter
+            params.extend(adv_params)
+
+        if lv_ops:
+            id_filter, lv_params = DBService._reference_filter('lv.operator_id', 'lv_operators', lv_ops)
+            where += id_filter
+            params.extend(lv_params)
+
+        if aff_ids:
+            placeholders, aff_params = DBService._prepare_in_values(aff_ids)
+            where += f" AND tl_lead.webmaster_id IN {placeholders}"
+            params.extend(aff_params)
+
+        query = f"""
+        ({select} WHERE lv.approved_at BETWEEN %s AND %s {where})
+        UNION ALL
+        ({select} WHERE lv.created_at BETWEEN %s AND %s
+            AND (lv.approved_at IS NULL OR lv.approved_at NOT BETWEEN %s AND %s) {where})
+        """
+        params = (select_params + [date_from, date_to] + params
+                  + select_params + [date_from, date_to] * 2 + params)
+
+        # Порядок лидов - как в get_leads (approved_at), для контейнеров порядок не важен
+        query += " ORDER BY call_eff_approved_at ASC"
+
+        logger.info(f"Запрос лидов и контейнеров лидов за период: {date_from} - {date_to}")
+        return DBService._execute_query(query, params, compact=compact, name='lead_sets')
+
+    @staticmethod
+    def split_lead_sets(rows: Iterable[Any], compact: bool = False) -> Tuple[List[Any], List[Any]]:
+        """Строки get_lead_sets -> (лиды, контейнеры лидов) с колонками get_leads и get_leads_container"""
+        lead_columns = DBService.LEAD_SET_COLUMNS['leads']
+        container_columns = DBService.LEAD_SET_COLUMNS['leads_container']
+        make_lead = DBService._row_type(list(lead_columns))._make if compact else None
+        make_container = DBService._row_type(list(container_columns))._make if compact else None
+
+        leads, container = [], []
+        for row in rows:
+            if row.get('lead_set_lead'):
+                values = [row.get(column) for column in lead_columns]
+                leads.append(make_lead(values) if compact else dict(zip(lead_columns, values)))
+            if row.get('lead_set_container'):
+                values = [row.get(column) for column in container_columns]
+                container.append(make_container(values) if compact else dict(zip(container_columns, values)))
+        return leads, container
 
     @staticmethod
     def is_fake_approve(lead_dict: Dict) -> str:
-        try:
-            required_fields = ['status_verbose', 'status_group', 'approved_at', 'canceled_at']
-            for field in required_fields:
-                if field not in lead_dict:
-                    return f"Отсутствует поле: {field}"
+        required_fields = ['status_verbose', 'status_group', 'approved_at', 'canceled_at']
+        for field in required_fields:
+            if field not in lead_dict:
+                return f"Отсутствует поле: {field}"
+        return DBService.fake_approve_reason(lead_dict['status_verbose'], lead_dict['status_group'],
+                                             lead_dict['approved_at'], lead_dict['canceled_at'])
 
-            status_verbose = lead_dict.get('status_verbose', '')
-            status_group = lead_dict.get('status_group', '')
-            approved_at = lead_dict.get('approved_at', '')
-            canceled_at = lead_dict.get('canceled_at', '')
+    @staticmethod
+    @lru_cache(maxsize=STATUS_VERDICT_CACHE_SIZE)
+    def _status_verdict(status_group: str, status_verbose: str) -> Tuple[str, str]:
+        """Части проверки аппрува, зависящие только от статуса: (причина до проверки дат, причина после)"""
+        if status_group not in DBService.GOOD_APPROVE_STATUS_GROUP:
+            return f"Группа статусов: {status_group}", ""
+        status_verbose_lower = status_verbose.lower()
+        if 'отправить позже' in status_verbose_lower:
+            return "Заказ в статусе 'Отправить позже'", ""
+        for bad_status in DBService.BAD_APPROVE_STATUS:
+            if bad_status in status_verbose_lower:
+                return "", f"Заказ в статусе: {status_verbose}"
+        return "", ""
+
+    @staticmethod
+    def _is_sortable_datetime(value: Any) -> bool:
+        """Строка 'YYYY-MM-DD HH:MM:SS': сравнение строк совпадает со сравнением дат"""
+        return (isinstance(value, str) and len(value) == 19 and value[4] == '-' and value[7] == '-'
+                and value[10] == ' ' and value[13] == ':' and value[16] == ':'
+                and (value[:4] + value[5:7] + value[8:10] + value[11:13] + value[14:16] + value[17:]).isdigit())
+
+    @staticmethod
+    def fake_approve_reason(status_verbose: str, status_group: str, approved_at: str, canceled_at: str) -> str:
+        """is_fake_approve по значениям полей, без промежуточного словаря.
+
+        Вердикт по статусу берется из таблицы _status_verdict, даты в формате 'YYYY-MM-DD HH:MM:SS'
+        сравниваются как строки. Остальные случаи (другие форматы и типы, ошибки) проверяются полностью
+        в _check_fake_approve с теми же причинами.
+        """
+        try:
+            before_dates, after_dates = DBService._status_verdict(status_group, status_verbose)
+        except Exception:
+            return DBService._check_fake_approve(status_verbose, status_group, approved_at, canceled_at)
+        if before_dates:
+            return before_dates
+        if approved_at and canceled_at:
+            if not (DBService._is_sortable_datetime(approved_at) and DBService._is_sortable_datetime(canceled_at)):
+                return DBService._check_fake_approve(status_verbose, status_group, approved_at, canceled_at)
+            if canceled_at >= approved_at:
+                return f"Заказ отменён ({canceled_at}) после подтверждения ({approved_at})"
+        if not approved_at:
+            return "Отсутствует дата подтверждения"
+        if not isinstance(approved_at, str):
+            return DBService._check_fake_approve(status_verbose, status_group, approved_at, canceled_at)
+        if approved_at.strip() == '':
+            return "Отсутствует дата подтверждения"
+        return after_dates
 
+    @staticmethod
+    def _check_fake_approve(status_verbose: str, status_group: str, approved_at: str, canceled_at: str) -> str:
+        try:
             if status_group not in DBService.GOOD_APPROVE_STATUS_GROUP:
                 return f"Группа статусов: {status_group}"
 
@@ -483,15 +1177,16 @@ class DBService:
 
     @staticmethod
     def is_fake_buyout(lead_dict: Dict) -> str:
-        try:
-            if 'status_group' not in lead_dict:
-                return "Отсутствует поле: status_group"
-            if 'buyout_at' not in lead_dict:
-                return "Отсутствует поле: buyout_at"
-
-            status_group = lead_dict.get('status_group', '')
-            buyout_at = lead_dict.get('buyout_at', '')
+        if 'status_group' not in lead_dict:
+            return "Отсутствует поле: status_group"
+        if 'buyout_at' not in lead_dict:
+            return "Отсутствует поле: buyout_at"
+        return DBService.fake_buyout_reason(lead_dict['status_group'], lead_dict['buyout_at'])
 
+    @staticmethod
+    def fake_buyout_reason(status_group: str, buyout_at: str) -> str:
+        """is_fake_buyout по значениям полей, без промежуточного словаря"""
+        try:
             if status_group != 'paid':
                 return "Лид не в группе статусов paid"
             if not buyout_at or buyout_at.strip() == '':
@@ -501,4 +1196,4 @@ class DBService:
 
         except Exception as e:
             logger.error(f"Ошибка в is_fake_buyout: {e}")
-            return f"Ошибка проверки: {str(e)}"
\ No newline at end of file
+            return f"Ошибка проверки: {str(e)}"
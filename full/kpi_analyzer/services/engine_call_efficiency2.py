@@ -1,6 +1,8 @@
 import logging
 from datetime import datetime, date
-from typing import Optional, Dict, List, Any
+from bisect import bisect_right
+from itertools import count
+from typing import Optional, Dict, List, Any, Union, Tuple, Iterable
 from decimal import Decimal
 from .statistics import safe_div
 from .db_service import DBService
@@ -12,6 +14,12 @@ _MAX_LOGS = 40
 
 
 class Kpi:
+    __slots__ = ('id', 'update_date', 'period_date', 'offer_id', 'affiliate_id', 'confirmation_price', 'buyout_price',
+                 'operator_efficiency', 'operator_efficiency_update_date', 'planned_approve',
+                 'planned_approve_update_date', 'planned_buyout', 'planned_buyout_update_date',
+                 'confirmation_price_update_date', 'buyout_price_update_date', 'key_aff_offer', 'is_personal_plan',
+                 'period_ordinal')
+
     def __init__(self, r: Dict):
         self.id = r.get('call_eff_kpi_id')
         self.update_date = r.get('call_eff_plan_update_date')
@@ -43,6 +51,17 @@ class Kpi:
                 self.period_date = self.period_date.strftime('%Y-%m-%d')
             else:
                 raise ValueError(f"Unexpected type for period_date: {type(self.period_date)}")
+        self.period_ordinal = self._date_ordinal(self.period_date)
+
+    @staticmethod
+    def _date_ordinal(period_date: Optional[str]) -> Optional[int]:
+        """Дата 'YYYY-MM-DD' -> порядковый номер дня (date.toordinal), None если дата не разбирается"""
+        if not period_date:
+            return None
+        try:
+            return date.fromisoformat(period_date).toordinal()
+        except (TypeError, ValueError):
+            return None
 
     @staticmethod
     def _make_key(affiliate_id: Optional[str], offer_id: str) -> str:
@@ -50,16 +69,14 @@ class Kpi:
             return str(offer_id)
         return f"{affiliate_id}-{offer_id}"
 
-    @staticmethod
-    def _make_key_cache(affiliate_id: Optional[str], offer_id: str, date: str) -> str:
-        affiliate_str = affiliate_id if affiliate_id is not None else "null"
-        return f"{affiliate_str}-{offer_id}-{date}"
-
     def print(self) -> str:
         return f"ID: {self.id} date: {self.period_date} offer_id: {self.offer_id} affiliate_id: {self.affiliate_id} op_eff: {self.operator_efficiency}"
 
 
 class Call:
+    __slots__ = ('id', 'crm_id', 'offer_id', 'uniqueid', 'billsec', 'billsec_exact', 'operator_id', 'crm_lead_id',
+                 'calldate_str', 'affiliate_id', 'calldate_date_str')
+
     def __init__(self, r: Dict):
         self.id = r.get('call_eff_id')
         self.crm_id = r.get('call_eff_crm_id')
@@ -92,7 +109,10 @@ class Call:
 
 
 class Lead:
-    def __init__(self, r: Dict):
+    __slots__ = ('crm_lead_id', 'approved_at', 'canceled_at', 'status_verbose', 'status_group', 'operator_id',
+                 'is_salary_pay', 'is_salary_not_pay_reason', 'offer_id', 'classified')
+
+    def __init__(self, r: Dict, offer_id: Optional[int] = None):
         self.crm_lead_id = r.get('call_eff_crm_lead_id')
         self.approved_at = r.get('call_eff_approved_at') or ''
         self.canceled_at = r.get('call_eff_canceled_at') or ''
@@ -101,7 +121,8 @@ class Lead:
         self.operator_id = r.get('call_eff_operator_id')
         self.is_salary_pay = True
         self.is_salary_not_pay_reason = ""
-        self.offer_id =r.get('offer_id')
+        self.classified = False
+        self.offer_id = offer_id if offer_id is not None else r.get('offer_id')
         if not self.offer_id:
             self.offer_id = r.get('call_eff_offer_id')
         if not self.offer_id:
@@ -111,16 +132,34 @@ class Lead:
         self.is_salary_pay = False
         self.is_salary_not_pay_reason = reason
 
-    def finalize(self, is_fake_approve_func):
-        self.is_salary_not_pay_reason = is_fake_approve_func(self.__dict__)
+    def as_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def finalize(self, is_fake_approve_func=None):
+        # Объект лида общий для всех разрезов (категория, оффер, вебмастер, оператор) - проверяется один раз
+        if self.classified:
+            return
+        self.classified = True
+        if is_fake_approve_func is None or is_fake_approve_func is DBService.is_fake_approve:
+            self.is_salary_not_pay_reason = DBService.fake_approve_reason(
+                self.status_verbose, self.status_group, self.approved_at, self.canceled_at)
+        else:
+            self.is_salary_not_pay_reason = is_fake_approve_func(self.as_dict())
         self.is_salary_pay = (self.is_salary_not_pay_reason == "")
 
 
 class CallGroup:
+    __slots__ = ('key', 'calls', 'billsec', 'calls_effective', 'call_effective_first', 'is_effective',
+                 'calls_effective_count', 'offer_id', 'affiliate_id', 'calldate_str', 'efficiency_seconds')
+
     def __init__(self, key: str, c: Call, efficiency_seconds: int):
         self.key = key
         self.calls = {}
-        self.calls_effective = {}
+        # Объекты Call общие для всех разрезов (оффер, вебмастер, оператор, категория) и не изменяются,
+        # поэтому повышенный billsec при повторе uniqueid хранится в группе. Словарь создается
+        # только при первом таком повторе - у большинства групп его нет
+        self.billsec = None
+        self.calls_effective = None
         self.call_effective_first = None
         self.is_effective = False
         self.calls_effective_count = 0
@@ -129,16 +168,26 @@ class CallGroup:
         self.calldate_str = c.calldate_str
         self.efficiency_seconds = efficiency_seconds
 
+    def get_billsec(self, uniqueid) -> int:
+        """Максимальный billsec звонков группы с данным uniqueid"""
+        call = self.calls[uniqueid]
+        if self.billsec is None:
+            return call.billsec
+        return self.billsec.get(uniqueid, call.billsec)
+
     def push_call(self, call: Call):
-        if call.uniqueid in self.calls:
-            self.calls[call.uniqueid].billsec = max(self.calls[call.uniqueid].billsec, call.billsec)
-        else:
+        if call.uniqueid not in self.calls:
             self.calls[call.uniqueid] = call
+        elif call.billsec > self.get_billsec(call.uniqueid):
+            if self.billsec is None:
+                self.billsec = {}
+            self.billsec[call.uniqueid] = call.billsec
 
     def finalize(self):
-        for call in self.calls.values():
-            if call.billsec >= self.efficiency_seconds:
-                self.calls_effective[call.uniqueid] = call
+        self.calls_effective = {}
+        for uniqueid, call in self.calls.items():
+            if self.get_billsec(uniqueid) >= self.efficiency_seconds:
+                self.calls_effective[uniqueid] = call
                 self.calls_effective_count += 1
                 if self.call_effective_first is None:
                     self.call_effective_first = call
@@ -147,63 +196,83 @@ class CallGroup:
 
 class KpiList:
     min_eff = 0.1
+    # Общий счетчик версий: у каждого изменения любого KpiList процесса своя версия
+    _versions = count(1)
 
     def __init__(self):
-        self.kpi_by_aff_offer = {}
-        self.kpi_by_offer = {}
+        # Индексы для бинарного поиска: ключ -> (отсортированные ординалы дат, планы).
+        # Планы без даты в индекс не попадают - при поиске они всегда пропускались
+        self.index_by_aff_offer = {}
+        self.index_by_offer = {}
+        # Версия планов: меняется при каждом push_kpi, у view() - та же, что у исходного списка.
+        # По ней IncrementalAnalysis узнает, что планы изменились с прошлого анализа
+        self.version = next(KpiList._versions)
+        # Кэш результатов find_kpi: affiliate_id -> offer_id -> period_date -> Kpi/None
         self.kpi_cache = {}
 
-    def _push_kpi_item(self, l: Dict, kpi: Kpi, key: str):
-        if key not in l:
-            l[key] = []
-        items = l[key]
-        current_period_date = self._normalize_date(kpi.period_date)
-        if items:
-            last_period_date = self._normalize_date(items[-1].period_date)
-            if last_period_date and current_period_date and last_period_date > current_period_date:
-                raise ValueError(f"Wrong kpi sort order\nprev: {items[-1].print()}\nnew: {kpi.print()}")
-        items.append(kpi)
-
-    def _normalize_date(self, date_value):
-        """Конвертирует дату в datetime объект для сравнения"""
-        if date_value is None:
-            return None
-        if isinstance(date_value, datetime):
-            return date_value
-        if isinstance(date_value, date):
-            return datetime.combine(date_value, datetime.min.time())
-        if isinstance(date_value, str):
-            try:
-                return datetime.strptime(date_value, '%Y-%m-%d')
-            except ValueError:
-                try:
-                    return datetime.strptime(date_value, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    return None
-        return None
+    @staticmethod
+    def _push_kpi_item(index: Dict, kpi: Kpi, key: str):
+        if kpi.period_ordinal is None:
+            return
+        if key not in index:
+            index[key] = ([], [])
+        ordinals, kpis = index[key]
+        if ordinals and ordinals[-1] > kpi.period_ordinal:
+            raise ValueError(f"Wrong kpi sort order\nprev: {kpis[-1].print()}\nnew: {kpi.print()}")
+        ordinals.append(kpi.period_ordinal)
+        kpis.append(kpi)
+
+    @staticmethod
+    def index_key(kpi: Kpi) -> Tuple[bool, str]:
+        """Индекс плана (True - по вебмастеру и офферу, False - по офферу) и ключ в нем"""
+        return kpi.affiliate_id is not None, kpi.key_aff_offer
 
     def push_kpi(self, r: Dict):
         kpi = Kpi(r)
-        if kpi.affiliate_id is not None:
-            self._push_kpi_item(self.kpi_by_aff_offer, kpi, kpi.key_aff_offer)
-        else:
-            self._push_kpi_item(self.kpi_by_offer, kpi, str(kpi.offer_id))
+        by_aff, key = self.index_key(kpi)
+        self._push_kpi_item(self.index_by_aff_offer if by_aff else self.index_by_offer, kpi, key)
+        self.version = next(KpiList._versions)
+        self.kpi_cache.clear()
+
+    def without(self, keys: Iterable[Tuple[bool, str]]) -> 'KpiList':
+        """Новый список с планами всех ключей (см. index_key), кроме keys.
+
+        Записи индексов остальных ключей общие с исходным списком и не изменяются - планы
+        убранных ключей добавляются в новый список заново через push_kpi.
+        """
+        kpi_list = KpiList()
+        kpi_list.index_by_aff_offer = dict(self.index_by_aff_offer)
+        kpi_list.index_by_offer = dict(self.index_by_offer)
+        for by_aff, key in keys:
+            (kpi_list.index_by_aff_offer if by_aff else kpi_list.index_by_offer).pop(key, None)
+        return kpi_list
+
+    def view(self) -> 'KpiList':
+        """Список с теми же планами и индексами, но собственным кэшем find_kpi (для общего KpiList)"""
+        kpi_list = KpiList.__new__(KpiList)
+        kpi_list.__dict__.update(self.__dict__)
+        kpi_list.kpi_cache = {}
+        return kpi_list
 
-    def _find_kpi_by_list(self, l: Dict, key: str, period_date: str) -> Optional[Kpi]:
-        if key not in l:
+    @staticmethod
+    def _find_kpi_by_index(index: Dict, key: str, period_ordinal: int) -> Optional[Kpi]:
+        """Последний план с датой <= period_ordinal (при равных датах - последний добавленный)"""
+        entry = index.get(key)
+        if entry is None:
             return None
-        items = l[key]
-        normalized_period_date = self._normalize_date(period_date)
-        if normalized_period_date is None:
+        ordinals, kpis = entry
+        pos = bisect_right(ordinals, period_ordinal)
+        return kpis[pos - 1] if pos else None
+
+    def _find_kpi_uncached(self, affiliate_id: Optional[str], offer_id: str, period_date: str) -> Optional[Kpi]:
+        period_ordinal = Kpi._date_ordinal(period_date)
+        if period_ordinal is None:
             return None
-        for i in range(len(items) - 1, -1, -1):
-            kpi_date = self._normalize_date(items[i].period_date)
-            if kpi_date is None:
-                continue
-            if kpi_date > normalized_period_date:
-                continue
-            return items[i]
-        return None
+        if affiliate_id is not None:
+            kpi = self._find_kpi_by_index(self.index_by_aff_offer, Kpi._make_key(affiliate_id, offer_id), period_ordinal)
+            if kpi:
+                return kpi
+        return self._find_kpi_by_index(self.index_by_offer, Kpi._make_key(None, offer_id), period_ordinal)
 
     def find_kpi(self, affiliate_id: Optional[str], offer_id: str, period_date: str) -> Optional[Kpi]:
         if isinstance(period_date, (datetime, date)):
@@ -212,23 +281,21 @@ class KpiList:
         if len(period_date) != 10:
             raise ValueError(f"Wrong kpi request period date '{period_date}' expecting len 10")
 
-        if affiliate_id is not None:
-            key_cache = Kpi._make_key_cache(affiliate_id, offer_id, period_date)
-            if key_cache in self.kpi_cache:
-                return self.kpi_cache[key_cache]
-            key = Kpi._make_key(affiliate_id, offer_id)
-            kpi = self._find_kpi_by_list(self.kpi_by_aff_offer, key, period_date)
-            if kpi:
-                self.kpi_cache[key_cache] = kpi
-                return kpi
-        key_cache = Kpi._make_key_cache(None, offer_id, period_date)
-        if key_cache in self.kpi_cache:
-            return self.kpi_cache[key_cache]
-        key = Kpi._make_key(None, offer_id)
-        kpi = self._find_kpi_by_list(self.kpi_by_offer, key, period_date)
-        if kpi:
-            self.kpi_cache[key_cache] = kpi
-            return kpi
+        # Вложенные словари вместо составного строкового ключа - попадание в кэш ничего не аллоцирует.
+        # Последний уровень - строка даты, а не ординал: после проверки длины строка однозначно
+        # соответствует дню, а попадание по строке обходится без разбора даты (ординал - только при промахе)
+        by_offer = self.kpi_cache.get(affiliate_id)
+        if by_offer is None:
+            by_offer = self.kpi_cache[affiliate_id] = {}
+        by_date = by_offer.get(offer_id)
+        if by_date is None:
+            by_date = by_offer[offer_id] = {}
+        if period_date in by_date:
+            return by_date[period_date]
+
+        kpi = self._find_kpi_uncached(affiliate_id, offer_id, period_date)
+        by_date[period_date] = kpi
+        return kpi
 
     def find_kpi_operator_eff(self, affiliate_id: Optional[str], offer_id: str, period_date: str) -> Optional[Kpi]:
         kpi = self.find_kpi(affiliate_id, offer_id, period_date)
@@ -251,6 +318,8 @@ class Stat:
         self.leads_effective_count = 0
         self.leads_with_calculation = 0
         self.leads_without_calculation = 0
+        # Продажи, посчитанные заранее (таблицы фактов за закрытые дни), см. push_salary_leads
+        self.salary_leads_aggregated = 0
         self.effective_rate = 0.0
         self.expecting_approved_leads = 0.0
         self.expecting_effective_rate = 0.0
@@ -259,9 +328,9 @@ class Stat:
         self.call_efficiency_second = 60
         self.finalized = False
 
-    def push_call(self, r: Dict):
+    def push_call(self, r: Union[Dict, Call]):
         try:
-            call = Call(r)
+            call = r if isinstance(r, Call) else Call(r)
             key = call.make_key()
             if key not in self.calls_group:
                 self.calls_group[key] = CallGroup(key, call, self.call_efficiency_second)
@@ -269,15 +338,19 @@ class Stat:
         except Exception as e:
             logger.warning(f"Skip call: {e}")
 
-    def push_lead(self, r: Dict):
+    def push_lead(self, r: Union[Dict, Lead], offer_id: Optional[int] = None):
         try:
-            lead = Lead(r)
+            lead = r if isinstance(r, Lead) else Lead(r, offer_id)
             if lead.crm_lead_id in self.leads:
                 raise ValueError(f"Lead duplicate id: {lead.crm_lead_id}")
             self.leads[lead.crm_lead_id] = lead
         except Exception as e:
             logger.warning(f"Skip lead: {e}")
 
+    def push_salary_leads(self, count: int):
+        """Добавляет готовое количество оплачиваемых лидов с оффером (без повторной проверки статусов)"""
+        self.salary_leads_aggregated += count
+
     def finalize(self, kpi_list: KpiList, is_fake_approve_func):
         global _log_counter
         if self.finalized:
@@ -314,6 +387,7 @@ class Stat:
                     self.leads_without_calculation += 1
                     continue
                 self.leads_with_calculation += 1
+        self.leads_with_calculation += self.salary_leads_aggregated
 
         # 4. Расчет итоговых показателей (ТОЧНОЕ СООТВЕТСТВИЕ ЭТАЛОНУ)
         self.calls_group_effective_count = self.calls_group_without_calculation + self.calls_group_with_calculation
@@ -349,25 +423,19 @@ def push_call_to_engine(sql_data: Dict, stat: Stat):
 
 
 def push_lead_to_engine(sql_data: Dict, offer_id: int, stat: Stat):
-    sql_data = sql_data.copy()
-    if offer_id is not None:
-        sql_data['offer_id'] = offer_id
-    stat.push_lead(sql_data)
+    stat.push_lead(sql_data, offer_id)
 
 
 def finalize_engine_stat(stat: Stat, kpi_list: KpiList, leads_data: List[Dict] = None):
     """Модифицированная функция, которая принимает готовые данные лидов"""
     global _log_counter
 
-    def is_fake_approve_func(lead_dict: Dict) -> str:
-        return DBService.is_fake_approve(lead_dict)
-
     if not stat.finalized:
         if leads_data:
             for lead in leads_data:
                 stat.push_lead(lead)
 
-        stat.finalize(kpi_list, is_fake_approve_func)
+        stat.finalize(kpi_list, DBService.is_fake_approve)
     else:
         if _log_counter < _MAX_LOGS:
             logger.warning("Engine stat already finalized, skipping")
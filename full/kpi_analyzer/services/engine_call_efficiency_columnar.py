@@ -0,0 +1,251 @@
+import logging
+from datetime import date
+from typing import Dict, Iterable, Any, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .engine_call_efficiency2 import Kpi, Call, Lead, KpiList
+from .db_service import DBService
+
+logger = logging.getLogger(__name__)
+
+
+# Колонки входных массивов звонков и лидов
+CALL_COLUMNS = ('date_ordinal', 'operator_id', 'crm_lead_id', 'uniqueid', 'billsec', 'offer_id', 'affiliate_id',
+                'category', 'offer_key', 'aff_key', 'operator_key')
+LEAD_COLUMNS = ('crm_lead_id', 'is_salary_pay', 'category', 'offer_key', 'aff_key', 'operator_key')
+
+# Разрезы анализа: колонки, задающие элемент разреза (оффер, вебмастер и оператор - внутри категории)
+DIMENSIONS = {
+    'category': ('category',),
+    'offer': ('category', 'offer_key'),
+    'aff': ('category', 'aff_key'),
+    'operator': ('category', 'operator_key'),
+}
+
+# Ключ группы звонков внутри элемента разреза - как в Call.make_key
+GROUP_COLUMNS = ('date_ordinal', 'operator_id', 'crm_lead_id')
+
+RESULT_COLUMNS = ('calls_group_effective_count', 'calls_group_with_calculation', 'calls_group_without_calculation',
+                  'leads_effective_count', 'effective_rate', 'expecting_approved_leads', 'expecting_effective_rate',
+                  'effective_percent')
+
+
+class ColumnarCallEfficiency:
+    """Колоночный расчет эффективности звонков для всех разрезов за один проход.
+
+    Альтернатива объектному движку engine_call_efficiency2 (Stat/CallGroup): принимает звонки и лиды
+    массивами (см. CALL_COLUMNS, LEAD_COLUMNS), группирует, отбирает эффективные группы и сопоставляет
+    планы векторными операциями pandas/numpy. Результат - те же показатели Stat.finalize для каждой
+    категории, оффера, вебмастера и оператора.
+
+    В анализ пока не подключен - сверяется с объектным движком тестом test_columnar_parity. Импортируется
+    напрямую из модуля (не через kpi_analyzer.services), чтобы pandas/numpy не загружались вместе с сервисами.
+    """
+
+    def __init__(self, calls: Dict[str, Iterable], leads: Dict[str, Iterable], efficiency_seconds: int = 60):
+        self.efficiency_seconds = efficiency_seconds
+        self.calls = self._calls_frame(calls)
+        self.leads = self._leads_frame(leads)
+        self._labels: Dict[str, np.ndarray] = {}
+        self._encode_items()
+        self._plan_efficiency: Dict[Tuple, float] = {}
+
+    @classmethod
+    def from_rows(cls, calls_rows: Iterable[Any], leads_rows: Iterable[Any],
+                  efficiency_seconds: int = 60) -> 'ColumnarCallEfficiency':
+        return cls(cls.calls_from_rows(calls_rows), cls.leads_from_rows(leads_rows), efficiency_seconds)
+
+    @staticmethod
+    def calls_from_rows(rows: Iterable[Any]) -> Dict[str, list]:
+        """Строки get_calls (dict или CompactRow) -> колонки CALL_COLUMNS.
+
+        billsec нормализуется так же, как в Call, принадлежность к разрезам - как в CategoryItem.push_call.
+        """
+        columns = {name: [] for name in CALL_COLUMNS}
+        for r in rows:
+            try:
+                call = Call(r)
+            except Exception as e:
+                logger.warning(f"Skip call: {e}")
+                continue
+            offer_id = call.offer_id or r.get('offer_id')
+            operator_name = r.get('lv_username', 'un_operator')
+            columns['date_ordinal'].append(Kpi._date_ordinal(call.calldate_date_str))
+            columns['operator_id'].append(call.operator_id)
+            columns['crm_lead_id'].append(call.crm_lead_id)
+            columns['uniqueid'].append(call.uniqueid)
+            columns['billsec'].append(call.billsec)
+            columns['offer_id'].append(call.offer_id)
+            columns['affiliate_id'].append(call.affiliate_id)
+            columns['category'].append(r.get('category_name', 'No category'))
+            columns['offer_key'].append(str(offer_id) if offer_id and str(offer_id).isdigit() else None)
+            columns['aff_key'].append(
+                str(call.affiliate_id) if call.affiliate_id and str(call.affiliate_id).isdigit() else None)
+            columns['operator_key'].append(
+                operator_name if operator_name and operator_name != 'un_operator' else None)
+        return columns
+
+    @staticmethod
+    def leads_from_rows(rows: Iterable[Any]) -> Dict[str, list]:
+        """Строки get_leads (dict или CompactRow) -> колонки LEAD_COLUMNS с уже рассчитанным is_salary_pay"""
+        columns = {name: [] for name in LEAD_COLUMNS}
+        for r in rows:
+            offer_id = r.get('offer_id')
+            try:
+                lead = Lead(r, int(offer_id) if str(offer_id).isdigit() else None)
+            except Exception as e:
+                logger.warning(f"Skip lead: {e}")
+                continue
+            lead.finalize(DBService.is_fake_approve)
+            aff_id = r.get('aff_id')
+            operator_name = r.get('lv_username', 'No operator')
+            columns['crm_lead_id'].append(lead.crm_lead_id)
+            columns['is_salary_pay'].append(lead.is_salary_pay)
+            columns['category'].append(r.get('category_name', 'No category'))
+            columns['offer_key'].append(str(offer_id) if str(offer_id).isdigit() else None)
+            columns['aff_key'].append(str(aff_id) if str(aff_id).isdigit() else None)
+            columns['operator_key'].append(operator_name or None)
+        return columns
+
+    @staticmethod
+    def _codes(values: Iterable) -> np.ndarray:
+        """Целочисленные коды значений, None получает собственный код"""
+        codes, _ = pd.factorize(pd.Series(list(values), dtype=object), use_na_sentinel=False)
+        return codes
+
+    def _calls_frame(self, calls: Dict[str, Iterable]) -> pd.DataFrame:
+        frame = pd.DataFrame({name: pd.Series(list(calls[name]), dtype=object) for name in CALL_COLUMNS})
+        frame['billsec'] = pd.to_numeric(frame['billsec']).fillna(0).astype(np.int64)
+        # Ключи группы сравниваются по значению, включая None - как в строковом ключе Call.make_key
+        for name in GROUP_COLUMNS:
+            frame[f'{name}_code'] = self._codes(frame[name])
+        frame['has_offer'] = frame['offer_id'].map(bool).astype(bool)
+        return frame
+
+    def _leads_frame(self, leads: Dict[str, Iterable]) -> pd.DataFrame:
+        frame = pd.DataFrame({name: pd.Series(list(leads[name]), dtype=object) for name in LEAD_COLUMNS})
+        frame['is_salary_pay'] = frame['is_salary_pay'].astype(bool)
+        frame['crm_lead_id_code'] = self._codes(frame['crm_lead_id'])
+        return frame
+
+    def _encode_items(self):
+        """Общие для звонков и лидов коды ключей разрезов.
+
+        Для category None - обычное значение ключа, для остальных колонок None -> -1 (не входит в разрез).
+        """
+        for name in ('category', 'offer_key', 'aff_key', 'operator_key'):
+            values = pd.concat([self.calls[name], self.leads[name]], ignore_index=True)
+            codes, labels = pd.factorize(values, use_na_sentinel=name != 'category')
+            self.calls[f'{name}_code'] = codes[:len(self.calls)]
+            self.leads[f'{name}_code'] = codes[len(self.calls):]
+            self._labels[name] = np.asarray(labels, dtype=object)
+
+    def _resolve_plan_efficiency(self, groups: pd.DataFrame, kpi_list: KpiList) -> np.ndarray:
+        """operator_efficiency плана для каждой группы, NaN - план не найден или некорректен.
+
+        Поиск выполняется только для уникальных (вебмастер, оффер, дата), результат соединяется с группами.
+        """
+        keys = list(zip(groups['affiliate_id'], groups['offer_id'], groups['date_ordinal']))
+        codes, uniques = pd.factorize(pd.Series(keys, dtype=object))
+        efficiency = np.empty(len(uniques), dtype=np.float64)
+        for i, key in enumerate(uniques):
+            value = self._plan_efficiency.get(key)
+            if value is None:
+                value = self._find_plan_efficiency(kpi_list, *key)
+                self._plan_efficiency[key] = value
+            efficiency[i] = value
+        return efficiency[codes] if len(codes) else np.empty(0, dtype=np.float64)
+
+    @staticmethod
+    def _find_plan_efficiency(kpi_list: KpiList, affiliate_id, offer_id, date_ordinal) -> float:
+        if date_ordinal is None or pd.isna(date_ordinal):
+            return np.nan
+        kpi = kpi_list.find_kpi_operator_eff(affiliate_id, str(offer_id), date.fromordinal(int(date_ordinal)).isoformat())
+        if kpi is None or kpi.operator_efficiency < KpiList.min_eff:
+            return np.nan
+        return float(kpi.operator_efficiency)
+
+    def _compute_calls(self, item_codes: Tuple[str, ...], kpi_list: KpiList) -> pd.DataFrame:
+        calls = self.calls
+        mask = np.ones(len(calls), dtype=bool)
+        for name in item_codes:
+            mask &= calls[name].to_numpy() >= 0
+        calls = calls[mask]
+
+        keys = list(item_codes) + [f'{name}_code' for name in GROUP_COLUMNS]
+        # Группа эффективна, если хотя бы у одного uniqueid максимальный billsec >= порога.
+        # Максимум по максимумам uniqueid равен максимуму по всем звонкам группы, поэтому
+        # отдельный шаг дедупликации по uniqueid не нужен
+        group_billsec = calls.groupby(keys, sort=False)['billsec'].transform('max')
+        # Атрибуты группы (оффер, вебмастер, дата) берутся из первого звонка - как в CallGroup
+        groups = calls[group_billsec.to_numpy() >= self.efficiency_seconds].drop_duplicates(keys, keep='first')
+
+        efficiency = np.full(len(groups), np.nan)
+        has_offer = groups['has_offer'].to_numpy()
+        if has_offer.any():
+            efficiency[has_offer] = self._resolve_plan_efficiency(groups[has_offer], kpi_list)
+        plan_invalid = has_offer & np.isnan(efficiency)
+        inverse = np.where(has_offer & ~plan_invalid, 1.0 / np.where(np.isnan(efficiency), 1.0, efficiency), 0.0)
+
+        groups = groups[list(item_codes)].assign(
+            calls_group_with_calculation=has_offer.astype(np.int64),
+            calls_group_without_calculation=(~has_offer).astype(np.int64),
+            expecting_approved_leads=inverse,
+            plan_invalid=plan_invalid,
+        )
+        return groups.groupby(list(item_codes), sort=False).agg(
+            calls_group_with_calculation=('calls_group_with_calculation', 'sum'),
+            calls_group_without_calculation=('calls_group_without_calculation', 'sum'),
+            expecting_approved_leads=('expecting_approved_leads', 'sum'),
+            plan_invalid=('plan_invalid', 'any'),
+        )
+
+    def _compute_leads(self, item_codes: Tuple[str, ...]) -> pd.Series:
+        leads = self.leads
+        mask = np.ones(len(leads), dtype=bool)
+        for name in item_codes:
+            mask &= leads[name].to_numpy() >= 0
+        # Повторный лид в элементе разреза пропускается - как в Stat.push_lead
+        leads = leads[mask].drop_duplicates(list(item_codes) + ['crm_lead_id_code'], keep='first')
+        return leads.groupby(list(item_codes), sort=False)['is_salary_pay'].sum().rename('leads_effective_count')
+
+    def _compute_dimension(self, item_columns: Tuple[str, ...], kpi_list: KpiList) -> pd.DataFrame:
+        item_codes = tuple(f'{name}_code' for name in item_columns)
+        result = self._compute_calls(item_codes, kpi_list).join(self._compute_leads(item_codes), how='outer')
+        result = result.fillna({
+            'calls_group_with_calculation': 0, 'calls_group_without_calculation': 0,
+            'expecting_approved_leads': 0.0, 'plan_invalid': False, 'leads_effective_count': 0,
+        }).astype({'calls_group_with_calculation': np.int64, 'calls_group_without_calculation': np.int64,
+                   'leads_effective_count': np.int64, 'plan_invalid': bool})
+
+        calls_with = result['calls_group_with_calculation'].to_numpy().astype(np.float64)
+        leads = result['leads_effective_count'].to_numpy().astype(np.float64)
+        # Отсутствие корректного плана хотя бы для одной группы обнуляет ожидание (None в Stat.finalize)
+        expecting = np.where(result['plan_invalid'].to_numpy(), np.nan, result['expecting_approved_leads'].to_numpy())
+        safe_expecting = np.where(np.isnan(expecting) | (expecting == 0), 1.0, expecting)
+
+        result['calls_group_effective_count'] = (result['calls_group_with_calculation']
+                                                 + result['calls_group_without_calculation'])
+        result['effective_rate'] = np.where((calls_with > 0) & (leads > 0), calls_with / np.where(leads > 0, leads, 1.0),
+                                            0.0)
+        result['expecting_approved_leads'] = expecting
+        result['effective_percent'] = np.where(expecting == 0, 0.0, leads / safe_expecting * 100)
+        result['expecting_effective_rate'] = np.where(expecting == 0, 0.0, calls_with / safe_expecting)
+        result.loc[np.isnan(expecting), ['effective_percent', 'expecting_effective_rate']] = np.nan
+
+        # Коды -> исходные значения ключей
+        result = result.reset_index()
+        for column, code in zip(item_columns, item_codes):
+            result[column] = self._labels[column][result[code].to_numpy()]
+        return result[list(item_columns) + list(RESULT_COLUMNS)]
+
+    def compute(self, kpi_list: KpiList) -> Dict[str, pd.DataFrame]:
+        """Показатели по всем разрезам: {'category'|'offer'|'aff'|'operator': DataFrame}.
+
+        Колонки результата - ключи элемента разреза (category, offer_key, aff_key, operator_key) и RESULT_COLUMNS.
+        NaN в expecting_approved_leads, effective_percent и expecting_effective_rate соответствует None
+        в объектном движке. Элементы без звонков и лидов в результат не попадают.
+        """
+        return {dimension: self._compute_dimension(columns, kpi_list) for dimension, columns in DIMENSIONS.items()}
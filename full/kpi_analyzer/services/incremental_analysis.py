@@ -0,0 +1,330 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Any, Optional, Callable, Set, Tuple
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .analysis_cache import AnalysisCache
+from .db_service import DBService
+from .engine_call_efficiency2 import Call
+from .kpi_analyzer import Stat
+from .kpi_facts import KpiFactService
+from .kpi_plan_cache import KpiPlanCache
+from .parallel_finalize import ParallelFinalize
+from .query_stats import QueryStats
+from .stat_partial import StatPartial
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalAnalysis:
+    """Инкрементальный анализ периода с сегодняшним днем: принятое состояние хранится в процессе.
+
+    Для фильтра (период не длиннее MAX_DAYS дней, включает сегодня, без дней из таблиц фактов)
+    процесс держит частичное состояние анализа (StatPartial), счетчики контейнера лидов и отметки
+    загрузки. Повторный анализ дочитывает из itrade только новое:
+      - звонки с pae.id больше отметки (с запасом CALL_ID_OVERLAP - звонки из незавершенных
+        транзакций могут получить id меньше отметки; уже принятые звонки запаса отбрасываются);
+      - лиды с approved_at не раньше последнего принятого (лиды на самой отметке не повторяются);
+      - контейнеры лидов, созданных или сменивших approved_at / canceled_at / buyout_at после
+        прошлого запроса (по NOW() itrade, с запасом CONTAINER_OVERLAP_SECONDS); вклад лида в
+        счетчики заменяется новым.
+    Дочитанное объединяется с состоянием, заново финализируются только категории с новыми строками
+    или изменившимися счетчиками контейнера (все - при смене планов KPI или списка офферов).
+
+    Изменения уже принятых лидов без новых дат (статус, треш) и отмена после аппрува в строках лидов
+    подхватываются полной перезагрузкой - раз в FULL_RELOAD_SECONDS. Состояния хранятся для
+    MAX_STATES последних фильтров.
+    """
+    ENABLED = getattr(settings, 'KPI_INCREMENTAL_ENABLED', True)
+    MAX_DAYS = getattr(settings, 'KPI_INCREMENTAL_MAX_DAYS', 3)
+    MAX_STATES = getattr(settings, 'KPI_INCREMENTAL_MAX_STATES', 8)
+    FULL_RELOAD_SECONDS = getattr(settings, 'KPI_INCREMENTAL_FULL_RELOAD_SECONDS', 15 * 60)
+    CALL_ID_OVERLAP = getattr(settings, 'KPI_INCREMENTAL_CALL_ID_OVERLAP', 1000)
+    CONTAINER_OVERLAP_SECONDS = getattr(settings, 'KPI_INCREMENTAL_CONTAINER_OVERLAP_SECONDS', 60)
+
+    DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    _lock = threading.Lock()
+    _states: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+
+    @staticmethod
+    def applies(filters: Dict) -> bool:
+        if not IncrementalAnalysis.ENABLED:
+            return False
+        days = DBService._partition_days(filters)
+        if not days or len(days) > IncrementalAnalysis.MAX_DAYS or days[-1] < datetime.now().date():
+            return False
+        return not (KpiFactService.ENABLED and KpiFactService.closed_days(filters))
+
+    @staticmethod
+    def make_key(filters: Dict) -> str:
+        payload = json.dumps(AnalysisCache.normalize_filters(filters), sort_keys=True, ensure_ascii=False,
+                             cls=DjangoJSONEncoder)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _state(key: str) -> Dict[str, Any]:
+        with IncrementalAnalysis._lock:
+            state = IncrementalAnalysis._states.get(key)
+            if state is None:
+                state = IncrementalAnalysis._states[key] = {'lock': threading.Lock(), 'loaded_at': 0.0}
+            IncrementalAnalysis._states.move_to_end(key)
+            while len(IncrementalAnalysis._states) > IncrementalAnalysis.MAX_STATES:
+                IncrementalAnalysis._states.popitem(last=False)
+        return state
+
+    @staticmethod
+    def _drop(key: str):
+        with IncrementalAnalysis._lock:
+            IncrementalAnalysis._states.pop(key, None)
+
+    @staticmethod
+    def _reset(state: Dict[str, Any], started: float):
+        state.update({
+            'partial': StatPartial.empty(),
+            'stat': None,
+            'kpi_version': None,
+            'offers_key': None,
+            'calls_id': None,
+            'leads_at': None,
+            'leads_seen': set(),
+            'container': {'category': {}, 'offer': {}},
+            'container_rows': {},
+            'container_now': None,
+            'leads_count': 0,
+            'calls_count': 0,
+            'loaded_at': started,
+        })
+
+    @staticmethod
+    def run(filters: Dict, progress: Optional[Callable[..., None]] = None) -> Tuple[Stat, Dict[str, Any]]:
+        """Финализированный Stat фильтра и сведения о загрузке (timings, fact_days, leads_count,
+        calls_count, incremental)"""
+        started = time.time()
+        key = IncrementalAnalysis.make_key(filters)
+        state = IncrementalAnalysis._state(key)
+        with state['lock']:
+            full = state.get('stat') is None or started - state['loaded_at'] >= IncrementalAnalysis.FULL_RELOAD_SECONDS
+            if full:
+                IncrementalAnalysis._reset(state, started)
+            try:
+                return IncrementalAnalysis._refresh(state, filters, full, progress)
+            except Exception:
+                # Состояние могло быть изменено частично - следующий анализ загрузит все заново
+                IncrementalAnalysis._drop(key)
+                raise
+
+    @staticmethod
+    def _fetch(state: Dict[str, Any], filters: Dict, full: bool,
+               progress: Optional[Callable[..., None]]) -> Tuple[Dict[str, Any], Dict[str, float]]:
+        calls_filters, leads_filters, container_filters = filters, filters, filters
+        if not full:
+            if state['calls_id'] is not None:
+                calls_filters = dict(filters, after_call_id=max(state['calls_id'] - IncrementalAnalysis.CALL_ID_OVERLAP, 0))
+            if state['leads_at']:
+                leads_filters = dict(filters, approved_since=state['leads_at'])
+            if state['container_now']:
+                since = (datetime.strptime(state['container_now'], IncrementalAnalysis.DATETIME_FORMAT)
+                         - timedelta(seconds=IncrementalAnalysis.CONTAINER_OVERLAP_SECONDS))
+                container_filters = dict(filters, changed_since=since.strftime(IncrementalAnalysis.DATETIME_FORMAT))
+
+        tasks = {
+            'kpi_plans': (KpiPlanCache.kpi_list, ()),
+            'offers': (DBService.get_offers, (filters,)),
+            'calls': (DBService.get_calls, (calls_filters, False, True)),
+            'leads': (DBService.get_leads, (leads_filters, False, True)),
+            'leads_container': (DBService.get_leads_container, (container_filters, True)),
+        }
+        result, timings = {}, {}
+        executor = DBService._executor('fetch')
+        futures = {name: QueryStats.submit(executor, DBService._run_timed, func, *args)
+                   for name, (func, args) in tasks.items()}
+        try:
+            for name, future in futures.items():
+                result[name], duration = future.result()
+                timings[name] = round(duration, 3)
+                if progress:
+                    progress('fetch', query=name, seconds=timings[name], done=len(timings), total=len(tasks))
+        finally:
+            for future in futures.values():
+                future.cancel()
+        return result, timings
+
+    @staticmethod
+    def _is_known_call(partial: Dict[str, Any], row: Any) -> bool:
+        """Звонок уже принят: есть в группе своей категории с не меньшим billsec"""
+        try:
+            call = Call(row)
+        except Exception:
+            return False
+        category = partial['categories'].get(row.get('category_name', 'No category'))
+        group = category['stat']['calls_group'].get(call.make_key()) if category is not None else None
+        return group is not None and group[4].get(call.uniqueid, -1) >= call.billsec
+
+    @staticmethod
+    def _new_calls(state: Dict[str, Any], rows: List[Any]) -> List[Any]:
+        """Звонки, которых еще нет в состоянии (запас перед отметкой - уже принятые); сдвигает отметку"""
+        previous = state['calls_id']
+        if previous is None:
+            new_rows = list(rows)
+        else:
+            new_rows = [row for row in rows if (row.get('call_eff_id') or 0) > previous
+                        or not IncrementalAnalysis._is_known_call(state['partial'], row)]
+        ids = [row.get('call_eff_id') or 0 for row in rows]
+        if ids:
+            state['calls_id'] = max(ids + ([previous] if previous is not None else []))
+        return new_rows
+
+    @staticmethod
+    def _new_leads(state: Dict[str, Any], rows: List[Any]) -> List[Any]:
+        """Лиды, которых еще нет в состоянии; сдвигает отметку approved_at"""
+        leads_at, seen = state['leads_at'], state['leads_seen']
+        new_rows = [row for row in rows
+                    if not ((row.get('call_eff_approved_at') or '') == leads_at and row.get('call_eff_crm_lead_id') in seen)]
+        if new_rows:
+            latest = max(row.get('call_eff_approved_at') or '' for row in new_rows)
+            if latest != leads_at:
+                state['leads_at'], seen = latest, set()
+            seen.update(row.get('call_eff_crm_lead_id') for row in new_rows
+                        if (row.get('call_eff_approved_at') or '') == latest)
+            state['leads_seen'] = seen
+        return new_rows
+
+    @staticmethod
+    def _apply_container(state: Dict[str, Any], rows: List[Any]) -> Tuple[Set[str], Set[str], int]:
+        """Обновляет счетчики контейнера; возвращает (категории, офферы) с изменениями и число лидов"""
+        counters = state['container']
+        changed_categories: Set[str] = set()
+        changed_offers: Set[str] = set()
+
+        def add(entry: Tuple[str, str, Tuple[int, ...]], sign: int):
+            cat_name, offer_id, counts = entry
+            for counter in (counters['category'].setdefault(cat_name, [0, 0, 0, 0]),
+                            counters['offer'].setdefault(offer_id, [0, 0, 0, 0])):
+                for i, count in enumerate(counts):
+                    counter[i] += sign * count
+            changed_categories.add(cat_name)
+            changed_offers.add(offer_id)
+
+        previous_now = state['container_now']
+        leads: Dict[Any, List[Tuple[str, str, Tuple[int, ...]]]] = {}
+        for row in rows:
+            entry = (row.get('category_name', 'No category'), str(row.get('offer_id', '')),
+                     (1,) + Stat.container_row_counts(row))
+            crm_lead_id = row.get('lead_container_crm_lead_id')
+            if crm_lead_id is None:
+                # Без CRM лида строку не заменить - учитываются только созданные после прошлого запроса
+                if previous_now is None or (row.get('lead_container_created_at') or '') >= previous_now:
+                    add(entry, 1)
+                continue
+            leads.setdefault(crm_lead_id, []).append(entry)
+
+        container_rows = state['container_rows']
+        changed_leads = 0
+        for crm_lead_id, entries in leads.items():
+            if container_rows.get(crm_lead_id) == entries:
+                continue
+            changed_leads += 1
+            for entry in container_rows.get(crm_lead_id, ()):
+                add(entry, -1)
+            for entry in entries:
+                add(entry, 1)
+            container_rows[crm_lead_id] = entries
+
+        now = max((row.get('lead_container_now') or '' for row in rows), default='')
+        if now:
+            state['container_now'] = now
+        return changed_categories, changed_offers, changed_leads
+
+    @staticmethod
+    def _refresh(state: Dict[str, Any], filters: Dict, full: bool,
+                 progress: Optional[Callable[..., None]]) -> Tuple[Stat, Dict[str, Any]]:
+        started = time.time()
+        data, timings = IncrementalAnalysis._fetch(state, filters, full, progress)
+        kpi_list = data['kpi_plans']
+
+        new_calls = IncrementalAnalysis._new_calls(state, data['calls'])
+        new_leads = IncrementalAnalysis._new_leads(state, data['leads'])
+        state['calls_count'] += len(new_calls)
+        state['leads_count'] += len(new_leads)
+
+        offers_key = [(offer.get('id'), offer.get('name'), offer.get('category_name')) for offer in data['offers']]
+        offers_changed = offers_key != state['offers_key']
+        state['offers_key'] = offers_key
+        delta = StatPartial.ingest(data['offers'] if offers_changed else [], new_leads, new_calls)
+        if progress:
+            progress('ingest', leads_count=state['leads_count'], calls_count=state['calls_count'])
+
+        changed_categories, changed_offers, changed_container = IncrementalAnalysis._apply_container(
+            state, data['leads_container'])
+        partial = StatPartial.merge_into(state['partial'], delta)
+
+        previous = state['stat']
+        if previous is None or offers_changed or state['kpi_version'] != kpi_list.version:
+            affected = set(partial['categories'])
+        else:
+            affected = set(delta['categories']) | changed_categories
+            if changed_offers:
+                affected.update(cat_name for cat_name, category in partial['categories'].items()
+                                if changed_offers.intersection(category['offer']))
+        state['kpi_version'] = kpi_list.version
+
+        # Заново финализируются только затронутые категории, остальные берутся из прошлого анализа
+        refinalized = StatPartial.finalize({
+            'version': StatPartial.VERSION,
+            'categories': {cat_name: category for cat_name, category in partial['categories'].items()
+                           if cat_name in affected},
+            'container': state['container'],
+        }, kpi_list)
+
+        stat = Stat()
+        stat.kpi_list = kpi_list
+        for cat_name in partial['categories']:
+            category = refinalized.category.get(cat_name)
+            if category is not None:
+                ParallelFinalize.strip_rows(category)
+            else:
+                category = previous.category[cat_name]
+            category.offer_index = stat.offer_index
+            for key, offer in category.offer.items():
+                stat.offer_index.setdefault(key, []).append(offer)
+            stat.category[cat_name] = category
+        state['stat'] = stat
+        if progress:
+            progress('finalize', categories_count=len(stat.category))
+
+        timings['total'] = round(time.time() - started, 3)
+        incremental = {
+            'full': full,
+            'new_calls': len(new_calls),
+            'new_leads': len(new_leads),
+            'changed_container_leads': changed_container,
+            'categories_refinalized': len(refinalized.category),
+            'state_age_seconds': round(started - state['loaded_at'], 1),
+        }
+        logger.info(f">>> Инкрементальный анализ ({'полная загрузка' if full else 'дозагрузка'}) за "
+                    f"{timings['total']:.2f}с: {incremental}")
+        return stat, {
+            'timings': timings,
+            'fact_days': 0,
+            'leads_count': state['leads_count'],
+            'calls_count': state['calls_count'],
+            'incremental': incremental,
+        }
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        now = time.time()
+        with IncrementalAnalysis._lock:
+            states = list(IncrementalAnalysis._states.values())
+        return {
+            'states': len(states),
+            'loaded_seconds_ago': [round(now - state['loaded_at'], 1) for state in states if state.get('stat')],
+        }
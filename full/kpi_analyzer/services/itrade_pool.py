@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any
+
+import MySQLdb
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Свободное соединение itrade не получено за ITRADE_POOL_TIMEOUT"""
+
+
+class ItradeConnectionPool:
+    """Ограниченный пул постоянных соединений MySQLdb к itrade (на процесс).
+
+    Параметры подключения берутся из алиаса Django (get_connection_params), поэтому конвертеры и
+    OPTIONS совпадают с connections['itrade']. Каждое новое соединение получает сессионные настройки
+    (только чтение, уровень изоляции, лимит времени запроса). Соединение, простоявшее дольше
+    PING_INTERVAL, проверяется ping перед выдачей, старше RECYCLE - пересоздается. Запросы сверх SIZE
+    ждут освобождения соединения, поэтому одновременные анализы не перегружают itrade.
+    """
+    SIZE = getattr(settings, 'ITRADE_POOL_SIZE', 8)
+    TIMEOUT = getattr(settings, 'ITRADE_POOL_TIMEOUT', 30)
+    RECYCLE = getattr(settings, 'ITRADE_POOL_RECYCLE', 30 * 60)
+    PING_INTERVAL = getattr(settings, 'ITRADE_POOL_PING_INTERVAL', 30)
+
+    ISOLATION_LEVELS = ('READ UNCOMMITTED', 'READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE')
+    ISOLATION_LEVEL = getattr(settings, 'ITRADE_SESSION_ISOLATION_LEVEL', 'READ COMMITTED')
+    MAX_EXECUTION_MS = getattr(settings, 'ITRADE_SESSION_MAX_EXECUTION_MS', 5 * 60 * 1000)
+
+    def __init__(self, alias: str = 'itrade'):
+        # Алиас Django базы itrade (основной сервер или реплика, см. ItradeReplicaSet)
+        self.alias = alias
+        self._lock = threading.Condition()
+        # Настройки сессии, которые сервер не поддерживает - больше не отправляются
+        self._unsupported_statements = set()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # Свободные соединения: (соединение, время создания, время возврата в пул)
+        self._idle = deque()
+        self._in_use = 0
+        # Время создания выданных и свободных соединений пула (по id соединения)
+        self._created_at: Dict[int, float] = {}
+        self._metrics = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+            'in_use_max': 0,
+        }
+
+    def _check_fork(self):
+        # После fork (воркеры Celery) сокеты родителя не используются: пул начинается заново
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _session_statements(self):
+        statements = ['SET SESSION TRANSACTION READ ONLY']
+        level = str(self.ISOLATION_LEVEL).upper().replace('-', ' ')
+        if level in self.ISOLATION_LEVELS:
+            statements.append(f'SET SESSION TRANSACTION ISOLATION LEVEL {level}')
+        else:
+            logger.warning(f"Неизвестный уровень изоляции itrade: {self.ISOLATION_LEVEL}")
+        if self.MAX_EXECUTION_MS:
+            statements.append(f'SET SESSION max_execution_time = {int(self.MAX_EXECUTION_MS)}')
+        return statements
+
+    def _connect(self):
+        params = connections[self.alias].get_connection_params()
+        connection = MySQLdb.connect(**params)
+        connection.autocommit(True)
+        cursor = connection.cursor()
+        try:
+            for statement in self._session_statements():
+                if statement in self._unsupported_statements:
+                    continue
+                try:
+                    cursor.execute(statement)
+                except MySQLdb.Error as e:
+                    # max_execution_time есть только в MySQL 5.7.8+, остальные настройки не критичны для чтения
+                    logger.warning(f"Настройка сессии itrade не применена ({statement}): {e}")
+                    self._unsupported_statements.add(statement)
+        finally:
+            cursor.close()
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created_at.pop(id(connection), None)
+            self._metrics['closed'] += 1
+
+    def _healthy(self, connection, returned_at: float) -> bool:
+        if time.time() - returned_at < self.PING_INTERVAL:
+            return True
+        try:
+            connection.ping()
+            return True
+        except Exception as e:
+            logger.warning(f"Соединение {self.alias} из пула не отвечает, пересоздается: {e}")
+            with self._lock:
+                self._metrics['health_check_failures'] += 1
+            return False
+
+    def acquire(self):
+        """Выдает соединение из пула; ждет не дольше TIMEOUT, если все SIZE соединений заняты"""
+        start = time.time()
+        deadline = start + self.TIMEOUT
+        waited = False
+        with self._lock:
+            self._check_fork()
+            while not self._idle and self._in_use >= self.SIZE:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._metrics['timeouts'] += 1
+                    raise PoolTimeout(f"Нет свободного соединения {self.alias} за {self.TIMEOUT}с "
+                                      f"(занято {self._in_use} из {self.SIZE})")
+                waited = True
+                self._lock.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self._metrics['in_use_max'] = max(self._metrics['in_use_max'], self._in_use)
+
+        # Проверка и подключение - вне блокировки, слот уже занят
+        try:
+            if entry is not None:
+                connection, created_at, returned_at = entry
+                if time.time() - created_at > self.RECYCLE or not self._healthy(connection, returned_at):
+                    self._close(connection)
+                    entry = None
+            if entry is None:
+                connection = self._connect()
+                with self._lock:
+                    self._created_at[id(connection)] = time.time()
+                    self._metrics['created'] += 1
+        except Exception:
+            self._release_slot()
+            raise
+
+        wait_seconds = time.time() - start
+        with self._lock:
+            self._metrics['checkouts'] += 1
+            if waited:
+                self._metrics['waits'] += 1
+                self._metrics['wait_seconds_total'] += wait_seconds
+                self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], wait_seconds)
+        if waited:
+            logger.info(f"Ожидание соединения itrade из пула: {wait_seconds:.2f}с")
+        return connection
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+            self._lock.notify()
+
+    def release(self, connection, discard: bool = False):
+        """Возвращает соединение в пул; discard=True - закрывает (ошибка, незавершенный потоковый курсор)"""
+        with self._lock:
+            self._check_fork()
+            created_at = self._created_at.get(id(connection))
+        if created_at is None:
+            # Соединение выдано до fork - в текущем пуле его слот не учитывался
+            return
+        if discard:
+            self._close(connection)
+            self._release_slot()
+            return
+        with self._lock:
+            self._idle.append((connection, created_at, time.time()))
+            self._in_use -= 1
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except BaseException:
+            # Состояние соединения после ошибки запроса неизвестно - в пул не возвращается
+            self.release(connection, discard=True)
+            raise
+        else:
+            self.release(connection)
+
+    def close_idle(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for connection, _, _ in idle:
+            self._close(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._check_fork()
+            metrics = dict(self._metrics)
+            in_use, idle = self._in_use, len(self._idle)
+        metrics.update({
+            'alias': self.alias,
+            'size': self.SIZE,
+            'in_use': in_use,
+            'idle': idle,
+            'saturation': round(in_use / self.SIZE, 2) if self.SIZE else None,
+            'wait_seconds_avg': round(metrics['wait_seconds_total'] / metrics['waits'], 3) if metrics['waits'] else 0.0,
+        })
+        metrics['wait_seconds_total'] = round(metrics['wait_seconds_total'], 3)
+        metrics['wait_seconds_max'] = round(metrics['wait_seconds_max'], 3)
+        return metrics
+
+
+itrade_pool = ItradeConnectionPool()
@@ -0,0 +1,168 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Tuple
+
+import MySQLdb
+from django.conf import settings
+
+from .itrade_pool import ItradeConnectionPool, itrade_pool
+
+logger = logging.getLogger(__name__)
+
+
+class ItradeReplicaSet:
+    """Распределение запросов DBService по репликам itrade (алиасы DATABASES, у каждой свой пул).
+
+    REPLICAS - реплики общего пользования, запрос получает одну из них по правилу ROUTING:
+    'round_robin' - по очереди, 'least_outstanding' - с наименьшим числом выполняемых сейчас
+    запросов процесса. QUERY_REPLICAS закрепляет запросы по имени (см. QueryStats) за отдельной
+    репликой, например тяжелые calls / call_groups - за аналитической; пока она исключена, запросы
+    идут на общие реплики.
+
+    Реплика, на которой подряд EJECT_FAILURES раз произошла ошибка соединения (CONNECTION_ERRORS),
+    исключается на EJECT_SECONDS; после этого она снова получает запросы, но первая же ошибка
+    исключает ее повторно, а успешный запрос сбрасывает счетчик. Если исключены все реплики,
+    используется та, что вернется раньше всех. Ошибки самих запросов (синтаксис, данные, таймаут
+    max_execution_time, ожидание блокировки, deadlock) и ожидание пула (PoolTimeout) на исключение
+    не влияют.
+    """
+    REPLICAS = list(getattr(settings, 'ITRADE_REPLICAS', ['itrade']))
+    ROUTING = getattr(settings, 'ITRADE_ROUTING', 'least_outstanding')
+    QUERY_REPLICAS = dict(getattr(settings, 'ITRADE_QUERY_REPLICAS', {}))
+    EJECT_FAILURES = getattr(settings, 'ITRADE_REPLICA_EJECT_FAILURES', 2)
+    EJECT_SECONDS = getattr(settings, 'ITRADE_REPLICA_EJECT_SECONDS', 30)
+    # Коды ошибок клиента MySQL, означающие недоступность сервера или обрыв соединения:
+    # CONN_HOST_ERROR, CONNECTION_ERROR, SERVER_GONE_ERROR, SERVER_LOST, SERVER_LOST_EXTENDED
+    CONNECTION_ERRORS = (2002, 2003, 2006, 2013, 2055)
+
+    ROUTINGS = ('round_robin', 'least_outstanding')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Пул основного алиаса общий с itrade_pool
+        self._pools: Dict[str, ItradeConnectionPool] = {itrade_pool.alias: itrade_pool}
+        if self.ROUTING not in self.ROUTINGS:
+            logger.warning(f"Неизвестное правило распределения по репликам itrade: {self.ROUTING}, "
+                           f"используется least_outstanding")
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._next = 0
+        self._state: Dict[str, Dict[str, Any]] = {}
+
+    def _replica_state(self, alias: str) -> Dict[str, Any]:
+        state = self._state.get(alias)
+        if state is None:
+            state = self._state[alias] = {
+                'outstanding': 0,
+                'queries': 0,
+                'failures': 0,
+                'ejected_until': 0.0,
+                'ejections': 0,
+            }
+        return state
+
+    def pool(self, alias: str) -> ItradeConnectionPool:
+        with self._lock:
+            pool = self._pools.get(alias)
+            if pool is None:
+                pool = self._pools[alias] = ItradeConnectionPool(alias)
+            return pool
+
+    def _pick(self, candidates: List[str]) -> str:
+        if self.ROUTING == 'round_robin':
+            alias = candidates[self._next % len(candidates)]
+            self._next += 1
+            return alias
+        return min(candidates, key=lambda alias: self._replica_state(alias)['outstanding'])
+
+    def choose(self, name: str) -> str:
+        """Реплика для запроса name; учитывает закрепление, исключенные реплики и правило ROUTING"""
+        now = time.time()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            pinned = self.QUERY_REPLICAS.get(name)
+            if pinned and self._replica_state(pinned)['ejected_until'] <= now:
+                alias = pinned
+            else:
+                healthy = [alias for alias in self.REPLICAS if self._replica_state(alias)['ejected_until'] <= now]
+                if healthy:
+                    alias = self._pick(healthy)
+                else:
+                    alias = min(self.REPLICAS, key=lambda alias: self._replica_state(alias)['ejected_until'])
+            state = self._replica_state(alias)
+            state['outstanding'] += 1
+            state['queries'] += 1
+        return alias
+
+    @staticmethod
+    def _is_connection_error(error: BaseException) -> bool:
+        return (isinstance(error, MySQLdb.OperationalError) and bool(error.args)
+                and error.args[0] in ItradeReplicaSet.CONNECTION_ERRORS)
+
+    def _finish(self, alias: str, error: Optional[BaseException] = None):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            state = self._replica_state(alias)
+            state['outstanding'] = max(state['outstanding'] - 1, 0)
+            if error is None:
+                state['failures'] = 0
+                return
+            # Считаются только ошибки соединения: OperationalError бывает и у медленных или
+            # конфликтующих запросов (3024 max_execution_time, 1205 lock wait, 1213 deadlock)
+            if not self._is_connection_error(error):
+                return
+            state['failures'] += 1
+            if state['failures'] < self.EJECT_FAILURES:
+                return
+            state['ejected_until'] = time.time() + self.EJECT_SECONDS
+            state['ejections'] += 1
+        logger.warning(f"Реплика itrade {alias} исключена на {self.EJECT_SECONDS}с после ошибки: {error}")
+
+    def acquire(self, name: str) -> Tuple[str, Any]:
+        """(алиас, соединение) для запроса name; вернуть через release"""
+        alias = self.choose(name)
+        try:
+            return alias, self.pool(alias).acquire()
+        except Exception as e:
+            self._finish(alias, e)
+            raise
+
+    def release(self, alias: str, connection, discard: bool = False, error: Optional[BaseException] = None):
+        self.pool(alias).release(connection, discard=discard or error is not None)
+        self._finish(alias, error)
+
+    @contextmanager
+    def connection(self, name: str):
+        alias, connection = self.acquire(name)
+        try:
+            yield alias, connection
+        except BaseException as e:
+            self.release(alias, connection, discard=True, error=e if isinstance(e, Exception) else None)
+            raise
+        else:
+            self.release(alias, connection)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            states = {alias: dict(state) for alias, state in self._state.items()}
+            aliases = list(dict.fromkeys(self.REPLICAS + list(self.QUERY_REPLICAS.values()) + list(states)))
+        replicas = {}
+        for alias in aliases:
+            state = states.get(alias) or {'outstanding': 0, 'queries': 0, 'failures': 0,
+                                          'ejected_until': 0.0, 'ejections': 0}
+            ejected_until = state.pop('ejected_until')
+            state['ejected_seconds_left'] = round(max(ejected_until - now, 0), 1)
+            state['pool'] = self.pool(alias).stats()
+            replicas[alias] = state
+        return {'routing': self.ROUTING, 'query_replicas': self.QUERY_REPLICAS, 'replicas': replicas}
+
+
+itrade_replicas = ItradeReplicaSet()
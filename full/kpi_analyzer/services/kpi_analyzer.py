@@ -1,15 +1,16 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable, Tuple, Union
 from datetime import datetime
 import logging
 import time
-from types import SimpleNamespace
 
 from .engine_call_efficiency2 import (
-    KpiList, Stat as CallStat, push_lead_to_engine, push_call_to_engine,
+    KpiList, Stat as CallStat, Call, Lead, push_lead_to_engine, push_call_to_engine,
     finalize_engine_stat
 )
 from .statistics import safe_div, safe_float
 from .db_service import DBService
+from .kpi_plan_cache import KpiPlanCache
+from .parallel_finalize import ParallelFinalize
 
 logger = logging.getLogger(__name__)
 
@@ -75,6 +76,9 @@ class RecommendationEngine:
 
 
 class KpiStat:
+    __slots__ = ('calls_group_effective_count', 'leads_effective_count', 'effective_percent', 'effective_rate',
+                 'expecting_effective_rate', 'stat')
+
     def __init__(self):
         self.calls_group_effective_count = 0
         self.leads_effective_count = 0
@@ -84,7 +88,29 @@ class KpiStat:
         self.stat = CallStat()
 
 
+class LeadContainer:
+    __slots__ = ('leads_non_trash_count', 'leads_approved_count', 'leads_buyout_count', 'leads_trash_count',
+                 'leads_total_count', 'leads_raw_count')
+
+    def __init__(self):
+        self.leads_non_trash_count = 0
+        self.leads_approved_count = 0
+        self.leads_buyout_count = 0
+        self.leads_trash_count = 0
+        self.leads_total_count = 0
+        self.leads_raw_count = 0
+
+
 class CommonItem:
+    __slots__ = ('key', 'description', 'kpi_stat', 'kpi_current_plan', 'recommended_efficiency',
+                 'recommended_approve', 'recommended_buyout', 'recommended_confirmation_price',
+                 'expecting_approve_leads', 'expecting_buyout_leads',
+                 'kpi_eff_need_correction', 'kpi_eff_need_correction_str', 'kpi_app_need_correction',
+                 'kpi_app_need_correction_str', 'kpi_buyout_need_correction', 'kpi_buyout_need_correction_str',
+                 'kpi_confirmation_price_need_correction', 'kpi_confirmation_price_need_correction_str',
+                 'lead_container', 'approve_percent_fact', 'buyout_percent_fact', 'trash_percent',
+                 'raw_to_approve_percent', 'raw_to_buyout_percent', 'non_trash_to_buyout_percent')
+
     def __init__(self, key: str, description: str):
         self.key = key
         self.description = description
@@ -106,14 +132,7 @@ class CommonItem:
         self.kpi_confirmation_price_need_correction = False
         self.kpi_confirmation_price_need_correction_str = ""
 
-        self.lead_container = SimpleNamespace(
-            leads_non_trash_count=0,
-            leads_approved_count=0,
-            leads_buyout_count=0,
-            leads_trash_count=0,
-            leads_total_count=0,
-            leads_raw_count=0
-        )
+        self.lead_container = LeadContainer()
         self.approve_percent_fact: Optional[float] = None
         self.buyout_percent_fact: Optional[float] = None
         self.trash_percent: Optional[float] = None
@@ -121,11 +140,12 @@ class CommonItem:
         self.raw_to_buyout_percent: Optional[float] = None
         self.non_trash_to_buyout_percent: Optional[float] = None
 
-    def push_lead(self, sql_data: Dict, offer_id: int = None):
-        push_lead_to_engine(sql_data, offer_id, self.kpi_stat.stat)
+    def push_lead(self, lead: Optional[Lead], offer_id: int = None):
+        if lead is not None:
+            push_lead_to_engine(lead, offer_id, self.kpi_stat.stat)
 
-    def push_call(self, sql_data: Dict):
-        push_call_to_engine(sql_data, self.kpi_stat.stat)
+    def push_call(self, call: Call):
+        push_call_to_engine(call, self.kpi_stat.stat)
 
     def calculate_correction_flags(self):
         self.kpi_eff_need_correction = False
@@ -248,15 +268,19 @@ class CommonItem:
 
 
 class OfferItem(CommonItem):
+    __slots__ = ()
+
     def __init__(self, key: str, description: str):
         super().__init__(key, description)
 
 
 class CategoryItem:
-    def __init__(self, key: str, name: str):
+    def __init__(self, key: str, name: str, offer_index: Optional[Dict[str, List['OfferItem']]] = None):
         self.key = key
         self.description = name
         self.offer: Dict[str, OfferItem] = {}
+        # Общий для всех категорий индекс id оффера -> OfferItem категорий (см. Stat.offer_index)
+        self.offer_index = offer_index
         self.aff: Dict[str, CommonItem] = {}
         self.operator: Dict[str, CommonItem] = {}
         self.kpi_stat = KpiStat()
@@ -283,14 +307,7 @@ class CategoryItem:
         self.approve_rate_plan: float = 0.0
         self.buyout_rate_plan: float = 0.0
 
-        self.lead_container = SimpleNamespace(
-            leads_non_trash_count=0,
-            leads_approved_count=0,
-            leads_buyout_count=0,
-            leads_trash_count=0,
-            leads_total_count=0,
-            leads_raw_count=0
-        )
+        self.lead_container = LeadContainer()
 
         self.kpi_eff_need_correction = False
         self.kpi_eff_need_correction_str = ""
@@ -299,24 +316,28 @@ class CategoryItem:
         self.kpi_buyout_need_correction = False
         self.kpi_buyout_need_correction_str = ""
 
+    def _get_offer(self, key: str, name: str) -> 'OfferItem':
+        offer = self.offer.get(key)
+        if offer is None:
+            offer = self.offer[key] = OfferItem(key, name)
+            if self.offer_index is not None:
+                self.offer_index.setdefault(key, []).append(offer)
+        return offer
+
     def push_offer(self, offer_data: Dict, sql_data: Dict):
         offer_id = offer_data.get('id')
         if not offer_id or not str(offer_id).isdigit():
             return
-        key = str(offer_id)
-        if key not in self.offer:
-            self.offer[key] = OfferItem(key, offer_data.get('name', ''))
+        self._get_offer(str(offer_id), offer_data.get('name', ''))
 
-    def push_lead(self, lead_data: Dict, sql_data: Dict):
-        offer_id = lead_data.get('offer_id')
-        aff_id = lead_data.get('aff_id')
-        operator_name = lead_data.get('lv_operator', 'No operator')
+    def push_lead(self, sql_data: Dict, lead: Optional[Lead]):
+        offer_id = sql_data.get('offer_id')
+        aff_id = sql_data.get('aff_id')
+        operator_name = sql_data.get('lv_username', 'No operator')
 
         if str(offer_id).isdigit():
             key = str(offer_id)
-            if key not in self.offer:
-                self.offer[key] = OfferItem(key, lead_data.get('offer_name', ''))
-            self.offer[key].push_lead(sql_data, offer_id=int(offer_id))
+            self._get_offer(key, sql_data.get('offer_name', '')).push_lead(lead)
 
             self.offer[key].lead_container.leads_raw_count += 1
             self.offer[key].lead_container.leads_total_count += 1
@@ -334,7 +355,7 @@ class CategoryItem:
             key = str(aff_id)
             if key not in self.aff:
                 self.aff[key] = CommonItem(key, f"Web #{key}")
-            self.aff[key].push_lead(sql_data, offer_id=int(offer_id))
+            self.aff[key].push_lead(lead)
 
             self.aff[key].lead_container.leads_raw_count += 1
             self.aff[key].lead_container.leads_total_count += 1
@@ -351,7 +372,7 @@ class CategoryItem:
         if operator_name:
             if operator_name not in self.operator:
                 self.operator[operator_name] = CommonItem(operator_name, operator_name)
-            self.operator[operator_name].push_lead(sql_data, offer_id=int(offer_id))
+            self.operator[operator_name].push_lead(lead)
 
             self.operator[operator_name].lead_container.leads_raw_count += 1
             self.operator[operator_name].lead_container.leads_total_count += 1
@@ -365,32 +386,62 @@ class CategoryItem:
             else:
                 self.operator[operator_name].lead_container.leads_trash_count += 1
 
-        push_lead_to_engine(sql_data, int(offer_id) if str(offer_id).isdigit() else None, self.kpi_stat.stat)
+        if lead is not None:
+            push_lead_to_engine(lead, None, self.kpi_stat.stat)
 
-    def push_call(self, call_data: Dict, sql_data: Dict):
-        offer_id = call_data.get('offer_id')
-        aff_id = call_data.get('aff_id')
-        operator_name = call_data.get('lv_operator', 'No operator')
+    def push_lead_fact(self, fact: Dict):
+        """Дневной агрегат лидов (KpiLeadFact): то же, что push_lead для leads_count строк ячейки"""
+        offer_id = fact.get('offer_id')
+        aff_id = fact.get('aff_id')
+        operator_name = fact.get('lv_username', 'No operator')
+        leads_count = fact.get('leads_count', 0)
+        salary_leads_count = fact.get('salary_leads_count', 0)
+
+        items = []
+        if str(offer_id).isdigit():
+            items.append(self._get_offer(str(offer_id), fact.get('offer_name', '')))
+
+        if str(aff_id).isdigit():
+            key = str(aff_id)
+            if key not in self.aff:
+                self.aff[key] = CommonItem(key, f"Web #{key}")
+            items.append(self.aff[key])
+
+        if operator_name:
+            if operator_name not in self.operator:
+                self.operator[operator_name] = CommonItem(operator_name, operator_name)
+            items.append(self.operator[operator_name])
+
+        # В строках лидов нет полей контейнера, поэтому каждая строка - сырой, не треш, без аппрува
+        for item in items:
+            item.kpi_stat.stat.push_salary_leads(salary_leads_count)
+            item.lead_container.leads_raw_count += leads_count
+            item.lead_container.leads_total_count += leads_count
+            item.lead_container.leads_non_trash_count += leads_count
+
+        self.kpi_stat.stat.push_salary_leads(salary_leads_count)
+
+    def push_call(self, sql_data: Dict, call: Call):
+        offer_id = call.offer_id or sql_data.get('offer_id')
+        aff_id = call.affiliate_id
+        operator_name = sql_data.get('lv_username', 'un_operator')
 
         if offer_id and str(offer_id).isdigit():
             key = str(offer_id)
-            if key not in self.offer:
-                offer_name = call_data.get('offer_name') or sql_data.get('offer_name', f'Offer #{key}')
-                self.offer[key] = OfferItem(key, offer_name)
-            self.offer[key].push_call(sql_data)
+            self._get_offer(key, sql_data.get('offer_name', f'Offer #{key}')).push_call(call)
 
         if aff_id and str(aff_id).isdigit():
             key = str(aff_id)
             if key not in self.aff:
                 self.aff[key] = CommonItem(key, f"Web #{key}")
-            self.aff[key].push_call(sql_data)
+            self.aff[key].push_call(call)
 
         if operator_name and operator_name != 'un_operator':
             if operator_name not in self.operator:
                 self.operator[operator_name] = CommonItem(operator_name, operator_name)
-            self.operator[operator_name].push_call(sql_data)
+            self.operator[operator_name].push_call(call)
 
-        push_call_to_engine(sql_data, self.kpi_stat.stat)
+        push_call_to_engine(call, self.kpi_stat.stat)
 
     def _finalize_operators_and_affiliates(self, kpi_list: KpiList):
         for operator in self.operator.values():
@@ -665,118 +716,147 @@ class Stat:
         self.category: Dict[str, CategoryItem] = {}
         self.kpi_list: Optional[KpiList] = None
         self.leads_container_data: List[Dict] = []
+        self.leads_container_facts: List[Dict] = []
+        # id оффера -> OfferItem всех категорий с этим оффером; пополняется при приеме строк
+        self.offer_index: Dict[str, List[OfferItem]] = {}
+
+    def _get_category(self, cat_name: str) -> CategoryItem:
+        category = self.category.get(cat_name)
+        if category is None:
+            category = self.category[cat_name] = CategoryItem(cat_name, cat_name, self.offer_index)
+        return category
+
+    def _load_kpi_data(self, kpi_plans_data: Union[List[Dict], KpiList]):
+        # Готовый KpiList (см. KpiPlanCache) используется как есть
+        if isinstance(kpi_plans_data, KpiList):
+            self.kpi_list = kpi_plans_data
+        else:
+            self.kpi_list = KpiPlanCache.build_kpi_list(kpi_plans_data)
 
-    def _load_kpi_data(self, kpi_plans_data: List[Dict]):
-        self.kpi_list = KpiList()
-        for plan in kpi_plans_data or []:
-            try:
-                self.kpi_list.push_kpi(plan)
-            except Exception as e:
-                logger.error(f"KPI load error: {e}")
-
-    def finalize_with_data(self, kpi_plans_data: List[Dict], leads_container_data: List[Dict]):
+    def finalize_with_data(self, kpi_plans_data: Union[List[Dict], KpiList], leads_container_data: List[Dict],
+                           leads_container_facts: Optional[List[Dict]] = None, parallel: Optional[bool] = None):
+        """parallel - финализация категорий в пуле процессов (см. ParallelFinalize): None - по объему данных"""
         self.leads_container_data = leads_container_data
+        self.leads_container_facts = leads_container_facts or []
         self._load_kpi_data(kpi_plans_data)
         self._process_leads_container_data()
+        self.finalize_categories(parallel)
 
+    def finalize_categories(self, parallel: Optional[bool] = None):
+        if ParallelFinalize.should_run(self, parallel) and ParallelFinalize.run(self):
+            return
         for cat in self.category.values():
             cat.finalize(self.kpi_list)
 
+    @staticmethod
+    def container_row_counts(lead: Dict) -> Tuple[int, int, int]:
+        """Строка контейнера лидов -> (не треш, аппрув, выкуп) с учетом фейковых аппрувов и выкупов"""
+        is_trash = lead.get('lead_container_is_trash', False)
+        approved_at = lead.get('lead_container_approved_at')
+        fake_approve_reason = None
+
+        if approved_at:
+            fake_approve_reason = DBService.fake_approve_reason(
+                lead.get('lead_container_status_verbose', ''),
+                lead.get('lead_container_status_group', ''),
+                approved_at,
+                lead.get('lead_container_canceled_at', ''))
+            if not fake_approve_reason:
+                is_trash = False
+
+        if is_trash:
+            return 0, 0, 0
+        if not approved_at or fake_approve_reason:
+            return 1, 0, 0
+        if lead.get('lead_container_buyout_at'):
+            fake_buyout_reason = DBService.fake_buyout_reason(
+                lead.get('lead_container_status_group', ''),
+                lead.get('lead_container_buyout_at', ''))
+            if not fake_buyout_reason:
+                return 1, 1, 1
+        return 1, 1, 0
+
+    @staticmethod
+    def container_counters(leads_container_data: List[Dict], leads_container_facts: Optional[List[Dict]] = None
+                           ) -> Tuple[Dict[str, List[int]], Dict[str, List[int]]]:
+        """Счетчики контейнера [сырые, не треш, аппрув, выкуп] по категориям и по офферам (оффер - по всем категориям)"""
+        category_leads: Dict[str, List[int]] = {}
+        offer_leads: Dict[str, List[int]] = {}
+
+        # Дневные агрегаты закрытых дней (KpiLeadContainerFact), затем строки открытых дней
+        for fact in leads_container_facts or []:
+            counts = (fact['raw_count'], fact['non_trash_count'], fact['approved_count'], fact['buyout_count'])
+            for counters in (category_leads.setdefault(fact.get('category_name', 'No category'), [0, 0, 0, 0]),
+                             offer_leads.setdefault(str(fact.get('offer_id', '')), [0, 0, 0, 0])):
+                for i, count in enumerate(counts):
+                    counters[i] += count
+
+        for lead in leads_container_data or []:
+            non_trash, approved, buyout = Stat.container_row_counts(lead)
+            for counters in (category_leads.setdefault(lead.get('category_name', 'No category'), [0, 0, 0, 0]),
+                             offer_leads.setdefault(str(lead.get('offer_id', '')), [0, 0, 0, 0])):
+                counters[0] += 1
+                counters[1] += non_trash
+                counters[2] += approved
+                counters[3] += buyout
+        return category_leads, offer_leads
+
     def _process_leads_container_data(self):
-        if not self.leads_container_data:
+        if not self.leads_container_data and not self.leads_container_facts:
             logger.warning("No leads container data provided")
             return
+        self.apply_container_counters(*self.container_counters(self.leads_container_data, self.leads_container_facts))
 
-        category_leads = {}
-        offer_leads = {}
-
-        for lead in self.leads_container_data:
-            category_name = lead.get('category_name', 'No category')
-            offer_id = str(lead.get('offer_id', ''))
-
-            if category_name not in category_leads:
-                category_leads[category_name] = {'raw': 0, 'non_trash': 0, 'approved': 0, 'buyout': 0}
-            if offer_id not in offer_leads:
-                offer_leads[offer_id] = {'raw': 0, 'non_trash': 0, 'approved': 0, 'buyout': 0}
-
-            category_leads[category_name]['raw'] += 1
-            offer_leads[offer_id]['raw'] += 1
-
-            is_trash = lead.get('lead_container_is_trash', False)
-            approved_at = lead.get('lead_container_approved_at')
-
-            if approved_at:
-                fake_approve_reason = DBService.is_fake_approve({
-                    'status_verbose': lead.get('lead_container_status_verbose', ''),
-                    'status_group': lead.get('lead_container_status_group', ''),
-                    'approved_at': approved_at,
-                    'canceled_at': lead.get('lead_container_canceled_at', '')
-                })
-                if not fake_approve_reason:
-                    is_trash = False
-
-            if not is_trash:
-                category_leads[category_name]['non_trash'] += 1
-                offer_leads[offer_id]['non_trash'] += 1
-
-                if approved_at and not fake_approve_reason:
-                    category_leads[category_name]['approved'] += 1
-                    offer_leads[offer_id]['approved'] += 1
-
-                    if lead.get('lead_container_buyout_at'):
-                        fake_buyout_reason = DBService.is_fake_buyout({
-                            'status_group': lead.get('lead_container_status_group', ''),
-                            'buyout_at': lead.get('lead_container_buyout_at', '')
-                        })
-                        if not fake_buyout_reason:
-                            category_leads[category_name]['buyout'] += 1
-                            offer_leads[offer_id]['buyout'] += 1
-
-        for cat_name, cat_data in category_leads.items():
-            if cat_name in self.category:
-                self.category[cat_name].lead_container.leads_raw_count = cat_data['raw']
-                self.category[cat_name].lead_container.leads_non_trash_count = cat_data['non_trash']
-                self.category[cat_name].lead_container.leads_approved_count = cat_data['approved']
-                self.category[cat_name].lead_container.leads_buyout_count = cat_data['buyout']
-
-        for offer_id, offer_data in offer_leads.items():
-            for category in self.category.values():
-                if offer_id in category.offer:
-                    category.offer[offer_id].lead_container.leads_raw_count = offer_data['raw']
-                    category.offer[offer_id].lead_container.leads_non_trash_count = offer_data['non_trash']
-                    category.offer[offer_id].lead_container.leads_approved_count = offer_data['approved']
-                    category.offer[offer_id].lead_container.leads_buyout_count = offer_data['buyout']
+    def apply_container_counters(self, category_leads: Dict[str, List[int]], offer_leads: Dict[str, List[int]]):
+        for cat_name, counters in category_leads.items():
+            category = self.category.get(cat_name)
+            if category is not None:
+                self._set_container_counts(category.lead_container, counters)
+
+        for offer_id, counters in offer_leads.items():
+            for offer in self.offer_index.get(offer_id, ()):
+                self._set_container_counts(offer.lead_container, counters)
+
+    @staticmethod
+    def _set_container_counts(lead_container: LeadContainer, counters: List[int]):
+        lead_container.leads_raw_count = counters[0]
+        lead_container.leads_non_trash_count = counters[1]
+        lead_container.leads_approved_count = counters[2]
+        lead_container.leads_buyout_count = counters[3]
 
     def push_offer(self, sql_data: Dict):
         cat_name = sql_data.get('category_name', 'No category')
-        if cat_name not in self.category:
-            self.category[cat_name] = CategoryItem(cat_name, cat_name)
+        category = self._get_category(cat_name)
         offer_data = {'id': sql_data.get('id'), 'name': sql_data.get('name', '')}
-        self.category[cat_name].push_offer(offer_data, sql_data)
+        category.push_offer(offer_data, sql_data)
 
     def push_lead(self, sql_data: Dict):
+        # Строка разбирается в Lead один раз, объект общий для всех разрезов категории
         cat_name = sql_data.get('category_name', 'No category')
-        if cat_name not in self.category:
-            self.category[cat_name] = CategoryItem(cat_name, cat_name)
-        lead_data = {
-            'offer_id': sql_data.get('offer_id'),
-            'offer_name': sql_data.get('offer_name', ''),
-            'aff_id': sql_data.get('aff_id'),
-            'lv_operator': sql_data.get('lv_username', 'No operator')
-        }
-        self.category[cat_name].push_lead(lead_data, sql_data)
+        category = self._get_category(cat_name)
+        offer_id = sql_data.get('offer_id')
+        try:
+            lead = Lead(sql_data, int(offer_id) if str(offer_id).isdigit() else None)
+        except Exception as e:
+            logger.warning(f"Skip lead: {e}")
+            lead = None
+        category.push_lead(sql_data, lead)
+
+    def push_lead_fact(self, fact: Dict):
+        cat_name = fact.get('category_name', 'No category')
+        category = self._get_category(cat_name)
+        category.push_lead_fact(fact)
 
     def push_call(self, sql_data: Dict):
+        # Строка разбирается в Call один раз, объект общий для всех разрезов категории
+        try:
+            call = Call(sql_data)
+        except Exception as e:
+            logger.warning(f"Skip call: {e}")
+            return
         cat_name = sql_data.get('category_name', 'No category')
-        if cat_name not in self.category:
-            self.category[cat_name] = CategoryItem(cat_name, cat_name)
-        call_data = {
-            'offer_id': sql_data.get('call_eff_offer_id') or sql_data.get('offer_id'),
-            'offer_name': sql_data.get('offer_name', ''),
-            'aff_id': sql_data.get('call_eff_affiliate_id'),
-            'lv_operator': sql_data.get('lv_username', 'un_operator')
-        }
-        self.category[cat_name].push_call(call_data, sql_data)
+        category = self._get_category(cat_name)
+        category.push_call(sql_data, call)
 
     def get_categories_list(self) -> List[CategoryItem]:
         return list(self.category.values())
@@ -794,28 +874,46 @@ class OpAnalyzeKPI:
 
     def __init__(self):
         self.stat = Stat()
+        self.leads_count = 0
+        self.calls_count = 0
 
     def run_analysis_with_data(self, kpi_plans_data, offers_data, leads_data, calls_data, leads_container_data,
-                               filters):
+                               filters, progress: Optional[Callable[..., None]] = None,
+                               lead_facts: Optional[List[Dict]] = None,
+                               leads_container_facts: Optional[List[Dict]] = None):
+        """leads_data и calls_data могут быть как списками, так и итераторами (потоковое чтение из БД).
+
+        progress(stage, **details) - необязательный обработчик этапов анализа (ingest, finalize).
+        lead_facts и leads_container_facts - дневные агрегаты закрытых дней (см. KpiFactService);
+        сгруппированные звонки (таблицы фактов, DBService.get_call_groups) передаются в calls_data
+        как обычные строки.
+        """
         logger.info(">>> Starting KPI analysis with pre-loaded data...")
 
         for offer in offers_data:
             self.stat.push_offer(offer)
+        for fact in lead_facts or []:
+            self.stat.push_lead_fact(fact)
+            self.leads_count += fact.get('leads_count', 0)
         for lead in leads_data:
             self.stat.push_lead(lead)
+            self.leads_count += 1
         for call in calls_data:
             self.stat.push_call(call)
-
-        self.stat.finalize_with_data(kpi_plans_data, leads_container_data)
+            # Сгруппированная строка (get_call_groups, таблицы фактов) несет число исходных звонков
+            self.calls_count += call.get('call_eff_calls_count') or 1
+        if progress:
+            progress('ingest', leads_count=self.leads_count, calls_count=self.calls_count)
+
+        self.stat.finalize_with_data(kpi_plans_data, leads_container_data, leads_container_facts)
+        if progress:
+            progress('finalize', categories_count=len(self.stat.category))
         return self.stat
 
     def run_analysis(self, filters: Dict) -> Stat:
         logger.warning("Using deprecated run_analysis method - consider switching to run_analysis_with_data")
 
-        kpi_plans = DBService.get_kpi_plans_data()
-        offers = DBService.get_offers(filters)
-        leads = DBService.get_leads(filters)
-        calls = DBService.get_calls(filters)
-        leads_container = DBService.get_leads_container(filters)
+        data = DBService.fetch_analysis_data(filters)
 
-        return self.run_analysis_with_data(kpi_plans, offers, leads, calls, leads_container, filters)
\ No newline at end of file
+        return self.run_analysis_with_data(data['kpi_plans'], data['offers'], data['leads'], data['calls'],
+                                           data['leads_container'], filters)
\ No newline at end of file
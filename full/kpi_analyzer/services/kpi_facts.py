@@ -0,0 +1,338 @@
+import logging
+import time
+from datetime import date, datetime, timedelta
+from itertools import chain
+from typing import Dict, List, Any, Optional, Callable, Iterable, Iterator
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from ..models import KpiFactDay, KpiCallGroupFact, KpiLeadFact, KpiLeadContainerFact
+from .db_service import DBService
+from .engine_call_efficiency2 import Call, Lead
+from .kpi_analyzer import Stat
+
+logger = logging.getLogger(__name__)
+
+
+class KpiFactService:
+    """Дневные таблицы фактов KPI, построенные из itrade.
+
+    Закрытые дни периода анализ читает из локальных агрегатов, открытые - загружает из itrade как раньше:
+    - звонки сгруппированы по (дата звонка, оператор, CRM лид) внутри ячейки (категория, оффер, вебмастер,
+      оператор LV, рекламодатель) с максимальным billsec - движок получает их как обычные строки звонков
+      и группирует так же, как исходные звонки;
+    - лиды и контейнер лидов сведены в счетчики по ячейкам.
+    Ячейка содержит все поля фильтров анализа, поэтому фильтры применяются к фактам без потерь.
+    """
+    ENABLED = getattr(settings, 'KPI_FACTS_ENABLED', True)
+    # Сегодня и OPEN_DAYS - 1 предыдущих дней открыты: статусы лидов еще меняются
+    OPEN_DAYS = getattr(settings, 'KPI_FACTS_OPEN_DAYS', 3)
+    HISTORY_DAYS = getattr(settings, 'KPI_FACTS_HISTORY_DAYS', 120)
+    # Построенный день пересобирается, если его лиды изменились (поздние отмены и выкупы) после сборки;
+    # запас покрывает изменения, попавшие между загрузкой строк дня и сохранением built_at
+    CHANGE_OVERLAP_SECONDS = getattr(settings, 'KPI_FACTS_CHANGE_OVERLAP_SECONDS', 60)
+    MAX_DAYS_PER_RUN = 10
+    BATCH_SIZE = 5000
+
+    @staticmethod
+    def _parse_day(value: Any) -> Optional[date]:
+        """Дата фильтра без времени; период с временем целиком загружается из itrade"""
+        try:
+            return datetime.strptime(str(value), '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _restore_id(value: Optional[str]) -> Any:
+        # Идентификаторы itrade целочисленные (см. Affiliate.external_id), в фактах хранятся строкой
+        if value is not None and value.isdigit():
+            return int(value)
+        return value
+
+    @staticmethod
+    def _to_str(value: Any) -> Optional[str]:
+        return str(value) if value is not None else None
+
+    # === Построение ===
+
+    @staticmethod
+    def _aggregate_calls(day: date, rows: Iterable[Any]) -> List[KpiCallGroupFact]:
+        groups: Dict[tuple, KpiCallGroupFact] = {}
+        for seq, r in enumerate(rows):
+            try:
+                call = Call(r)
+            except Exception as e:
+                logger.warning(f"Skip call: {e}")
+                continue
+            key = (call.calldate_date_str, call.operator_id, call.crm_lead_id, r.get('category_name'),
+                   call.offer_id, call.affiliate_id, r.get('lv_username'), r.get('subsystem_name'))
+            fact = groups.get(key)
+            if fact is None:
+                groups[key] = KpiCallGroupFact(
+                    day=day, seq=seq, calldate=call.calldate_str or '',
+                    category_name=r.get('category_name'), offer_id=call.offer_id, offer_name=r.get('offer_name'),
+                    affiliate_id=KpiFactService._to_str(call.affiliate_id), lv_username=r.get('lv_username'),
+                    subsystem_name=r.get('subsystem_name'), operator_id=call.operator_id,
+                    crm_lead_id=call.crm_lead_id, first_call_id=call.id, billsec=call.billsec, calls_count=1,
+                )
+            else:
+                fact.calls_count += 1
+                if call.billsec > fact.billsec:
+                    fact.billsec = call.billsec
+        return list(groups.values())
+
+    @staticmethod
+    def _aggregate_leads(day: date, rows: Iterable[Any]) -> List[KpiLeadFact]:
+        cells: Dict[tuple, KpiLeadFact] = {}
+        seen: Dict[tuple, set] = {}
+        for r in rows:
+            offer_id = r.get('offer_id')
+            key = (r.get('category_name', 'No category'), offer_id, r.get('aff_id'),
+                   r.get('lv_username', 'No operator'), r.get('subsystem_name'))
+            fact = cells.get(key)
+            if fact is None:
+                fact = cells[key] = KpiLeadFact(
+                    day=day, category_name=key[0], offer_id=offer_id, offer_name=r.get('offer_name'),
+                    aff_id=KpiFactService._to_str(key[2]), lv_username=key[3], subsystem_name=key[4],
+                )
+                seen[key] = set()
+            # Каждая строка учитывается в контейнере элемента, как в CategoryItem.push_lead
+            fact.leads_count += 1
+
+            try:
+                lead = Lead(r, int(offer_id) if str(offer_id).isdigit() else None)
+            except Exception as e:
+                logger.warning(f"Skip lead: {e}")
+                continue
+            # Повтор CRM лида не учитывается, как в Stat.push_lead движка
+            if lead.crm_lead_id in seen[key]:
+                continue
+            seen[key].add(lead.crm_lead_id)
+            lead.finalize(DBService.is_fake_approve)
+            if lead.is_salary_pay and lead.offer_id:
+                fact.salary_leads_count += 1
+        return list(cells.values())
+
+    @staticmethod
+    def _aggregate_container(day: date, rows: Iterable[Any]) -> List[KpiLeadContainerFact]:
+        cells: Dict[tuple, KpiLeadContainerFact] = {}
+        for r in rows:
+            key = (r.get('category_name', 'No category'), r.get('offer_id'), r.get('aff_id'),
+                   r.get('lv_username'), r.get('subsystem_name'))
+            fact = cells.get(key)
+            if fact is None:
+                fact = cells[key] = KpiLeadContainerFact(
+                    day=day, category_name=key[0], offer_id=key[1], aff_id=KpiFactService._to_str(key[2]),
+                    lv_username=key[3], subsystem_name=key[4],
+                )
+            non_trash, approved, buyout = Stat.container_row_counts(r)
+            fact.raw_count += 1
+            fact.non_trash_count += non_trash
+            fact.approved_count += approved
+            fact.buyout_count += buyout
+        return list(cells.values())
+
+    @staticmethod
+    def build_day(day: date) -> KpiFactDay:
+        """Пересобирает факты одного дня: загрузка из itrade без фильтров и замена строк дня в транзакции"""
+        start = time.time()
+        day_str = day.strftime('%Y-%m-%d')
+        filters = {'date_from': day_str, 'date_to': day_str}
+
+        call_groups = KpiFactService._aggregate_calls(day, DBService.get_calls(filters, stream=True, compact=True))
+        lead_facts = KpiFactService._aggregate_leads(day, DBService.get_leads(filters, stream=True, compact=True))
+        container_facts = KpiFactService._aggregate_container(day, DBService.get_leads_container(filters,
+                                                                                                 compact=True))
+
+        with transaction.atomic():
+            for model in (KpiCallGroupFact, KpiLeadFact, KpiLeadContainerFact):
+                model.objects.filter(day=day).delete()
+            KpiCallGroupFact.objects.bulk_create(call_groups, batch_size=KpiFactService.BATCH_SIZE)
+            KpiLeadFact.objects.bulk_create(lead_facts, batch_size=KpiFactService.BATCH_SIZE)
+            KpiLeadContainerFact.objects.bulk_create(container_facts, batch_size=KpiFactService.BATCH_SIZE)
+            fact_day, _ = KpiFactDay.objects.update_or_create(day=day, defaults={
+                'call_groups_count': len(call_groups),
+                'lead_facts_count': len(lead_facts),
+                'container_facts_count': len(container_facts),
+                'build_seconds': round(time.time() - start, 3),
+            })
+
+        logger.info(f">>> Факты KPI за {day_str} построены за {fact_day.build_seconds:.2f}с: "
+                    f"групп звонков {len(call_groups)}, лидов {len(lead_facts)}, контейнеров {len(container_facts)}")
+        return fact_day
+
+    @staticmethod
+    def last_closed_day() -> date:
+        return datetime.now().date() - timedelta(days=KpiFactService.OPEN_DAYS)
+
+    @staticmethod
+    def _server_time(value: datetime) -> str:
+        """Время в формате itrade со сдвигом +3 часа (как changed_since и changed_at в DBService)"""
+        return (value + timedelta(hours=3)).strftime('%Y-%m-%d %H:%M:%S')
+
+    @staticmethod
+    def changed_days(built: Dict[date, tuple]) -> set:
+        """Построенные дни, лиды которых создавались или меняли статус после сборки дня.
+
+        built - {день: (built_at, build_seconds)}. Изменение лида затрагивает день его создания
+        (контейнер лидов) и день подтверждения (лиды); звонки после закрытия дня не меняются.
+        """
+        if not built:
+            return set()
+        overlap = timedelta(seconds=KpiFactService.CHANGE_OVERLAP_SECONDS)
+        # Граница изменений дня: начало его сборки с запасом
+        since = {day: KpiFactService._server_time(built_at - timedelta(seconds=build_seconds or 0) - overlap)
+                 for day, (built_at, build_seconds) in built.items()}
+
+        days = set()
+        for row in DBService.get_changed_lead_days(min(since.values())):
+            for day in (row['created_day'], row['approved_day']):
+                if day in since and row['changed_at'] >= since[day]:
+                    days.add(day)
+        return days
+
+    @staticmethod
+    def days_to_build() -> List[date]:
+        """Недостающие закрытые дни за HISTORY_DAYS и дни с изменившимися после сборки лидами, новые первыми"""
+        first_day = datetime.now().date() - timedelta(days=KpiFactService.HISTORY_DAYS)
+        last_day = KpiFactService.last_closed_day()
+
+        built = {day: (built_at, build_seconds) for day, built_at, build_seconds in KpiFactDay.objects.filter(
+            day__range=(first_day, last_day)).values_list('day', 'built_at', 'build_seconds')}
+        days = KpiFactService.changed_days(built)
+        day = last_day
+        while day >= first_day:
+            if day not in built:
+                days.add(day)
+            day -= timedelta(days=1)
+        return sorted(days, reverse=True)
+
+    @staticmethod
+    def build_incremental(max_days: Optional[int] = None) -> List[date]:
+        days = KpiFactService.days_to_build()[:max_days or KpiFactService.MAX_DAYS_PER_RUN]
+        for day in days:
+            KpiFactService.build_day(day)
+        return days
+
+    @staticmethod
+    def build_range(date_from: date, date_to: date) -> List[date]:
+        """Строит факты закрытых дней периода (открытые дни пропускаются)"""
+        date_to = min(date_to, KpiFactService.last_closed_day())
+        days = []
+        day = date_from
+        while day <= date_to:
+            KpiFactService.build_day(day)
+            days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    # === Чтение ===
+
+    @staticmethod
+    def closed_days(filters: Dict) -> List[date]:
+        """Закрытые дни с фактами - непрерывный префикс периода фильтра"""
+        date_from = KpiFactService._parse_day(filters.get('date_from'))
+        date_to = KpiFactService._parse_day(filters.get('date_to'))
+        if not date_from or not date_to:
+            return []
+
+        last_day = min(date_to, KpiFactService.last_closed_day())
+        if last_day < date_from:
+            return []
+        built = set(KpiFactDay.objects.filter(day__range=(date_from, last_day)).values_list('day', flat=True))
+
+        days = []
+        day = date_from
+        while day <= last_day and day in built:
+            days.append(day)
+            day += timedelta(days=1)
+        return days
+
+    @staticmethod
+    def _filter_facts(queryset, filters: Dict, aff_field: str):
+        """Те же фильтры, что в запросах DBService, по колонкам ячейки"""
+        categories = filters.get('category', [])
+        offer_ids = filters.get('offer_id', [])
+        aff_ids = filters.get('aff_id', [])
+        lv_ops = [op.lower() for op in filters.get('lv_op', [])]
+        advertiser = [a.lower() for a in filters.get('advertiser', [])]
+
+        if categories and categories != ['']:
+            queryset = queryset.filter(category_name__in=categories)
+        if offer_ids and offer_ids != ['']:
+            queryset = queryset.filter(offer_id__in=[int(o) for o in offer_ids if str(o).isdigit()])
+        if aff_ids and aff_ids != ['']:
+            queryset = queryset.filter(**{f'{aff_field}__in': [str(a) for a in aff_ids]})
+        if lv_ops and lv_ops != ['']:
+            queryset = queryset.annotate(lv_username_lower=Lower('lv_username')).filter(lv_username_lower__in=lv_ops)
+        if advertiser and advertiser != ['']:
+            queryset = queryset.annotate(subsystem_lower=Lower('subsystem_name')).filter(
+                subsystem_lower__in=advertiser)
+        return queryset
+
+    @staticmethod
+    def _call_rows(queryset) -> Iterator[Dict[str, Any]]:
+        """Группы звонков в формате строк get_calls; порядок - как у исходных звонков"""
+        for fact in queryset.order_by('day', 'seq').values().iterator(chunk_size=KpiFactService.BATCH_SIZE):
+            yield {
+                'call_eff_id': fact['first_call_id'],
+                'call_eff_crm_id': None,
+                'call_eff_offer_id': fact['offer_id'],
+                'offer_name': fact['offer_name'],
+                'call_eff_uniqueid': f"fact-{fact['id']}",
+                'call_eff_calldate': fact['calldate'],
+                'call_eff_crm_lead_id': fact['crm_lead_id'],
+                'call_eff_operator_id': fact['operator_id'],
+                'call_eff_billsec': fact['billsec'],
+                'call_eff_billsec_exact': None,
+                'call_eff_robo_detected': 0,
+                'lv_username': fact['lv_username'],
+                'category_name': fact['category_name'],
+                'call_eff_affiliate_id': KpiFactService._restore_id(fact['affiliate_id']),
+                'subsystem_name': fact['subsystem_name'],
+                'call_eff_calls_count': fact['calls_count'],
+            }
+
+    @staticmethod
+    def load_facts(filters: Dict, date_from: date, date_to: date) -> Dict[str, Any]:
+        days = {'day__range': (date_from, date_to)}
+        calls = KpiFactService._filter_facts(KpiCallGroupFact.objects.filter(**days), filters, 'affiliate_id')
+        leads = KpiFactService._filter_facts(KpiLeadFact.objects.filter(**days), filters, 'aff_id')
+        container = KpiFactService._filter_facts(KpiLeadContainerFact.objects.filter(**days), filters, 'aff_id')
+        return {
+            'calls': KpiFactService._call_rows(calls),
+            'lead_facts': list(leads.order_by('day', 'id').values()),
+            'leads_container_facts': list(container.values()),
+        }
+
+    @staticmethod
+    def fetch_analysis_data(filters: Dict, stream: Optional[bool] = None, compact: bool = True,
+                            progress: Optional[Callable[..., None]] = None) -> Dict[str, Any]:
+        """DBService.fetch_analysis_data, где закрытые дни периода берутся из таблиц фактов.
+
+        Из itrade загружаются планы, офферы и строки только открытой части периода. Дополнительно
+        возвращаются lead_facts, leads_container_facts (для OpAnalyzeKPI.run_analysis_with_data) и fact_days.
+        """
+        days = KpiFactService.closed_days(filters) if KpiFactService.ENABLED else []
+        if not days:
+            data = DBService.fetch_analysis_data(filters, stream=stream, compact=compact, progress=progress)
+            data.update({'lead_facts': [], 'leads_container_facts': [], 'fact_days': 0})
+            return data
+
+        start = time.time()
+        facts = KpiFactService.load_facts(filters, days[0], days[-1])
+        facts_seconds = round(time.time() - start, 3)
+
+        live_filters = dict(filters, date_from=(days[-1] + timedelta(days=1)).strftime('%Y-%m-%d'))
+        data = DBService.fetch_analysis_data(live_filters, stream=stream, compact=compact, progress=progress)
+        data['calls'] = chain(facts['calls'], data['calls'])
+        data['lead_facts'] = facts['lead_facts']
+        data['leads_container_facts'] = facts['leads_container_facts']
+        data['fact_days'] = len(days)
+        data['timings']['facts'] = facts_seconds
+
+        logger.info(f">>> Закрытые дни {days[0]} - {days[-1]} ({len(days)}) взяты из фактов за {facts_seconds:.2f}с, "
+                    f"из itrade загружен период с {live_filters['date_from']}")
+        return data
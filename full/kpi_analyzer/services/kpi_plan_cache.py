@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Any, Optional, Tuple
+
+from django.conf import settings
+
+from .db_service import DBService
+from .engine_call_efficiency2 import KpiList, Kpi
+
+logger = logging.getLogger(__name__)
+
+
+class KpiPlanCache:
+    """Общий для процесса KpiList, построенный по таблице планов partners_tlofferplanneddataperiod.
+
+    Планы меняются редко, поэтому таблица не перечитывается в каждом анализе: не чаще раза в
+    CHECK_SECONDS сверяется подпись таблицы (MAX(updated_at), COUNT(*)). Если она изменилась,
+    дочитываются только строки с updated_at не раньше прежнего максимума и строится новый KpiList,
+    в котором заново собраны только ключи (вебмастер-оффер или оффер) измененных строк - записи
+    остальных ключей общие с прежним списком (KpiList.without). Строки, удаленные из таблицы (число строк не сошлось), и изменения в
+    partners_affiliate подхватываются полной перезагрузкой - при расхождении и раз в FULL_RELOAD_SECONDS.
+
+    Проверка и дозагрузка выполняются в фоновом потоке, анализ получает текущий KpiList сразу;
+    синхронно планы загружаются только при первом обращении в процессе. KpiList не изменяется после
+    построения: каждый анализ получает view() с собственным кэшем find_kpi.
+    """
+    CHECK_SECONDS = getattr(settings, 'KPI_PLAN_CHECK_SECONDS', 30)
+    FULL_RELOAD_SECONDS = getattr(settings, 'KPI_PLAN_FULL_RELOAD_SECONDS', 60 * 60)
+
+    _lock = threading.Lock()
+    # Первая загрузка процесса - одна на все параллельные анализы
+    _load_lock = threading.Lock()
+    _refreshing = False
+    # Строки планов по id, ключи индексов KpiList для планов в индексах (см. _index_keys), подпись
+    # таблицы, построенный KpiList и время проверок
+    _rows: Dict[Any, Dict] = {}
+    _keys: Dict[Any, Optional[Tuple[bool, str]]] = {}
+    _signature: Optional[Tuple[Any, int]] = None
+    _kpi_list: Optional[KpiList] = None
+    _checked_at = 0.0
+    _loaded_at = 0.0
+
+    @staticmethod
+    def build_kpi_list(kpi_plans_data: List[Dict], kpi_list: Optional[KpiList] = None) -> KpiList:
+        kpi_list = kpi_list if kpi_list is not None else KpiList()
+        for plan in kpi_plans_data or []:
+            try:
+                kpi_list.push_kpi(plan)
+            except Exception as e:
+                logger.error(f"KPI load error: {e}")
+        return kpi_list
+
+    @staticmethod
+    def _plan_sort_key(row: Dict):
+        # Как ORDER BY period_date: планы без даты первыми, при равных датах - по id
+        period_date = row.get('call_eff_period_date')
+        return period_date is not None, str(period_date or ''), row.get('call_eff_kpi_id')
+
+    @staticmethod
+    def _plan_key(row: Dict) -> Optional[Tuple[bool, str]]:
+        # Строка, которая не разбирается в Kpi, в KpiList не попадает (см. build_kpi_list)
+        try:
+            return KpiList.index_key(Kpi(row))
+        except Exception:
+            return None
+
+    @staticmethod
+    def _index_keys(kpi_list: KpiList, only: Optional[set] = None) -> Dict[Any, Tuple[bool, str]]:
+        """id плана -> ключ индекса для планов в индексах KpiList (планы без даты в них не попадают)"""
+        keys = {}
+        for by_aff, index in ((True, kpi_list.index_by_aff_offer), (False, kpi_list.index_by_offer)):
+            for key, (_, kpis) in index.items():
+                if only is None or (by_aff, key) in only:
+                    for kpi in kpis:
+                        keys[kpi.id] = (by_aff, key)
+        return keys
+
+    @staticmethod
+    def _read_signature() -> Tuple[Any, int]:
+        row = DBService._execute_query(
+            "SELECT MAX(updated_at) AS max_updated_at, COUNT(*) AS rows_count "
+            "FROM partners_tlofferplanneddataperiod", [], name='kpi_plans_signature')[0]
+        return row['max_updated_at'], int(row['rows_count'] or 0)
+
+    @staticmethod
+    def _refresh(force_full: bool = False):
+        started = time.time()
+        signature = KpiPlanCache._read_signature()
+        if not force_full and signature == KpiPlanCache._signature:
+            KpiPlanCache._checked_at = started
+            return
+
+        previous = KpiPlanCache._signature
+        full = force_full or previous is None or previous[0] is None or KpiPlanCache._kpi_list is None
+        if not full:
+            changed = DBService.get_kpi_plans_data(updated_since=previous[0])
+            rows = dict(KpiPlanCache._rows)
+            rows.update((row['call_eff_kpi_id'], row) for row in changed)
+            if len(rows) != signature[1]:
+                # Удаленные строки по updated_at не найти - перечитываем таблицу целиком
+                logger.info(f"Планы KPI: строк {len(rows)} вместо {signature[1]}, полная перезагрузка")
+                full = True
+            else:
+                # Заново собираются ключи измененных строк: прежний ключ строки и новый
+                keys = dict(KpiPlanCache._keys)
+                affected = set()
+                for row in changed:
+                    kpi_id = row['call_eff_kpi_id']
+                    affected.add(keys.pop(kpi_id, None))
+                    affected.add(KpiPlanCache._plan_key(row))
+                affected.discard(None)
+                changed_ids = {row['call_eff_kpi_id'] for row in changed}
+                plans = [rows[kpi_id] for kpi_id, key in keys.items() if key in affected]
+                plans.extend(rows[kpi_id] for kpi_id in changed_ids)
+                kpi_list = KpiPlanCache.build_kpi_list(sorted(plans, key=KpiPlanCache._plan_sort_key),
+                                                       KpiPlanCache._kpi_list.without(affected))
+                keys.update(KpiPlanCache._index_keys(kpi_list, affected))
+                logger.info(f"Планы KPI: дочитано измененных строк: {len(changed)}, "
+                            f"пересобрано ключей: {len(affected)} ({len(plans)} планов)")
+        if full:
+            rows = {row['call_eff_kpi_id']: row for row in DBService.get_kpi_plans_data()}
+            kpi_list = KpiPlanCache.build_kpi_list(sorted(rows.values(), key=KpiPlanCache._plan_sort_key))
+            keys = KpiPlanCache._index_keys(kpi_list)
+
+        with KpiPlanCache._lock:
+            KpiPlanCache._rows = rows
+            KpiPlanCache._keys = keys
+            KpiPlanCache._signature = signature
+            KpiPlanCache._kpi_list = kpi_list
+            KpiPlanCache._checked_at = started
+            if full:
+                KpiPlanCache._loaded_at = started
+        logger.info(f">>> KpiList планов построен ({'полностью' if full else 'по изменениям'}): "
+                    f"{len(rows)} строк за {time.time() - started:.2f}с")
+
+    @staticmethod
+    def _refresh_in_background(force_full: bool):
+        try:
+            KpiPlanCache._refresh(force_full)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить планы KPI, используется прежний KpiList: {e}")
+        finally:
+            with KpiPlanCache._lock:
+                KpiPlanCache._refreshing = False
+
+    @staticmethod
+    def kpi_list() -> KpiList:
+        """KpiList для анализа: общий построенный список с собственным кэшем поиска"""
+        now = time.time()
+        with KpiPlanCache._lock:
+            kpi_list = KpiPlanCache._kpi_list
+            due = now - KpiPlanCache._checked_at >= KpiPlanCache.CHECK_SECONDS
+            force_full = now - KpiPlanCache._loaded_at >= KpiPlanCache.FULL_RELOAD_SECONDS
+            start_background = kpi_list is not None and due and not KpiPlanCache._refreshing
+            if start_background:
+                KpiPlanCache._refreshing = True
+
+        if kpi_list is None:
+            # Первое обращение в процессе: загрузка в запросе
+            with KpiPlanCache._load_lock:
+                if KpiPlanCache._kpi_list is None:
+                    KpiPlanCache._refresh(force_full=True)
+            return KpiPlanCache._kpi_list.view()
+
+        if start_background:
+            threading.Thread(target=KpiPlanCache._refresh_in_background, args=(force_full,),
+                             name='kpi-plan-refresh', daemon=True).start()
+        return kpi_list.view()
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        with KpiPlanCache._lock:
+            signature = KpiPlanCache._signature
+            return {
+                'rows': len(KpiPlanCache._rows),
+                'max_updated_at': str(signature[0]) if signature else None,
+                'checked_seconds_ago': round(time.time() - KpiPlanCache._checked_at, 1)
+                if KpiPlanCache._checked_at else None,
+                'loaded_seconds_ago': round(time.time() - KpiPlanCache._loaded_at, 1)
+                if KpiPlanCache._loaded_at else None,
+            }
+
@@ -0,0 +1,142 @@
+import logging
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from typing import Dict, Any, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ParallelFinalize:
+    """Финализация категорий kpi_analyzer.Stat в пуле процессов.
+
+    Категории независимы, общий у них только KpiList (только чтение). Рабочий процесс получает
+    категорию и KpiList (pickle), финализирует категорию и возвращает ее без принятых строк -
+    сгруппированных звонков и лидов движка, которые после финализации не используются. Родитель
+    подменяет категории результатами.
+
+    Пул создается вызовом start() - в воркерах Celery по сигналу worker_process_init (см.
+    kpi_analyzer_project/celery.py). Процессы пула порождает сервер forkserver - отдельный,
+    заново запущенный интерпретатор без потоков, поэтому потоки процесса анализа (пулы загрузки
+    itrade, обновление KpiPlanCache) и их блокировки в рабочие процессы не попадают. В процессах
+    без пула (веб-процесс) категории финализируются последовательно, в том числе при parallel=True.
+
+    Включается, когда в анализе не меньше MIN_ROWS групп звонков и лидов, а в процессе запущен пул.
+    При любой ошибке пула категории финализируются последовательно, как обычно.
+    """
+    MIN_ROWS = getattr(settings, 'KPI_PARALLEL_FINALIZE_MIN_ROWS', 200000)
+    WORKERS = getattr(settings, 'KPI_PARALLEL_FINALIZE_WORKERS', min(os.cpu_count() or 1, 8))
+
+    # Пул текущего процесса (см. start); дочерние процессы его не наследуют
+    _executor: Optional[ProcessPoolExecutor] = None
+    _executor_pid: Optional[int] = None
+
+    @staticmethod
+    def start():
+        """Создает пул финализации текущего процесса (воркер Celery)"""
+        if ParallelFinalize.WORKERS < 2 or 'forkserver' not in multiprocessing.get_all_start_methods():
+            return
+        ParallelFinalize._executor = ProcessPoolExecutor(
+            max_workers=ParallelFinalize.WORKERS, mp_context=multiprocessing.get_context('forkserver'),
+            initializer=ParallelFinalize._init_worker)
+        ParallelFinalize._executor_pid = os.getpid()
+
+    @staticmethod
+    def _init_worker():
+        # Рабочий процесс - новый интерпретатор: модели и настройки нужны для распаковки категорий
+        import django
+        django.setup()
+
+    @staticmethod
+    def _discard():
+        """Пул сломан (упал рабочий процесс) - закрывается, следующий анализ создаст новый"""
+        executor, ParallelFinalize._executor = ParallelFinalize._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def category_rows(category) -> int:
+        engine_stat = category.kpi_stat.stat
+        return len(engine_stat.calls_group) + len(engine_stat.leads)
+
+    @staticmethod
+    def available() -> bool:
+        if ParallelFinalize._executor_pid != os.getpid():
+            return False
+        if ParallelFinalize._executor is None:
+            ParallelFinalize.start()
+        return ParallelFinalize._executor is not None
+
+    @staticmethod
+    def should_run(stat, parallel: Optional[bool] = None) -> bool:
+        if parallel is False or len(stat.category) < 2 or not ParallelFinalize.available():
+            return False
+        if parallel:
+            return True
+        return sum(map(ParallelFinalize.category_rows, stat.category.values())) >= ParallelFinalize.MIN_ROWS
+
+    @staticmethod
+    def strip_rows(category):
+        """Освобождает принятые строки финализированной категории (группы звонков и лиды движка)"""
+        for item in chain([category], category.offer.values(), category.aff.values(), category.operator.values()):
+            item.kpi_stat.stat.calls_group = {}
+            item.kpi_stat.stat.leads = {}
+
+    @staticmethod
+    def _finalize_category(payload: bytes, kpi_list: bytes) -> bytes:
+        """Выполняется в рабочем процессе: финализирует категорию и отдает ее без принятых строк"""
+        category = pickle.loads(payload)
+        category.finalize(pickle.loads(kpi_list))
+
+        ParallelFinalize.strip_rows(category)
+        return pickle.dumps(category, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def _dump_category(category) -> bytes:
+        # Общий индекс офферов содержит офферы всех категорий - в рабочий процесс не передается
+        offer_index, category.offer_index = category.offer_index, None
+        try:
+            return pickle.dumps(category, pickle.HIGHEST_PROTOCOL)
+        finally:
+            category.offer_index = offer_index
+
+    @staticmethod
+    def run(stat) -> bool:
+        """Финализирует все категории stat в пуле процессов; False - не получилось, нужен обычный путь"""
+        start = time.time()
+        # Тяжелые категории первыми - пул раздает задачи по мере освобождения процессов
+        names = sorted(stat.category, key=lambda name: ParallelFinalize.category_rows(stat.category[name]),
+                       reverse=True)
+        workers = min(ParallelFinalize.WORKERS, len(names))
+        results: Dict[str, Any] = {}
+
+        try:
+            kpi_list = pickle.dumps(stat.kpi_list, pickle.HIGHEST_PROTOCOL)
+            futures = {name: ParallelFinalize._executor.submit(
+                ParallelFinalize._finalize_category, ParallelFinalize._dump_category(stat.category[name]), kpi_list)
+                for name in names}
+            for name, future in futures.items():
+                results[name] = pickle.loads(future.result())
+        except Exception as e:
+            logger.warning(f"Параллельная финализация не удалась, финализация в текущем процессе: {e}")
+            if isinstance(e, BrokenProcessPool):
+                ParallelFinalize._discard()
+            return False
+
+        stat.offer_index.clear()
+        for name in names:
+            category = results[name]
+            category.offer_index = stat.offer_index
+            for key, offer in category.offer.items():
+                stat.offer_index.setdefault(key, []).append(offer)
+            stat.category[name] = category
+
+        logger.info(f">>> Категории финализированы в {workers} процессах за {time.time() - start:.2f}с: "
+                    f"{len(names)} категорий")
+        return True
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import zlib
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Any, Iterable, Optional
+
+import msgpack
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .analysis_cache import AnalysisCache
+
+logger = logging.getLogger(__name__)
+
+
+class PartitionCache:
+    """Кэш строк запросов itrade по дням (партициям) в django cache (redis).
+
+    Кэшируются только закрытые дни: строки открытых дней (сегодня и OPEN_DAYS - 1 предыдущих)
+    еще меняются и всегда загружаются из itrade. Строки хранятся компактно - список колонок и
+    кортежи значений в msgpack, сжатые zlib. Ошибки кэша не прерывают загрузку.
+    """
+    KEY_PREFIX = 'kpi_partition'
+    # Увеличить при изменении набора колонок или условий запросов
+    VERSION = 2
+
+    ENABLED = getattr(settings, 'KPI_PARTITION_CACHE_ENABLED', True)
+    OPEN_DAYS = getattr(settings, 'KPI_PARTITION_OPEN_DAYS', 3)
+    # Закрытые дни тоже изредка меняются (поздние отмены и выкупы) - запись живет сутки
+    TTL = getattr(settings, 'KPI_PARTITION_TTL', 24 * 60 * 60)
+
+    @staticmethod
+    def is_closed(day: date) -> bool:
+        return day <= datetime.now().date() - timedelta(days=PartitionCache.OPEN_DAYS)
+
+    @staticmethod
+    def make_key(name: str, day: date, filters: Dict) -> str:
+        """Ключ партиции: запрос + день + хэш фильтров без дат"""
+        normalized = AnalysisCache.normalize_filters(filters)
+        for key in AnalysisCache.DATE_FILTERS:
+            normalized.pop(key, None)
+        payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False, cls=DjangoJSONEncoder)
+        digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+        return f'{PartitionCache.KEY_PREFIX}:v{PartitionCache.VERSION}:{name}:{day.isoformat()}:{digest}'
+
+    @staticmethod
+    def _encode_value(value: Any) -> Any:
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, (date, datetime)):
+            # Как MySQLdb отдает даты строкой: 'YYYY-MM-DD HH:MM:SS'
+            return str(value)
+        raise TypeError(f"Неподдерживаемый тип значения в партиции: {type(value)}")
+
+    @staticmethod
+    def pack(rows: List[Any]) -> bytes:
+        """Компактные строки (namedtuple) одного запроса -> сжатый msgpack"""
+        columns = list(rows[0]._fields) if rows else []
+        payload = msgpack.packb({'columns': columns, 'rows': [tuple(row) for row in rows]},
+                                default=PartitionCache._encode_value, use_bin_type=True)
+        return zlib.compress(payload, 1)
+
+    @staticmethod
+    def unpack(packed: bytes) -> Dict[str, Any]:
+        return msgpack.unpackb(zlib.decompress(packed), raw=False, use_list=False)
+
+    @staticmethod
+    def get_many(name: str, days: Iterable[date], filters: Dict) -> Dict[date, bytes]:
+        """Закэшированные партиции дней в сжатом виде: {день: packed}.
+
+        Распаковываются по одной (load) по мере чтения, чтобы в памяти не было всего периода сразу.
+        """
+        keys = {PartitionCache.make_key(name, day, filters): day for day in days}
+        try:
+            found = cache.get_many(list(keys))
+        except Exception as e:
+            logger.warning(f"Кэш партиций недоступен: {e}")
+            return {}
+        return {keys[key]: packed for key, packed in found.items()}
+
+    @staticmethod
+    def load(name: str, day: date, packed: bytes) -> Optional[Dict[str, Any]]:
+        """Распакованная партиция {'columns': [...], 'rows': (...)}; None - запись повреждена"""
+        try:
+            return PartitionCache.unpack(packed)
+        except Exception as e:
+            logger.warning(f"Поврежденная партиция {name} за {day}: {e}")
+            return None
+
+    @staticmethod
+    def set(name: str, day: date, filters: Dict, rows: List[Any]):
+        try:
+            cache.set(PartitionCache.make_key(name, day, filters), PartitionCache.pack(rows), PartitionCache.TTL)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить партицию {name} за {day} в кэш: {e}")
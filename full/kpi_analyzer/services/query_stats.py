@@ -0,0 +1,222 @@
+import contextvars
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCollector:
+    """Замеры запросов одного анализа (общие для всех рабочих потоков загрузки)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries: List[Dict[str, Any]] = []
+
+    def add(self, record: Dict[str, Any]):
+        with self._lock:
+            self.queries.append(record)
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            queries = list(self.queries)
+        totals = {'count': len(queries)}
+        for field in ('server_seconds', 'fetch_seconds', 'build_seconds', 'rows', 'bytes'):
+            values = [q[field] for q in queries if q.get(field) is not None]
+            totals[field] = round(sum(values), 3) if values else None
+        return {'totals': totals, 'queries': queries}
+
+
+class QueryStats:
+    """Замеры запросов DBService к itrade: время сервера (execute до первой строки), чтения строк
+    (передача и разбор драйвером), построения строк Python, объем переданных данных.
+
+    Замеры текущего анализа собираются в QueryCollector (см. collect), сводные по имени запроса -
+    в счетчиках django cache для AdminStatsView. Для запросов дольше EXPLAIN_SECONDS (по умолчанию
+    выключено) сохраняется план EXPLAIN FORMAT=JSON. Ошибки замеров не прерывают запросы.
+
+    В redis замер записывается одним pipeline: INCRBY счетчиков, SADD имени запроса и LPUSH/LTRIM
+    медленного запроса - без чтения и перезаписи списков, которые теряли замеры параллельных воркеров.
+    """
+    KEY_PREFIX = 'kpi_query_stats'
+    # Порог (секунды) для сохранения плана запроса; None - планы не собираются
+    EXPLAIN_SECONDS = getattr(settings, 'KPI_QUERY_EXPLAIN_SECONDS', None)
+    SLOW_QUERIES_LIMIT = 20
+    # Сводные счетчики по именам запросов: время в миллисекундах, чтобы использовать атомарный incr
+    COUNTERS = ('count', 'server_ms', 'fetch_ms', 'build_ms', 'rows', 'bytes')
+    # Множество имен запросов (SADD) и список последних медленных запросов (LPUSH/LTRIM); имена ключей
+    # отличаются от прежних ключей со списками в pickle, чтобы SADD/LPUSH не получили WRONGTYPE
+    NAMES_KEY = f'{KEY_PREFIX}:query_names'
+    SLOW_KEY = f'{KEY_PREFIX}:slow_queries'
+
+    _collector: contextvars.ContextVar = contextvars.ContextVar('kpi_query_collector', default=None)
+
+    @staticmethod
+    @contextmanager
+    def collect():
+        """Собирает замеры запросов, выполненных внутри блока (в том числе в потоках, запущенных через
+        QueryStats.submit)"""
+        collector = QueryCollector()
+        token = QueryStats._collector.set(collector)
+        try:
+            yield collector
+        finally:
+            QueryStats._collector.reset(token)
+
+    @staticmethod
+    def submit(executor, func, *args):
+        """executor.submit с передачей текущего сборщика замеров в рабочий поток"""
+        return executor.submit(contextvars.copy_context().run, func, *args)
+
+    @staticmethod
+    def bytes_sent(connection) -> Optional[int]:
+        """Счетчик байт, отправленных сервером клиенту в текущей сессии"""
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+            return int(row[1]) if row else None
+        except Exception as e:
+            logger.debug(f"Не удалось получить Bytes_sent: {e}")
+            return None
+
+    @staticmethod
+    def explain(connection, query: str, params: List[Any]) -> Optional[Any]:
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(f"EXPLAIN FORMAT=JSON {query}", params)
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.warning(f"Не удалось получить план запроса: {e}")
+            return None
+
+    @staticmethod
+    def need_explain(seconds: float) -> bool:
+        return QueryStats.EXPLAIN_SECONDS is not None and seconds >= QueryStats.EXPLAIN_SECONDS
+
+    @staticmethod
+    def _redis():
+        """Клиент redis для счетчиков, None - кэш не redis (locmem в разработке)"""
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            return None
+
+    @staticmethod
+    def _counter_key(name: str, counter: str) -> str:
+        return f'{QueryStats.KEY_PREFIX}:{name}:{counter}'
+
+    @staticmethod
+    def record(name: str, server_seconds: float, fetch_seconds: float, build_seconds: float, rows: int,
+               bytes_count: Optional[int] = None, explain: Optional[Any] = None, stream: bool = False,
+               replica: Optional[str] = None):
+        record = {
+            'name': name,
+            'replica': replica,
+            'stream': stream,
+            'server_seconds': round(server_seconds, 3),
+            'fetch_seconds': round(fetch_seconds, 3),
+            'build_seconds': round(build_seconds, 3),
+            'total_seconds': round(server_seconds + fetch_seconds + build_seconds, 3),
+            'rows': rows,
+            'bytes': bytes_count,
+        }
+        if explain is not None:
+            record['explain'] = explain
+        logger.info(f">>> Запрос '{name}' ({replica}): сервер {record['server_seconds']:.2f}с, чтение {record['fetch_seconds']:.2f}с, "
+                    f"строки {record['build_seconds']:.2f}с, строк: {rows}, байт: {bytes_count}")
+
+        collector = QueryStats._collector.get()
+        if collector is not None:
+            collector.add(record)
+
+        try:
+            deltas = {
+                'count': 1,
+                'server_ms': int(server_seconds * 1000),
+                'fetch_ms': int(fetch_seconds * 1000),
+                'build_ms': int(build_seconds * 1000),
+                'rows': rows,
+                'bytes': bytes_count or 0,
+            }
+            client = QueryStats._redis()
+            if client is None:
+                QueryStats._record_cache(name, deltas, record if explain is not None else None)
+                return
+            # Счетчики пишутся без сериализации django-redis - целые числа она хранит так же, и stats
+            # читает их через cache.get_many
+            pipeline = client.pipeline(transaction=False)
+            for counter, delta in deltas.items():
+                pipeline.incrby(cache.make_key(QueryStats._counter_key(name, counter)), delta)
+            pipeline.sadd(cache.make_key(QueryStats.NAMES_KEY), name)
+            if explain is not None:
+                slow_key = cache.make_key(QueryStats.SLOW_KEY)
+                pipeline.lpush(slow_key, json.dumps(record, default=str))
+                pipeline.ltrim(slow_key, 0, QueryStats.SLOW_QUERIES_LIMIT - 1)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статистику запросов: {e}")
+
+    @staticmethod
+    def _record_cache(name: str, deltas: Dict[str, int], slow_record: Optional[Dict[str, Any]]):
+        """Запись замера через API django cache (не redis: locmem в разработке)"""
+        for counter, delta in deltas.items():
+            key = QueryStats._counter_key(name, counter)
+            cache.add(key, 0, None)
+            cache.incr(key, delta)
+        names = cache.get(QueryStats.NAMES_KEY) or []
+        if name not in names:
+            cache.set(QueryStats.NAMES_KEY, sorted(set(names) | {name}), None)
+        if slow_record is not None:
+            slow = cache.get(QueryStats.SLOW_KEY) or []
+            cache.set(QueryStats.SLOW_KEY, ([slow_record] + slow)[:QueryStats.SLOW_QUERIES_LIMIT], None)
+
+    @staticmethod
+    def stats() -> Dict[str, Any]:
+        """Сводная статистика по именам запросов и последние медленные запросы с планами"""
+        try:
+            client = QueryStats._redis()
+            if client is None:
+                names = cache.get(QueryStats.NAMES_KEY) or []
+                slow = cache.get(QueryStats.SLOW_KEY) or []
+            else:
+                pipeline = client.pipeline(transaction=False)
+                pipeline.smembers(cache.make_key(QueryStats.NAMES_KEY))
+                pipeline.lrange(cache.make_key(QueryStats.SLOW_KEY), 0, -1)
+                members, slow_items = pipeline.execute()
+                names = sorted(member.decode() for member in members)
+                slow = [json.loads(item) for item in slow_items]
+            keys = [QueryStats._counter_key(name, counter) for name in names for counter in QueryStats.COUNTERS]
+            counters = cache.get_many(keys)
+        except Exception as e:
+            logger.warning(f"Статистика запросов недоступна: {e}")
+            return {'queries': {}, 'slow': []}
+
+        queries = {}
+        for name in names:
+            values = {counter: counters.get(QueryStats._counter_key(name, counter), 0)
+                      for counter in QueryStats.COUNTERS}
+            count = values['count'] or 1
+            queries[name] = {
+                'count': values['count'],
+                'rows': values['rows'],
+                'bytes': values['bytes'],
+                'server_seconds': round(values['server_ms'] / 1000, 3),
+                'fetch_seconds': round(values['fetch_ms'] / 1000, 3),
+                'build_seconds': round(values['build_ms'] / 1000, 3),
+                'avg_seconds': round((values['server_ms'] + values['fetch_ms'] + values['build_ms']) / 1000 / count, 3),
+            }
+        return {'queries': queries, 'slow': slow}
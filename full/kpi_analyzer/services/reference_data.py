@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceData:
+    """Справочники itrade: группы офферов, рекламодатели (subsystem), офферы, операторы LV.
+
+    Таблицы загружаются из itrade целиком и хранятся в django cache (redis) в течение TTL;
+    задача refresh_reference_data перечитывает их по расписанию, поэтому запросы справочников
+    (списки фильтров, get_offers, фильтры по именам) не обращаются к itrade. Каждый процесс держит
+    копию в памяти и сверяет ее с redis не чаще раза в LOCAL_SECONDS. У таблицы есть etag - хэш ее
+    строк, по нему эндпоинты списков отвечают 304.
+
+    Фильтры по рекламодателю и оператору задаются именами; DBService переводит их в id (resolve_ids)
+    и фильтрует по subsystem_id / operator_id, чтобы itrade использовал индексы. Если среди имен есть
+    неизвестные (например, новый оператор), таблица перечитывается, но не чаще раза в
+    MISSING_RELOAD_SECONDS.
+    """
+    KEY_PREFIX = 'kpi_reference'
+    # Увеличить при изменении колонок запросов
+    VERSION = 1
+    # Запас над расписанием обновления: при остановке celery beat справочники еще час берутся из кэша
+    TTL = getattr(settings, 'KPI_REFERENCE_TTL', 60 * 60)
+    LOCAL_SECONDS = getattr(settings, 'KPI_REFERENCE_LOCAL_SECONDS', 30)
+    MISSING_RELOAD_SECONDS = 60
+    ADVERTISER_SYSTEM = 'traffic_light'
+
+    TABLES = {
+        'group_offers': "SELECT id, name FROM partners_groupoffer ORDER BY id",
+        'subsystems': "SELECT subsystem.id, subsystem.name, subsystem.system FROM partners_subsystem subsystem "
+                      "ORDER BY subsystem.id",
+        'offers': """
+        SELECT
+            partners_offer.id as id,
+            partners_offer.name as name,
+            group_offer.name as category_name
+        FROM partners_offer
+        LEFT JOIN partners_assignedoffer assigned_offer ON assigned_offer.offer_id = partners_offer.id
+        LEFT JOIN partners_groupoffer group_offer ON assigned_offer.group_id = group_offer.id
+        ORDER BY partners_offer.id
+        """,
+        'lv_operators': "SELECT id, username AS name FROM partners_lvoperator ORDER BY id",
+    }
+
+    _lock = threading.Lock()
+    # Копии процесса: {таблица: {'etag', 'loaded_at', 'rows', 'checked_at', 'indexes'}}
+    _local: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def normalize(name: Any) -> str:
+        return str(name).strip().lower()
+
+    @staticmethod
+    def _key(table: str) -> str:
+        return f'{ReferenceData.KEY_PREFIX}:v{ReferenceData.VERSION}:{table}'
+
+    @staticmethod
+    def _load(table: str) -> Dict[str, Any]:
+        from .db_service import DBService
+
+        rows = [dict(row) for row in DBService._execute_query(ReferenceData.TABLES[table], [],
+                                                               name=f'reference_{table}')]
+        payload = json.dumps(rows, sort_keys=True, ensure_ascii=False, cls=DjangoJSONEncoder)
+        entry = {
+            'etag': hashlib.sha1(payload.encode('utf-8')).hexdigest(),
+            'loaded_at': time.time(),
+            'rows': rows,
+        }
+        try:
+            cache.set(ReferenceData._key(table), entry, ReferenceData.TTL)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить справочник {table} в кэш: {e}")
+        logger.info(f"Справочник {table} загружен из itrade: {len(rows)} строк")
+        return entry
+
+    @staticmethod
+    def _set_local(table: str, entry: Dict[str, Any]) -> Dict[str, Any]:
+        local = dict(entry, checked_at=time.time(), indexes={})
+        ReferenceData._local[table] = local
+        return local
+
+    @staticmethod
+    def _entry(table: str, reload: bool = False) -> Dict[str, Any]:
+        start = time.time()
+        local = ReferenceData._local.get(table)
+        if not reload:
+            if local is not None and start - local['checked_at'] < ReferenceData.LOCAL_SECONDS:
+                return local
+            try:
+                entry = cache.get(ReferenceData._key(table))
+            except Exception as e:
+                logger.warning(f"Кэш справочников недоступен: {e}")
+                entry = None
+            if entry is not None:
+                if local is not None and local['etag'] == entry['etag']:
+                    local['checked_at'] = start
+                    return local
+                return ReferenceData._set_local(table, entry)
+            if local is not None and start - local['loaded_at'] < ReferenceData.TTL:
+                local['checked_at'] = start
+                return local
+
+        with ReferenceData._lock:
+            # Пока ждали блокировку, таблицу мог загрузить другой поток
+            local = ReferenceData._local.get(table)
+            if local is not None and local['loaded_at'] >= start:
+                return local
+            return ReferenceData._set_local(table, ReferenceData._load(table))
+
+    @staticmethod
+    def refresh(tables: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        """Перечитывает таблицы из itrade в кэш (по расписанию); возвращает {таблица: etag}"""
+        etags = {}
+        for table in tables or ReferenceData.TABLES:
+            etags[table] = ReferenceData._entry(table, reload=True)['etag']
+        return etags
+
+    @staticmethod
+    def rows(table: str) -> List[Dict[str, Any]]:
+        return ReferenceData._entry(table)['rows']
+
+    @staticmethod
+    def _name_index(entry: Dict[str, Any]) -> Dict[str, List[int]]:
+        index = entry['indexes'].get('name')
+        if index is None:
+            index = {}
+            for row in entry['rows']:
+                if row['name'] is not None:
+                    index.setdefault(ReferenceData.normalize(row['name']), []).append(row['id'])
+            entry['indexes']['name'] = index
+        return index
+
+    @staticmethod
+    def resolve_ids(table: str, names: Iterable[Any]) -> List[int]:
+        """id записей справочника с указанными именами; пустой список - ни одно имя не найдено"""
+        names = {ReferenceData.normalize(name) for name in names}
+        entry = ReferenceData._entry(table)
+        index = ReferenceData._name_index(entry)
+        missing = [name for name in names if name not in index]
+        if missing and time.time() - entry['loaded_at'] > ReferenceData.MISSING_RELOAD_SECONDS:
+            logger.info(f"Справочник {table}: не найдены {missing[:5]}, перечитываем")
+            entry = ReferenceData._entry(table, reload=True)
+            index = ReferenceData._name_index(entry)
+        return sorted({pk for name in names for pk in index.get(name, [])})
+
+    @staticmethod
+    def _sorted_names(names: Iterable[Any]) -> List[str]:
+        return sorted({name for name in names if name}, key=lambda name: (name.lower(), name))
+
+    @staticmethod
+    def categories() -> Tuple[List[str], str]:
+        """Названия групп офферов для фильтров (без служебных) и etag"""
+        from .db_service import DBService
+
+        entry = ReferenceData._entry('group_offers')
+        names = ReferenceData._sorted_names(row['name'] for row in entry['rows']
+                                            if row['name'] not in DBService.EXCLUDED_CATEGORIES)
+        return names, entry['etag']
+
+    @staticmethod
+    def advertisers() -> Tuple[List[str], str]:
+        """Названия рекламодателей (subsystem системы traffic_light) для фильтров и etag"""
+        entry = ReferenceData._entry('subsystems')
+        names = ReferenceData._sorted_names(row['name'] for row in entry['rows']
+                                            if row['system'] == ReferenceData.ADVERTISER_SYSTEM)
+        return names, entry['etag']
+
+    @staticmethod
+    def offers(categories: Optional[List[Any]] = None, offer_ids: Optional[List[Any]] = None) -> List[Dict]:
+        """Офферы с категорией (как get_offers): без служебных категорий, с фильтрами по категориям и id"""
+        from .db_service import DBService
+
+        excluded = set(DBService.EXCLUDED_CATEGORIES)
+        category_names = {ReferenceData.normalize(c) for c in categories} if categories else None
+        ids = {str(i).strip() for i in offer_ids} if offer_ids else None
+
+        offers = []
+        for row in ReferenceData.rows('offers'):
+            category = row['category_name']
+            if category is None or category in excluded:
+                continue
+            if category_names is not None and ReferenceData.normalize(category) not in category_names:
+                continue
+            if ids is not None and str(row['id']) not in ids:
+                continue
+            offers.append(dict(row))
+        return offers
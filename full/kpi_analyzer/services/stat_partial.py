@@ -0,0 +1,255 @@
+import logging
+import zlib
+from typing import Dict, List, Any, Iterable, Optional, Union
+
+import msgpack
+
+from .engine_call_efficiency2 import KpiList, Stat as CallStat, Call, CallGroup, Lead
+from .kpi_analyzer import Stat, CategoryItem, CommonItem, LeadContainer
+from .partition_cache import PartitionCache
+
+logger = logging.getLogger(__name__)
+
+
+class StatPartial:
+    """Частичное (до финализации) состояние kpi_analyzer.Stat, которое можно сериализовать и объединять.
+
+    Анализ можно принять по частям - по дням или по воркерам, - объединить частичные состояния
+    merge и финализировать результат (finalize) с теми же числами, что и при приеме всех строк сразу.
+    Частичное состояние - словари и списки простых значений (msgpack, см. dumps / loads):
+
+        {'version': 1,
+         'categories': {категория: {'name', 'stat', 'lc', 'offer': {ключ: разрез}, 'aff': {...}, 'operator': {...}}},
+         'container': {'category': {категория: [4 счетчика]}, 'offer': {id оффера: [4 счетчика]}}}
+
+    Разрез - {'name', 'stat', 'lc'}: описание, состояние движка и счетчики LeadContainer (LC_FIELDS).
+    Состояние движка (engine_call_efficiency2.Stat):
+      - calls_group: {'дата оператор лид': [id, offer_id, affiliate_id, calldate, {uniqueid: billsec}]} -
+        атрибуты группы берутся из первого звонка, billsec по uniqueid - максимальный (как в CallGroup);
+      - leads: {crm_lead_id: [поля LEAD_FIELDS]} - повтор лида отбрасывается, как в Stat.push_lead;
+      - salary_leads: готовое число оплачиваемых лидов из таблиц фактов.
+
+    merge ассоциативен: счетчики складываются, uniqueid групп объединяются с максимумом billsec,
+    первым звонком группы считается звонок с меньшим id (в одном проходе - самый ранний, звонки
+    упорядочены по calldate), из повторяющихся лидов и описаний остается взятый из более ранней части.
+    Части по дням, объединенные по порядку, дают точно те же числа; при разбиении не по дням меняется
+    порядок групп, и суммы с плавающей точкой могут отличаться в последнем знаке.
+    Условие равенства с анализом за весь период: лиды в нем упорядочены по approved_at (как в
+    DBService.get_leads), а лиды частей разбиты по дню approved_at - тогда из повторов CRM лида
+    и там, и при объединении остается лид самого раннего дня.
+    Даты значений сериализуются строкой, как в PartitionCache.
+    """
+    VERSION = 1
+
+    LEAD_FIELDS = ('crm_lead_id', 'approved_at', 'canceled_at', 'status_verbose', 'status_group', 'operator_id',
+                   'offer_id')
+    LC_FIELDS = ('leads_non_trash_count', 'leads_approved_count', 'leads_buyout_count', 'leads_trash_count',
+                 'leads_total_count', 'leads_raw_count')
+    DIMENSIONS = ('offer', 'aff', 'operator')
+
+    @staticmethod
+    def empty() -> Dict[str, Any]:
+        return {'version': StatPartial.VERSION, 'categories': {}, 'container': {'category': {}, 'offer': {}}}
+
+    # --- Построение из Stat ---
+
+    @staticmethod
+    def _engine_partial(stat: CallStat) -> Dict[str, Any]:
+        calls_group = {}
+        for key, group in stat.calls_group.items():
+            first = next(iter(group.calls.values()))
+            billsec = {uniqueid: group.get_billsec(uniqueid) for uniqueid in group.calls}
+            calls_group[key] = [first.id, group.offer_id, group.affiliate_id, group.calldate_str, billsec]
+        leads = {crm_lead_id: [getattr(lead, name) for name in StatPartial.LEAD_FIELDS]
+                 for crm_lead_id, lead in stat.leads.items()}
+        return {'calls_group': calls_group, 'leads': leads, 'salary_leads': stat.salary_leads_aggregated}
+
+    @staticmethod
+    def _item_partial(item: Union[CategoryItem, CommonItem]) -> Dict[str, Any]:
+        return {
+            'name': item.description,
+            'stat': StatPartial._engine_partial(item.kpi_stat.stat),
+            'lc': [getattr(item.lead_container, name) for name in StatPartial.LC_FIELDS],
+        }
+
+    @staticmethod
+    def from_stat(stat: Stat, leads_container_data: Optional[List[Dict]] = None,
+                  leads_container_facts: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """Частичное состояние принятого, но не финализированного Stat и строк контейнера лидов этой части"""
+        categories = {}
+        for cat_name, category in stat.category.items():
+            partial = categories[cat_name] = StatPartial._item_partial(category)
+            for dimension in StatPartial.DIMENSIONS:
+                partial[dimension] = {key: StatPartial._item_partial(item)
+                                      for key, item in getattr(category, dimension).items()}
+
+        category_leads, offer_leads = Stat.container_counters(leads_container_data, leads_container_facts)
+        return {'version': StatPartial.VERSION, 'categories': categories,
+                'container': {'category': category_leads, 'offer': offer_leads}}
+
+    @staticmethod
+    def ingest(offers_data: Iterable[Dict], leads_data: Iterable[Dict], calls_data: Iterable[Dict],
+               leads_container_data: Optional[List[Dict]] = None, lead_facts: Optional[List[Dict]] = None,
+               leads_container_facts: Optional[List[Dict]] = None) -> Dict[str, Any]:
+        """Прием строк одной части (как OpAnalyzeKPI.run_analysis_with_data) без финализации"""
+        stat = Stat()
+        for offer in offers_data:
+            stat.push_offer(offer)
+        for fact in lead_facts or []:
+            stat.push_lead_fact(fact)
+        for lead in leads_data:
+            stat.push_lead(lead)
+        for call in calls_data:
+            stat.push_call(call)
+        return StatPartial.from_stat(stat, leads_container_data, leads_container_facts)
+
+    # --- Объединение ---
+
+    @staticmethod
+    def _add_counters(target: List[int], other: List[int]):
+        for i, count in enumerate(other):
+            target[i] += count
+
+    @staticmethod
+    def _merge_engine(target: Dict[str, Any], other: Dict[str, Any]):
+        calls_group = target['calls_group']
+        for key, group in other['calls_group'].items():
+            current = calls_group.get(key)
+            if current is None:
+                calls_group[key] = list(group[:4]) + [dict(group[4])]
+                continue
+            if group[0] is not None and (current[0] is None or group[0] < current[0]):
+                current[:4] = group[:4]
+            billsec = current[4]
+            for uniqueid, seconds in group[4].items():
+                if uniqueid not in billsec or seconds > billsec[uniqueid]:
+                    billsec[uniqueid] = seconds
+
+        leads = target['leads']
+        for crm_lead_id, lead in other['leads'].items():
+            leads.setdefault(crm_lead_id, lead)
+        target['salary_leads'] += other['salary_leads']
+
+    @staticmethod
+    def _merge_item(items: Dict[Any, Dict[str, Any]], key: Any, other: Dict[str, Any]) -> Dict[str, Any]:
+        item = items.get(key)
+        if item is None:
+            item = items[key] = {'name': other['name'], 'stat': {'calls_group': {}, 'leads': {}, 'salary_leads': 0},
+                                 'lc': [0] * len(StatPartial.LC_FIELDS)}
+        StatPartial._merge_engine(item['stat'], other['stat'])
+        StatPartial._add_counters(item['lc'], other['lc'])
+        return item
+
+    @staticmethod
+    def merge_into(target: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+        """Добавляет other в target (target изменяется, other - нет)"""
+        if other.get('version') != StatPartial.VERSION:
+            raise ValueError(f"Неподдерживаемая версия частичного состояния: {other.get('version')}")
+
+        categories = target['categories']
+        for cat_name, other_category in other['categories'].items():
+            category = StatPartial._merge_item(categories, cat_name, other_category)
+            for dimension in StatPartial.DIMENSIONS:
+                items = category.setdefault(dimension, {})
+                for key, item in other_category[dimension].items():
+                    StatPartial._merge_item(items, key, item)
+
+        for name in ('category', 'offer'):
+            counters = target['container'][name]
+            for key, other_counters in other['container'][name].items():
+                StatPartial._add_counters(counters.setdefault(key, [0, 0, 0, 0]), other_counters)
+        return target
+
+    @staticmethod
+    def merge(partials: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Объединение частей в порядке их следования (по дням - от ранних к поздним)"""
+        result = StatPartial.empty()
+        for partial in partials:
+            StatPartial.merge_into(result, partial)
+        return result
+
+    # --- Сериализация ---
+
+    @staticmethod
+    def dumps(partial: Dict[str, Any]) -> bytes:
+        payload = msgpack.packb(partial, default=PartitionCache._encode_value, use_bin_type=True)
+        return zlib.compress(payload, 1)
+
+    @staticmethod
+    def loads(packed: bytes) -> Dict[str, Any]:
+        return msgpack.unpackb(zlib.decompress(packed), raw=False, strict_map_key=False)
+
+    # --- Восстановление и финализация ---
+
+    @staticmethod
+    def _restore_engine(stat: CallStat, partial: Dict[str, Any], calls: Dict[tuple, Call], leads: Dict[tuple, Lead]):
+        # Объекты Call и Lead общие для разрезов категории, как при приеме строк
+        for key, (call_id, offer_id, affiliate_id, calldate, billsec) in partial['calls_group'].items():
+            group = None
+            for uniqueid, seconds in billsec.items():
+                call_key = (call_id, offer_id, affiliate_id, calldate, uniqueid, seconds)
+                call = calls.get(call_key)
+                if call is None:
+                    call = calls[call_key] = Call({
+                        'call_eff_id': call_id,
+                        'call_eff_offer_id': offer_id,
+                        'call_eff_affiliate_id': affiliate_id,
+                        'call_eff_calldate': calldate,
+                        'call_eff_uniqueid': uniqueid,
+                        'call_eff_billsec': seconds,
+                    })
+                if group is None:
+                    group = stat.calls_group[key] = CallGroup(key, call, stat.call_efficiency_second)
+                group.push_call(call)
+
+        for values in partial['leads'].values():
+            lead_key = tuple(values)
+            lead = leads.get(lead_key)
+            if lead is None:
+                fields = dict(zip(StatPartial.LEAD_FIELDS, values))
+                lead = leads[lead_key] = Lead({f'call_eff_{name}': value for name, value in fields.items()},
+                                              fields['offer_id'])
+            stat.leads[lead.crm_lead_id] = lead
+        stat.salary_leads_aggregated = partial['salary_leads']
+
+    @staticmethod
+    def _restore_item(item: Union[CategoryItem, CommonItem], partial: Dict[str, Any],
+                      calls: Dict[tuple, Call], leads: Dict[tuple, Lead]):
+        StatPartial._restore_engine(item.kpi_stat.stat, partial['stat'], calls, leads)
+        lead_container = LeadContainer()
+        for name, count in zip(StatPartial.LC_FIELDS, partial['lc']):
+            setattr(lead_container, name, count)
+        item.lead_container = lead_container
+
+    @staticmethod
+    def to_stat(partial: Dict[str, Any]) -> Stat:
+        """Stat с принятыми данными части (без контейнера лидов - его счетчики применяет finalize)"""
+        stat = Stat()
+        for cat_name, category_partial in partial['categories'].items():
+            category = stat._get_category(cat_name)
+            category.description = category_partial['name']
+            calls: Dict[tuple, Call] = {}
+            leads: Dict[tuple, Lead] = {}
+            StatPartial._restore_item(category, category_partial, calls, leads)
+            for key, item_partial in category_partial['offer'].items():
+                StatPartial._restore_item(category._get_offer(key, item_partial['name']), item_partial, calls, leads)
+            for dimension in ('aff', 'operator'):
+                items = getattr(category, dimension)
+                for key, item_partial in category_partial[dimension].items():
+                    item = items[key] = CommonItem(key, item_partial['name'])
+                    StatPartial._restore_item(item, item_partial, calls, leads)
+        return stat
+
+    @staticmethod
+    def finalize(partial: Dict[str, Any], kpi_plans_data: Union[List[Dict], KpiList],
+                 parallel: Optional[bool] = None) -> Stat:
+        """Финализированный Stat по объединенному частичному состоянию"""
+        stat = StatPartial.to_stat(partial)
+        stat._load_kpi_data(kpi_plans_data)
+        container = partial['container']
+        if container['category'] or container['offer']:
+            stat.apply_container_counters(container['category'], container['offer'])
+        else:
+            logger.warning("No leads container data provided")
+        stat.finalize_categories(parallel)
+        return stat
@@ -20,6 +20,25 @@ def sync_kpi_data_from_itrade():
         logger.error(f"Error in KPI data sync: {str(e)}")
         raise
 
+@shared_task(bind=True)
+def run_kpi_analysis_job(self, endpoint, filter_params):
+    """Фоновый KPI анализ для режима задачи эндпоинтов KPIAdvancedAnalysisViewSet"""
+    from .views import KPIAdvancedAnalysisViewSet
+    from .services.analysis_jobs import AnalysisJobProgress
+
+    job_id = self.request.id
+    progress = AnalysisJobProgress(self, job_id)
+    progress('queued', endpoint=endpoint)
+    try:
+        result = KPIAdvancedAnalysisViewSet().run_job(endpoint, filter_params, progress)
+    except Exception as e:
+        logger.error(f"Error in KPI analysis job {job_id}: {str(e)}")
+        progress('failed', error=str(e))
+        raise
+
+    progress('done', success=result.get('success', False))
+    return result
+
 @shared_task
 def update_formula_dependencies():
     """Задача для обновления зависимостей формул"""
@@ -42,51 +61,115 @@ def update_formula_dependencies():
         logger.error(f"Error updating formula dependencies: {str(e)}")
         raise
 
+@shared_task
+def build_kpi_facts(max_days=None):
+    """Инкрементальное построение дневных таблиц фактов KPI (недостающие и устаревшие закрытые дни)"""
+    try:
+        from .services.kpi_facts import KpiFactService
+
+        days = KpiFactService.build_incremental(max_days)
+        logger.info(f"KPI facts built for {len(days)} days: {[d.isoformat() for d in days]}")
+        return [d.isoformat() for d in days]
+
+    except Exception as e:
+        logger.error(f"Error building KPI facts: {str(e)}")
+        raise
+
+
+@shared_task
+def refresh_reference_data():
+    """Фоновое обновление справочников itrade (категории, рекламодатели, офферы, операторы)"""
+    try:
+        from .services.reference_data import ReferenceData
+
+        etags = ReferenceData.refresh()
+        logger.info(f"Reference data refreshed: {etags}")
+        return etags
+
+    except Exception as e:
+        logger.error(f"Error refreshing reference data: {str(e)}")
+        raise
+
+
+def _kpi_data_rows(stat, date_from, date_to):
+    """Итоги анализа -> строки KpiData: категория и ее офферы, операторы, вебмастера"""
+    from .models import KpiData
+
+    def make_row(category, item, **fields):
+        kpi_stat = item.kpi_stat
+        lc = item.lead_container
+        return KpiData(
+            category=category,
+            date_from=date_from,
+            date_to=date_to,
+            calls_count=kpi_stat.calls_group_effective_count,
+            leads_count=kpi_stat.leads_effective_count,
+            effective_calls=kpi_stat.calls_group_effective_count,
+            effective_leads=kpi_stat.leads_effective_count,
+            non_trash_leads=lc.leads_non_trash_count,
+            approved_leads=lc.leads_approved_count,
+            buyout_count=lc.leads_buyout_count,
+            effective_rate=kpi_stat.effective_rate or 0.0,
+            effective_percent=kpi_stat.effective_percent or 0.0,
+            **fields
+        )
+
+    rows = []
+    for category_name, category in stat.category.items():
+        rows.append(make_row(category_name, category))
+        for offer in category.offer.values():
+            rows.append(make_row(category_name, offer, offer_name=offer.description))
+        for operator in category.operator.values():
+            rows.append(make_row(category_name, operator, operator_name=operator.key))
+        for aff in category.aff.values():
+            affiliate_id = int(aff.key) if str(aff.key).isdigit() else None
+            rows.append(make_row(category_name, aff, affiliate_id=affiliate_id))
+    return rows
+
+
 @shared_task
 def refresh_kpi_data(date_from=None, date_to=None):
     """Задача для обновления KPI данных в локальной БД"""
     try:
+        from datetime import date, timedelta
+        from django.db import transaction
         from .models import KpiData
-        from .views import KPIAnalyticsViewSet
+        from .services.kpi_analyzer import OpAnalyzeKPI
+        from .services.kpi_facts import KpiFactService
 
         if not date_from or not date_to:
             # По умолчанию за последние 30 дней
-            from django.utils import timezone
-            from datetime import timedelta
             date_to = timezone.now().date()
             date_from = date_to - timedelta(days=30)
+        # Аргументы из очереди Celery приходят строками
+        if isinstance(date_from, str):
+            date_from = date.fromisoformat(date_from[:10])
+        if isinstance(date_to, str):
+            date_to = date.fromisoformat(date_to[:10])
+
+        # Недостающие закрытые дни периода достраиваются, открытые дни анализ загрузит из itrade
+        missing = set(KpiFactService.days_to_build())
+        for day in sorted(missing):
+            if date_from <= day <= date_to:
+                KpiFactService.build_day(day)
 
-        analytics_viewset = KPIAnalyticsViewSet()
-        raw_data = analytics_viewset.execute_kpi_queries(
-            date_from.strftime('%Y-%m-%d'),
-            date_to.strftime('%Y-%m-%d'),
-            None, None, None, None
+        filters = {'date_from': date_from.strftime('%Y-%m-%d'), 'date_to': date_to.strftime('%Y-%m-%d')}
+        data = KpiFactService.fetch_analysis_data(filters)
+        stat = OpAnalyzeKPI().run_analysis_with_data(
+            data['kpi_plans'], data['offers'], data['leads'], data['calls'], data['leads_container'],
+            filters, lead_facts=data['lead_facts'], leads_container_facts=data['leads_container_facts']
         )
+        rows = _kpi_data_rows(stat, date_from, date_to)
 
         # Очистка и обновление данных
-        KpiData.objects.filter(date_from=date_from, date_to=date_to).delete()
-
-        records_created = 0
-        for item in raw_data:
-            KpiData.objects.create(
-                category=item.get('category_name'),
-                offer_name=item.get('offer_name'),
-                operator_name=item.get('operator_name'),
-                affiliate_id=item.get('aff_id'),
-                date_from=date_from,
-                date_to=date_to,
-                calls_count=item.get('calls_count', 0),
-                leads_count=item.get('leads_count', 0),
-                effective_calls=item.get('effective_calls', item.get('calls_count', 0)),
-                effective_leads=item.get('effective_leads', item.get('leads_count', 0)),
-                effective_rate=item.get('conversion_rate', 0),
-                effective_percent=item.get('conversion_rate', 0),
-            )
-            records_created += 1
+        with transaction.atomic():
+            KpiData.objects.filter(date_from=date_from, date_to=date_to).delete()
+            KpiData.objects.bulk_create(rows, batch_size=1000)
 
+        records_created = len(rows)
         logger.info(f"KPI data refreshed: {records_created} records for {date_from} to {date_to}")
         return records_created
 
     except Exception as e:
         logger.error(f"Error refreshing KPI data: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,158 @@
+import math
+import random
+from datetime import date, timedelta
+
+from django.test import SimpleTestCase
+
+from kpi_analyzer.services.db_service import DBService
+from kpi_analyzer.services.engine_call_efficiency2 import KpiList
+from kpi_analyzer.services.engine_call_efficiency_columnar import ColumnarCallEfficiency, DIMENSIONS
+from kpi_analyzer.services.kpi_analyzer import OpAnalyzeKPI
+
+BASE_DATE = date(2025, 9, 1)
+DAYS = 5
+CATEGORIES = ('Cat A', 'Cat B', 'Cat C')
+OPERATORS = tuple(f'op{i}' for i in range(8))
+AFFILIATES = (100, 101, 102, 103, None)
+STATUSES = (('accepted', 'Подтвержден'), ('accepted', 'Отправить позже'), ('canceled', 'Отмена'),
+            ('paid', 'Оплачен'), ('shipped', 'Перезвон 2 день'), ('return', 'Возврат'))
+
+
+def make_data(seed: int, calls_count: int = 3000, leads_count: int = 800):
+    """Синтетические планы, офферы, лиды и звонки для сравнения движков.
+
+    - оффер 12 без планов, у оффера 11 и части планов вебмастеров operator_efficiency ниже KpiList.min_eff;
+    - звонки оператора op_short короче порога эффективности (элементы разреза без эффективных групп);
+    - часть звонков без оффера (группы без расчета), у части лидов нет звонков.
+    """
+    r = random.Random(seed)
+    offers = [{'id': i, 'name': f'Offer {i}', 'category_name': CATEGORIES[i % 3]} for i in range(1, 13)]
+
+    plans = []
+    for day in range(-3, DAYS, 2):
+        for offer in offers[:-1]:
+            for aff in (None, 100, 101):
+                if aff is not None and r.random() < 0.6:
+                    continue
+                if aff is not None:
+                    efficiency = r.choice((0.05, 0.0, 1.5))
+                elif offer['id'] == 11:
+                    efficiency = 0.05
+                else:
+                    efficiency = r.choice((1.2, 1.5, 2.0, 2.5, 3.3))
+                plans.append({'call_eff_kpi_id': len(plans) + 1,
+                              'call_eff_period_date': (BASE_DATE + timedelta(days=day)).isoformat(),
+                              'call_eff_offer_id': offer['id'], 'call_eff_affiliate_id': aff,
+                              'call_eff_plan_update_date': '2025-08-01', 'call_eff_operator_efficiency': efficiency,
+                              'call_eff_planned_approve': 0.4, 'call_eff_planned_buyout': 0.6,
+                              'call_eff_confirmation_price': 10, 'call_eff_buyout_price': 5})
+    plans.sort(key=lambda p: p['call_eff_period_date'])
+
+    calls = []
+    for i in range(calls_count):
+        offer = r.choice(offers)
+        operator = r.choice(OPERATORS + (None, 'op_short'))
+        billsec = r.randrange(0, 59) if operator == 'op_short' else r.randrange(30, 200)
+        calls.append({'call_eff_id': i + 1, 'call_eff_crm_id': i,
+                      'call_eff_offer_id': None if r.random() < 0.05 else offer['id'],
+                      'call_eff_uniqueid': f'u{r.randrange(calls_count // 2)}',
+                      'call_eff_calldate': (BASE_DATE + timedelta(days=r.randrange(DAYS))).isoformat(),
+                      'call_eff_crm_lead_id': r.randrange(400), 'call_eff_operator_id': r.randrange(8),
+                      'call_eff_billsec': billsec, 'call_eff_billsec_exact': r.choice((None, billsec, -1)),
+                      'call_eff_robo_detected': 0, 'lv_username': operator, 'offer_name': offer['name'],
+                      'category_name': offer['category_name'], 'call_eff_affiliate_id': r.choice(AFFILIATES)})
+    calls.sort(key=lambda c: c['call_eff_calldate'])
+
+    leads = []
+    for _ in range(leads_count):
+        offer = r.choice(offers)
+        day = (BASE_DATE + timedelta(days=r.randrange(DAYS))).isoformat()
+        group, verbose = r.choice(STATUSES)
+        leads.append({'call_eff_crm_lead_id': r.randrange(500),
+                      'call_eff_approved_at': f'{day} 1{r.randrange(10)}:00:00',
+                      'call_eff_canceled_at': r.choice(('', None, f'{day} 12:00:00')),
+                      'lv_username': r.choice(OPERATORS), 'call_eff_operator_id': r.randrange(8),
+                      'call_eff_status_verbose': verbose, 'call_eff_status_group': group,
+                      'offer_id': offer['id'], 'offer_name': offer['name'],
+                      'category_name': offer['category_name'], 'aff_id': r.choice(AFFILIATES)})
+    return plans, offers, leads, calls
+
+
+def compact(rows):
+    """Строки в виде CompactRow, как их возвращает DBService при потоковом чтении"""
+    return [DBService._row_type(list(row.keys()))._make(row.values()) for row in rows]
+
+
+class ColumnarParityTest(SimpleTestCase):
+    """ColumnarCallEfficiency.compute совпадает с объектным движком (kpi_analyzer.Stat) по всем разрезам"""
+
+    SEEDS = (1, 2, 3, 4)
+
+    @staticmethod
+    def _same(expected, actual) -> bool:
+        if expected is None:
+            return actual is None or (isinstance(actual, float) and math.isnan(actual))
+        return math.isclose(float(expected), float(actual), rel_tol=1e-9, abs_tol=1e-12)
+
+    @staticmethod
+    def _items(stat, dimension):
+        for cat_name, category in stat.category.items():
+            if dimension == 'category':
+                yield (cat_name,), category
+            else:
+                for key, item in getattr(category, dimension).items():
+                    yield (cat_name, key), item
+
+    def _check(self, seed: int, compact_rows: bool):
+        plans, offers, leads, calls = make_data(seed)
+        if compact_rows:
+            leads, calls = compact(leads), compact(calls)
+
+        stat = OpAnalyzeKPI().run_analysis_with_data(plans, offers, list(leads), list(calls), [], {})
+        result = ColumnarCallEfficiency.from_rows(calls, leads).compute(stat.kpi_list)
+
+        for dimension, columns in DIMENSIONS.items():
+            rows = {tuple(row[c] for c in columns): row for row in result[dimension].to_dict('records')}
+            for key, item in self._items(stat, dimension):
+                engine = item.kpi_stat.stat
+                expected = {
+                    'calls_group_effective_count': engine.calls_group_effective_count,
+                    'calls_group_with_calculation': engine.calls_group_with_calculation,
+                    'calls_group_without_calculation': engine.calls_group_without_calculation,
+                    'leads_effective_count': engine.leads_effective_count,
+                    'effective_rate': engine.effective_rate,
+                    'expecting_approved_leads': engine.expecting_approved_leads,
+                    'expecting_effective_rate': engine.expecting_effective_rate,
+                    'effective_percent': engine.effective_percent,
+                }
+                row = rows.pop(key, None)
+                with self.subTest(seed=seed, compact=compact_rows, dimension=dimension, key=key):
+                    if row is None:
+                        # Элементы без эффективных групп и лидов колоночный движок не возвращает
+                        self.assertEqual(engine.calls_group_effective_count, 0)
+                        self.assertEqual(engine.leads_effective_count, 0)
+                        continue
+                    for name, value in expected.items():
+                        self.assertTrue(self._same(value, row[name]), f'{name}: {value} != {row[name]}')
+            with self.subTest(seed=seed, compact=compact_rows, dimension=dimension):
+                self.assertEqual(rows, {}, 'Лишние элементы разреза в колоночном результате')
+
+    def test_parity(self):
+        for seed in self.SEEDS:
+            self._check(seed, compact_rows=False)
+
+    def test_parity_compact_rows(self):
+        self._check(self.SEEDS[-1], compact_rows=True)
+
+    def test_data_covers_edge_cases(self):
+        """Данные содержат планы ниже min_eff, группы без эффективных звонков и элементы без ожидания"""
+        plans, offers, leads, calls = make_data(self.SEEDS[0])
+        self.assertTrue(any(p['call_eff_operator_efficiency'] < KpiList.min_eff for p in plans))
+
+        stat = OpAnalyzeKPI().run_analysis_with_data(plans, offers, leads, calls, [], {})
+        operators = [item for _, item in self._items(stat, 'operator')]
+        self.assertTrue(any(item.key == 'op_short' and item.kpi_stat.stat.calls_group and
+                            item.kpi_stat.stat.calls_group_effective_count == 0 for item in operators))
+        items = [item for dimension in DIMENSIONS for _, item in self._items(stat, dimension)]
+        self.assertTrue(any(item.kpi_stat.stat.expecting_approved_leads is None for item in items))
+        self.assertTrue(any(item.kpi_stat.stat.calls_group_without_calculation for item in items))
@@ -0,0 +1,148 @@
+import random
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from kpi_analyzer.services.db_service import DBService
+from kpi_analyzer.services.incremental_analysis import IncrementalAnalysis
+from kpi_analyzer.services.kpi_analyzer import OpAnalyzeKPI
+from kpi_analyzer.services.kpi_facts import KpiFactService
+from kpi_analyzer.services.kpi_plan_cache import KpiPlanCache
+from kpi_analyzer.services.output_formatter import KPIOutputFormatter
+
+from .test_columnar_parity import BASE_DATE, DAYS, make_data
+
+# Лиды, подтвержденные в одну секунду на границе дозагрузки: часть видна при дозагрузке в эту же
+# секунду, часть фиксируется в itrade позже с тем же approved_at
+BOUNDARY = 30000
+# Моменты анализов (секунды от начала сегодняшнего дня)
+REFRESHES = (20000, 20300, 20900, BOUNDARY, BOUNDARY + 1, BOUNDARY + 1, 50000, 86399)
+
+
+class ItradeTimeline:
+    """Строки itrade за сегодня, видимые на момент now, и фильтры дозагрузки как в запросах DBService"""
+
+    def __init__(self, seed: int):
+        r = random.Random(seed)
+        plans, self.offers, leads, calls = make_data(seed)
+        self.today = datetime.now().date()
+        # Планы сдвинуты так, чтобы последний день данных стал сегодняшним
+        shift = self.today - (BASE_DATE + timedelta(days=DAYS - 1))
+        for plan in plans:
+            plan['call_eff_period_date'] = (date.fromisoformat(plan['call_eff_period_date']) + shift).isoformat()
+        self.kpi_list = KpiPlanCache.build_kpi_list(plans)
+        self.now = 0
+
+        # Звонки: id по времени звонка, каждый 40-й фиксируется на 400 секунд позже соседей с большими id
+        times = sorted(r.randrange(86000) for _ in calls)
+        self.calls = []
+        for i, (call, at) in enumerate(zip(calls, times)):
+            self.calls.append(dict(call, call_eff_id=i + 1, call_eff_calldate=self.today.isoformat(),
+                                   visible_at=at + (400 if i % 40 == 0 else 0)))
+
+        self.leads = []
+        for i, lead in enumerate(leads):
+            at = BOUNDARY if i % 100 == 0 else r.randrange(86000)
+            visible_at = at + 1 if i % 200 == 0 else at
+            self.leads.append(dict(lead, call_eff_approved_at=self.ts(at), visible_at=visible_at))
+
+        # Контейнер: строка лида меняется (аппрув, выкуп) после создания - дозагрузка заменяет ее вклад.
+        # Строку без CRM лида заменить нельзя (см. IncrementalAnalysis._apply_container) - она не меняется
+        self.container = []
+        for i, lead in enumerate(leads):
+            crm_lead_id = None if i % 50 == 0 else i
+            created = r.randrange(80000)
+            delay = 0 if crm_lead_id is None else 6000
+            approved = created + r.randrange(delay + 1) if r.random() < 0.6 else None
+            buyout = approved + r.randrange(delay // 2 + 1) if approved is not None and r.random() < 0.5 else None
+            self.container.append({
+                'lead_container_crm_lead_id': crm_lead_id, 'created': created,
+                'approved': approved, 'buyout': buyout,
+                'lead_container_canceled_at': lead['call_eff_canceled_at'],
+                'lead_container_status_verbose': lead['call_eff_status_verbose'],
+                'lead_container_status_group': lead['call_eff_status_group'],
+                'lead_container_is_trash': r.choice((0, 0, 1)),
+                'offer_id': lead['offer_id'], 'offer_name': lead['offer_name'],
+                'category_name': lead['category_name'], 'aff_id': lead['aff_id'], 'lv_username': lead['lv_username'],
+            })
+
+    def ts(self, seconds: int) -> str:
+        return (datetime.combine(self.today, datetime.min.time()) + timedelta(seconds=seconds)).strftime(
+            '%Y-%m-%d %H:%M:%S')
+
+    def get_calls(self, filters, stream=False, compact=False):
+        after = filters.get('after_call_id') or 0
+        return [call for call in self.calls if call['visible_at'] <= self.now and call['call_eff_id'] > after]
+
+    def get_leads(self, filters, stream=False, compact=False):
+        since = filters.get('approved_since') or ''
+        leads = [lead for lead in self.leads if lead['visible_at'] <= self.now and lead['call_eff_approved_at'] >= since]
+        return sorted(leads, key=lambda lead: lead['call_eff_approved_at'])
+
+    def get_leads_container(self, filters, compact=False):
+        rows = []
+        for row in self.container:
+            if row['created'] > self.now:
+                continue
+            times = {'lead_container_created_at': row['created'], 'lead_container_approved_at': row['approved'],
+                     'lead_container_buyout_at': row['buyout']}
+            visible = {name: self.ts(at) if at is not None and at <= self.now else None for name, at in times.items()}
+            if filters.get('changed_since') and not any(at and at >= filters['changed_since']
+                                                        for at in visible.values()):
+                continue
+            rows.append(dict(row, **visible, lead_container_now=self.ts(self.now)))
+        return rows
+
+    def get_offers(self, filters=None):
+        return [dict(offer) for offer in self.offers]
+
+
+class IncrementalAnalysisTest(SimpleTestCase):
+    """Дозагрузка IncrementalAnalysis дает тот же анализ, что и полная загрузка видимых строк"""
+
+    SEEDS = (1, 2)
+
+    def setUp(self):
+        patcher = mock.patch.multiple(IncrementalAnalysis, CALL_ID_OVERLAP=50, FULL_RELOAD_SECONDS=10 ** 6)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(KpiFactService, 'ENABLED', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(IncrementalAnalysis._states.clear)
+
+    def _check(self, seed: int):
+        # Состояние дозагрузки - по фильтрам, у всех сидов они одинаковые
+        IncrementalAnalysis._states.clear()
+        timeline = ItradeTimeline(seed)
+        filters = {'date_from': timeline.today.isoformat(), 'date_to': timeline.today.isoformat()}
+        formatter = KPIOutputFormatter()
+
+        with mock.patch.object(DBService, 'get_calls', timeline.get_calls), \
+                mock.patch.object(DBService, 'get_leads', timeline.get_leads), \
+                mock.patch.object(DBService, 'get_leads_container', timeline.get_leads_container), \
+                mock.patch.object(DBService, 'get_offers', timeline.get_offers), \
+                mock.patch.object(KpiPlanCache, 'kpi_list', timeline.kpi_list.view):
+            self.assertTrue(IncrementalAnalysis.applies(filters))
+            for step, now in enumerate(REFRESHES):
+                timeline.now = now
+                stat, info = IncrementalAnalysis.run(filters)
+                full = OpAnalyzeKPI().run_analysis_with_data(
+                    timeline.kpi_list.view(), timeline.get_offers(), timeline.get_leads({}),
+                    timeline.get_calls({}), timeline.get_leads_container({}), {})
+
+                with self.subTest(seed=seed, now=now):
+                    self.assertEqual(info['incremental']['full'], step == 0)
+                    self.assertEqual(formatter.create_output_structure(full), formatter.create_output_structure(stat))
+                    self.assertEqual(formatter.format_for_frontend(full), formatter.format_for_frontend(stat))
+                    if now == BOUNDARY + 1 and REFRESHES[step - 1] == BOUNDARY:
+                        # Лиды с approved_at на отметке, зафиксированные после прошлой дозагрузки
+                        self.assertGreater(info['incremental']['new_leads'], 0)
+                    if step and now > REFRESHES[step - 1] + 1:
+                        self.assertGreater(info['incremental']['changed_container_leads'], 0)
+
+    def test_refreshes_match_full_analysis(self):
+        for seed in self.SEEDS:
+            with self.subTest(seed=seed):
+                self._check(seed)
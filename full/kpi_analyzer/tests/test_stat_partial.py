@@ -0,0 +1,78 @@
+import random
+from datetime import timedelta
+
+from django.test import SimpleTestCase
+
+from kpi_analyzer.services.kpi_analyzer import OpAnalyzeKPI
+from kpi_analyzer.services.output_formatter import KPIOutputFormatter
+from kpi_analyzer.services.stat_partial import StatPartial
+
+from .test_columnar_parity import BASE_DATE, DAYS, make_data
+
+
+def make_container(seed: int, leads):
+    """Строки контейнера лидов (get_leads_container) по лидам make_data: created_at - в дни периода"""
+    r = random.Random(seed)
+    container = []
+    for i, lead in enumerate(leads):
+        created_at = f'{(BASE_DATE + timedelta(days=r.randrange(DAYS))).isoformat()} 09:00:00'
+        container.append({'lead_container_crm_lead_id': i, 'lead_container_created_at': created_at,
+                          'lead_container_approved_at': r.choice((lead['call_eff_approved_at'], None)),
+                          'lead_container_canceled_at': lead['call_eff_canceled_at'],
+                          'lead_container_buyout_at': r.choice((None, lead['call_eff_approved_at'])),
+                          'lead_container_status_verbose': lead['call_eff_status_verbose'],
+                          'lead_container_status_group': lead['call_eff_status_group'],
+                          'lead_container_is_trash': r.choice((0, 0, 1)),
+                          'offer_id': lead['offer_id'], 'offer_name': lead['offer_name'],
+                          'category_name': lead['category_name'], 'aff_id': lead['aff_id'],
+                          'lv_username': lead['lv_username']})
+    return container
+
+
+class StatPartialDaysTest(SimpleTestCase):
+    """Анализ, принятый по дням (ingest -> dumps/loads -> merge -> finalize), совпадает с анализом за весь период"""
+
+    SEEDS = (1, 2, 3)
+
+    @staticmethod
+    def _days(rows, field):
+        days = {}
+        for row in rows:
+            days.setdefault(row[field][:10], []).append(row)
+        return days
+
+    def _check(self, seed: int):
+        plans, offers, leads, calls = make_data(seed)
+        # Как get_leads: лиды упорядочены по approved_at (см. StatPartial)
+        leads.sort(key=lambda lead: lead['call_eff_approved_at'])
+        container = make_container(seed, leads)
+
+        single = OpAnalyzeKPI().run_analysis_with_data(plans, offers, list(leads), list(calls), container, {})
+
+        leads_by_day = self._days(leads, 'call_eff_approved_at')
+        calls_by_day = self._days(calls, 'call_eff_calldate')
+        container_by_day = self._days(container, 'lead_container_created_at')
+        days = sorted(set(leads_by_day) | set(calls_by_day) | set(container_by_day))
+        self.assertGreater(len(days), 1)
+
+        parts = [StatPartial.loads(StatPartial.dumps(StatPartial.ingest(
+            offers, leads_by_day.get(day, []), calls_by_day.get(day, []), container_by_day.get(day, []))))
+            for day in days]
+        merged = StatPartial.finalize(StatPartial.merge(parts), plans)
+
+        formatter = KPIOutputFormatter()
+        self.assertEqual(formatter.create_output_structure(single), formatter.create_output_structure(merged))
+        self.assertEqual(formatter.format_for_frontend(single), formatter.format_for_frontend(merged))
+
+    def test_days_match_single_pass(self):
+        for seed in self.SEEDS:
+            with self.subTest(seed=seed):
+                self._check(seed)
+
+    def test_data_has_repeated_leads(self):
+        # Повторы CRM лида в разные дни проверяют, что из частей остается лид более раннего дня
+        _, _, leads, _ = make_data(self.SEEDS[0])
+        days_by_lead = {}
+        for lead in leads:
+            days_by_lead.setdefault(lead['call_eff_crm_lead_id'], set()).add(lead['call_eff_approved_at'][:10])
+        self.assertTrue(any(len(days) > 1 for days in days_by_lead.values()))
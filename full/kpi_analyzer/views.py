@@ -1,3 +1,4 @@
+import json
 import time
 import logging
 from rest_framework import viewsets, status
@@ -9,13 +10,24 @@ from rest_framework.views import APIView
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.http import quote_etag, parse_etags
+from celery.result import AsyncResult
 from datetime import datetime
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from .services.output_formatter import KPIOutputFormatter
 from .services.db_service import DBService
+from .services.itrade_replicas import itrade_replicas
+from .services.query_stats import QueryStats
+from .services.reference_data import ReferenceData
+from .services.analysis_cache import AnalysisCache
+from .services.kpi_facts import KpiFactService
+from .services.kpi_plan_cache import KpiPlanCache
 from .services.kpi_analyzer import OpAnalyzeKPI
+from .services.incremental_analysis import IncrementalAnalysis
+from .services.analysis_jobs import AnalysisJobProgress
 from .models import Spreadsheet, Sheet, Cell, Formula, PivotTable, KpiData
 from .serializers import (
     SpreadsheetSerializer, SheetSerializer, CellSerializer, FormulaSerializer,
@@ -23,6 +35,7 @@ from .serializers import (
 )
 from .services.formula_engine import FormulaEngine
 from .pivot_engine import PivotEngine
+from .tasks import run_kpi_analysis_job
 
 logger = logging.getLogger(__name__)
 
@@ -94,6 +107,10 @@ class AdminStatsView(APIView):
             'active_users': User.objects.filter(is_active=True).count(),
             'inactive_users': User.objects.filter(is_active=False).count(),
             'new_users_today': User.objects.filter(date_joined__date=today).count(),
+            'itrade_replicas': itrade_replicas.stats(),
+            'itrade_queries': QueryStats.stats(),
+            'kpi_plans': KpiPlanCache.stats(),
+            'incremental_analysis': IncrementalAnalysis.stats(),
         }
 
         return Response(stats)
@@ -287,23 +304,25 @@ class PivotTableViewSet(viewsets.ModelViewSet):
 
 
 # Эндпоинты для справочников (используют itrade)
+def reference_list_response(request, values, etag):
+    """Ответ со списком из справочника и ETag; 304, если у клиента актуальная версия"""
+    if etag is None:
+        return Response(values)
+    etag = quote_etag(etag)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(values, headers=headers)
+
+
 @permission_classes([IsAuthenticated])
 class CategoryListView(APIView):
     authentication_classes = [JWTAuthentication]
 
     def get(self, request):
         try:
-            query = """
-            SELECT DISTINCT name 
-            FROM partners_groupoffer 
-            WHERE name NOT IN ('Архив', 'Входящая линия') 
-            AND name IS NOT NULL 
-            AND name != ''
-            ORDER BY name
-            """
-            results = DBService._execute_query(query, [])
-            categories = [row['name'] for row in results if row['name']]
-            return Response(categories)
+            categories, etag = ReferenceData.categories()
+            return reference_list_response(request, categories, etag)
         except Exception as e:
             logger.error(f"Ошибка получения категорий: {e}")
             return Response([], status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -315,18 +334,8 @@ class AdvertiserListView(APIView):
 
     def get(self, request):
         try:
-            query = """
-            SELECT DISTINCT name 
-            FROM partners_subsystem 
-            WHERE 1=1
-            AND system = 'traffic_light' 
-            AND name IS NOT NULL 
-            AND name != ''
-            ORDER BY name
-            """
-            results = DBService._execute_query(query, [])
-            advertisers = [row['name'] for row in results if row['name']]
-            return Response(advertisers)
+            advertisers, etag = ReferenceData.advertisers()
+            return reference_list_response(request, advertisers, etag)
         except Exception as e:
             logger.error(f"Ошибка получения advertisers: {e}")
             return Response([], status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -336,36 +345,161 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
     permission_classes = []
     authentication_classes = []
 
+    # Эндпоинты, поддерживающие режим фоновой задачи ('async': true)
+    JOB_ENDPOINTS = ('advanced_analysis', 'full_structured_data', 'full_data_table')
+
     @action(detail=False, methods=['post'])
     def advanced_analysis(self, request):
-        start_time = time.time()
         filter_params = request.data or {}
-        response = {'success': False, 'data': []}
-
         logger.info(f"Запуск KPI анализа: {filter_params.get('date_from')} - {filter_params.get('date_to')}")
+        return self._cached_response(request, 'advanced_analysis', filter_params)
 
-        try:
-            kpi_plans = DBService.get_kpi_plans_data()
-            offers = DBService.get_offers(filter_params)
-            leads = DBService.get_leads(filter_params)
-            calls = DBService.get_calls(filter_params)
-            leads_container = DBService.get_leads_container(filter_params)
-
-            analyzer = OpAnalyzeKPI()
-            stat = analyzer.run_analysis_with_data(
-                kpi_plans_data=kpi_plans,
-                offers_data=offers,
-                leads_data=leads,
-                calls_data=calls,
-                leads_container_data=leads_container,
-                filters=filter_params
+    @action(detail=False, methods=['post'])
+    def full_structured_data(self, request):
+        filter_params = request.data or {}
+        logger.info(
+            f"Запуск полного KPI анализа для FullDataPage: {filter_params.get('date_from')} - {filter_params.get('date_to')}")
+        return self._cached_response(request, 'full_structured_data', filter_params)
+
+    @action(detail=False, methods=['post'])
+    def full_data_table(self, request):
+        filter_params = request.data or {}
+        logger.info(
+            f"Запуск генерации полной таблицы KPI: {filter_params.get('date_from')} - {filter_params.get('date_to')}")
+        return self._cached_response(request, 'full_data_table', filter_params)
+
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[\w-]+)')
+    def job_result(self, request, job_id=None):
+        """Статус и результат фонового анализа (режим async); только для сессии, поставившей задачу"""
+        if not AnalysisJobProgress.owns(request.session, job_id):
+            return Response({'success': False, 'error': 'Задача не найдена'}, status=status.HTTP_404_NOT_FOUND)
+
+        result = AsyncResult(job_id)
+        state = result.state
+        response = {'success': True, 'job_id': job_id, 'status': state.lower()}
+
+        if state == 'PROGRESS':
+            response['progress'] = result.info
+        elif state == 'SUCCESS':
+            response['result'] = result.result
+        elif state == 'FAILURE':
+            response = {'success': False, 'job_id': job_id, 'status': 'failure', 'error': str(result.result)}
+
+        return Response(response)
+
+    def _cached_response(self, request, endpoint, filter_params):
+        if filter_params.get('async'):
+            return self._enqueue_job(request, endpoint, filter_params)
+
+        response = self._get_or_compute(endpoint, filter_params)
+        if isinstance(response, Response):
+            return response
+        return Response(response)
+
+    def _enqueue_job(self, request, endpoint, filter_params):
+        """Режим задачи: анализ выполняется в Celery, HTTP воркер сразу освобождается"""
+        job = run_kpi_analysis_job.delay(endpoint, dict(filter_params))
+        AnalysisJobProgress.remember(request.session, job.id)
+        logger.info(f"KPI анализ {endpoint} поставлен в очередь: {job.id}")
+        return Response({
+            'success': True,
+            'job_id': job.id,
+            'status': 'queued',
+            'result_url': f'jobs/{job.id}/',
+            'ws_url': f'/ws/kpi-jobs/{job.id}/',
+        }, status=status.HTTP_202_ACCEPTED)
+
+    def run_job(self, endpoint, filter_params, progress=None):
+        """Анализ из фоновой задачи: тот же кэш и single-flight, что и в синхронном режиме.
+
+        Возвращает JSON-совместимый ответ эндпоинта (результат Celery задачи).
+        """
+        if endpoint not in self.JOB_ENDPOINTS:
+            raise ValueError(f"Unknown analysis endpoint: {endpoint}")
+
+        response = self._get_or_compute(endpoint, filter_params, progress)
+        if isinstance(response, Response):
+            response = response.data
+        return json.loads(json.dumps(response, cls=DjangoJSONEncoder))
+
+    def _get_or_compute(self, endpoint, filter_params, progress=None):
+        """Отдает результат из кэша анализа или считает его (один раз для одновременных одинаковых запросов)"""
+        start_time = time.time()
+        compute = getattr(self, f'_compute_{endpoint}')
+        cache_key = AnalysisCache.make_key(endpoint, filter_params)
+
+        refresh = bool(filter_params.get('refresh'))
+        response = None if refresh else AnalysisCache.get(cache_key)
+        cache_hit = response is not None
+        coalesced = False
+        if not cache_hit:
+            # Одинаковые анализы, запущенные одновременно, считаются один раз
+            response, coalesced = AnalysisCache.compute_once(
+                cache_key, lambda: self._compute_with_query_stats(compute, filter_params, progress),
+                AnalysisCache.ttl_for(filter_params), refresh=refresh
             )
+            if isinstance(response, Response):
+                return response
+
+        performance = response.setdefault('performance', {})
+        if cache_hit or coalesced:
+            performance['total_seconds'] = round(time.time() - start_time, 2)
+        performance['cache'] = {'hit': cache_hit, 'coalesced': coalesced, **AnalysisCache.stats()}
+        return response
+
+    @staticmethod
+    def _compute_with_query_stats(compute, filter_params, progress=None):
+        """Выполняет расчет, добавляя в performance замеры запросов к itrade (QueryStats)"""
+        with QueryStats.collect() as queries:
+            response = compute(filter_params, progress)
+        if isinstance(response, dict) and 'performance' in response:
+            response['performance']['queries'] = queries.summary()
+        return response
+
+    @staticmethod
+    def _run_analysis(filter_params, progress=None):
+        """Stat анализа и сведения о загрузке: timings, fact_days, leads_count, calls_count, incremental.
+
+        Периоды с сегодняшним днем считаются инкрементально (IncrementalAnalysis), остальные - полностью.
+        """
+        if IncrementalAnalysis.applies(filter_params):
+            return IncrementalAnalysis.run(filter_params, progress)
+
+        data = KpiFactService.fetch_analysis_data(filter_params, progress=progress)
+        analyzer = OpAnalyzeKPI()
+        stat = analyzer.run_analysis_with_data(
+            kpi_plans_data=data['kpi_plans'],
+            offers_data=data['offers'],
+            leads_data=data['leads'],
+            calls_data=data['calls'],
+            leads_container_data=data['leads_container'],
+            filters=filter_params,
+            progress=progress,
+            lead_facts=data['lead_facts'],
+            leads_container_facts=data['leads_container_facts']
+        )
+        return stat, {
+            'timings': data['timings'],
+            'fact_days': data['fact_days'],
+            'leads_count': analyzer.leads_count,
+            'calls_count': analyzer.calls_count,
+            'incremental': None,
+        }
+
+    def _compute_advanced_analysis(self, filter_params, progress=None):
+        start_time = time.time()
+        response = {'success': False, 'data': []}
+
+        try:
+            stat, data = self._run_analysis(filter_params, progress)
 
             formatter = KPIOutputFormatter()
             result_data = formatter.format_for_frontend(
                 stat,
                 group_rows=filter_params.get('group_rows', 'Нет')
             )
+            if progress:
+                progress('format')
 
             execution_time = round(time.time() - start_time, 2)
             response = {
@@ -375,8 +509,11 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
                 'recommendations': result_data['recommendations'],
                 'performance': {
                     'total_seconds': execution_time,
-                    'leads_count': len(leads),
-                    'calls_count': len(calls),
+                    'leads_count': data['leads_count'],
+                    'calls_count': data['calls_count'],
+                    'fetch_seconds': data['timings'],
+                    'fact_days': data['fact_days'],
+                    'incremental': data['incremental'],
                 }
             }
 
@@ -384,28 +521,14 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
             logger.error(f"Ошибка анализа KPI: {e}", exc_info=True)
             response = {'success': False, 'error': str(e), 'data': []}
 
-        return Response(response)
+        return response
 
-    @action(detail=False, methods=['post'])
-    def full_structured_data(self, request):
+    def _compute_full_structured_data(self, filter_params, progress=None):
         start_time = time.time()
-        filter_params = request.data or {}
         response = {'success': False, 'data': []}
 
-        logger.info(
-            f"Запуск полного KPI анализа для FullDataPage: {filter_params.get('date_from')} - {filter_params.get('date_to')}")
-
         try:
-            kpi_plans = DBService.get_kpi_plans_data()
-            offers = DBService.get_offers(filter_params)
-            leads = DBService.get_leads(filter_params)
-            calls = DBService.get_calls(filter_params)
-            leads_container = DBService.get_leads_container(filter_params)
-
-            analyzer = OpAnalyzeKPI()
-            stat = analyzer.run_analysis_with_data(
-                kpi_plans, offers, leads, calls, leads_container, filter_params
-            )
+            stat, data = self._run_analysis(filter_params, progress)
 
             if hasattr(stat, 'category'):
                 logger.info(f"Обработано категорий: {len(stat.category)}")
@@ -428,6 +551,8 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
                 stat,
                 group_rows=filter_params.get('group_rows', 'Нет')
             )
+            if progress:
+                progress('format')
 
             execution_time = round(time.time() - start_time, 2)
 
@@ -439,6 +564,9 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
                     'total_seconds': execution_time,
                     'leads_count': total_leads,
                     'calls_count': total_calls,
+                    'fetch_seconds': data['timings'],
+                    'fact_days': data['fact_days'],
+                    'incremental': data['incremental'],
                 }
             }
 
@@ -450,31 +578,19 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
             execution_time = round(time.time() - start_time, 2)
             logger.info(f"Полный KPI анализ завершён за {execution_time}s")
 
-        return Response(response)
+        return response
 
-    @action(detail=False, methods=['post'])
-    def full_data_table(self, request):
+    def _compute_full_data_table(self, filter_params, progress=None):
         start_time = time.time()
-        filter_params = request.data or {}
         response = {'success': False, 'rows': []}
 
-        logger.info(
-            f"Запуск генерации полной таблицы KPI: {filter_params.get('date_from')} - {filter_params.get('date_to')}")
-
         try:
-            kpi_plans = DBService.get_kpi_plans_data()
-            offers = DBService.get_offers(filter_params)
-            leads = DBService.get_leads(filter_params)
-            calls = DBService.get_calls(filter_params)
-            leads_container = DBService.get_leads_container(filter_params)
-
-            analyzer = OpAnalyzeKPI()
-            stat = analyzer.run_analysis_with_data(
-                kpi_plans, offers, leads, calls, leads_container, filter_params
-            )
+            stat, data = self._run_analysis(filter_params, progress)
 
             formatter = KPIOutputFormatter()
             table_data = formatter.create_output_structure(stat)
+            if progress:
+                progress('format')
 
             if not table_data or len(table_data) < 2:
                 response = {
@@ -485,7 +601,7 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
                         'total_seconds': round(time.time() - start_time, 2),
                     }
                 }
-                return Response(response)
+                return response
 
             headers = table_data[0]
             rows_data = table_data[1:]
@@ -513,6 +629,9 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
                 'rows': formatted_rows,
                 'performance': {
                     'total_seconds': execution_time,
+                    'fetch_seconds': data['timings'],
+                    'fact_days': data['fact_days'],
+                    'incremental': data['incremental'],
                 }
             }
 
@@ -520,7 +639,7 @@ class KPIAdvancedAnalysisViewSet(viewsets.ViewSet):
             logger.error(f"Ошибка генерации полной таблицы KPI: {e}", exc_info=True)
             response = {'success': False, 'error': str(e), 'rows': []}
 
-        return Response(response)
+        return response
 
     def _get_field_name(self, header, col_index):
         field_mapping = {
@@ -589,41 +708,30 @@ class LegacyFilterParamsView(APIView):
     authentication_classes = []
 
     def get(self, request):
-        return Response({
+        advertisers, advertisers_etag = self.get_advertisers_list()
+        categories, categories_etag = self.get_categories_list()
+        return reference_list_response(request, {
             'available_filters': {
                 'output': ['Все', 'Есть активность', '--'],
                 'group_rows': ['Да', 'Нет'],
-                'advertisers': self.get_advertisers_list(),
-                'categories': self.get_categories_list(),
+                'advertisers': advertisers,
+                'categories': categories,
             }
-        })
+        }, f'{advertisers_etag}-{categories_etag}' if advertisers_etag and categories_etag else None)
 
     def get_advertisers_list(self):
-        query = """
-        SELECT DISTINCT name 
-        FROM partners_subsystem 
-        WHERE 1=1
-        AND system = 'traffic_light' 
-        AND name IS NOT NULL 
-        AND name != ''
-        ORDER BY name
-        """
         try:
-            results = DBService._execute_query(query, [])
-            return [row['name'] for row in results if row['name']]
+            return ReferenceData.advertisers()
         except Exception as e:
             logger.error(f"Ошибка получения advertisers: {e}")
-            return []
+            return [], None
 
     def get_categories_list(self):
-        query = """SELECT DISTINCT name FROM partners_groupoffer 
-                   WHERE name NOT IN ('Архив', 'Входящая линия') AND name IS NOT NULL"""
         try:
-            results = DBService._execute_query(query, [])
-            return [row['name'] for row in results if row['name']]
+            return ReferenceData.categories()
         except Exception as e:
             logger.error(f"Ошибка получения категорий: {e}")
-            return []
+            return [], None
 
 
 class KpiDataViewSet(viewsets.ModelViewSet):
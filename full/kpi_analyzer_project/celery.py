@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kpi_analyzer_project.settings')
 
@@ -12,12 +13,28 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
+
+@worker_process_init.connect
+def start_parallel_finalize(**kwargs):
+    # Пул финализации анализа (см. ParallelFinalize) - процессы порождает отдельный сервер forkserver
+    from kpi_analyzer.services.parallel_finalize import ParallelFinalize
+    ParallelFinalize.start()
+
+
 # Периодические задачи для KPI анализа
 app.conf.beat_schedule = {
     'update-formula-dependencies-every-15-min': {
         'task': 'kpi_analyzer.tasks.update_formula_dependencies',
         'schedule': 900.0,  # Каждые 15 минут
     },
+    'build-kpi-facts-every-hour': {
+        'task': 'kpi_analyzer.tasks.build_kpi_facts',
+        'schedule': 3600.0,  # Каждый час: недостающие и устаревшие закрытые дни
+    },
+    'refresh-reference-data-every-5-min': {
+        'task': 'kpi_analyzer.tasks.refresh_reference_data',
+        'schedule': 300.0,  # Каждые 5 минут: справочники для фильтров и get_offers
+    },
 }
 
 app.conf.timezone = 'Europe/Moscow'
\ No newline at end of file